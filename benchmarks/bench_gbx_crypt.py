@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Benchmark GearboxCrypt decryption throughput for each chunk size, with the
+pure-python implementation and (when installed) the numpy one.
+
+    python benchmarks/bench_gbx_crypt.py [total_megabytes]
+"""
+
+import sys
+import os
+import os.path
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from naabal.util.gbx_crypt import GearboxCrypt, numpy
+
+CHUNK_SIZES = [256, 4 * 1024, 64 * 1024, 1024 * 1024]
+
+def time_decrypt(crypto, data, chunk_size):
+    start = time.time()
+    for offset in xrange(0, len(data), chunk_size):
+        crypto.decrypt(data[offset:offset+chunk_size], offset)
+    return time.time() - start
+
+def main():
+    total_size = (int(sys.argv[1]) if len(sys.argv) > 1 else 16) * 1024 * 1024
+    rng = random.Random(1)
+    local_key = bytearray(rng.getrandbits(8) for i in range(256))
+    global_key = bytearray(rng.getrandbits(8) for i in range(1024))
+    data = os.urandom(total_size)
+
+    implementations = [('python', False)]
+    if numpy is not None:
+        implementations.append(('numpy', True))
+
+    sys.stdout.write('{0:>8} {1:>10} {2:>10}\n'.format('impl', 'chunk', 'MB/s'))
+    for name, use_numpy in implementations:
+        crypto = GearboxCrypt(total_size, local_key, global_key, use_numpy=use_numpy)
+        for chunk_size in CHUNK_SIZES:
+            elapsed = time_decrypt(crypto, data, chunk_size)
+            sys.stdout.write('{0:>8} {1:>10d} {2:>10.1f}\n'.format(
+                name, chunk_size, total_size / elapsed / (1024 * 1024)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Benchmark HomeworldBigFile.save() wall-clock time against the number of
+compression worker processes.
+
+    python benchmarks/bench_hw1_save.py [member_count] [member_size]
+"""
+
+import sys
+import os
+import os.path
+import random
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from naabal.formats.big.hw1 import HomeworldBigFile
+from naabal.util.workers import cpu_count
+
+WORDS = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod'.split()
+
+def build_source_tree(path, member_count, member_size):
+    rng = random.Random(member_count)
+    for i in range(member_count):
+        filename = os.path.join(path, 'data', 'dir%02d' % (i % 8), 'file%04d.txt' % i)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        data = ' '.join(rng.choice(WORDS) for j in range(member_size // 5))[:member_size]
+        with open(filename, 'wb') as handle:
+            handle.write(data)
+
+def time_save(src_dir, archive_filename, workers):
+    with HomeworldBigFile(archive_filename, 'wb') as bigfile:
+        bigfile.add_all(src_dir + os.sep)
+        start = time.time()
+        bigfile.save(workers=workers)
+        return time.time() - start
+
+def main():
+    member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    member_size = int(sys.argv[2]) if len(sys.argv) > 2 else 16 * 1024
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src_dir = os.path.join(tmp_dir, 'src')
+        build_source_tree(src_dir, member_count, member_size)
+        worker_counts = sorted(set([1, 2, 4, 8, cpu_count()]))
+        sys.stdout.write('{0} members x {1} bytes, {2} CPUs\n'.format(
+            member_count, member_size, cpu_count()))
+        sys.stdout.write('{0:>8} {1:>10} {2:>8}\n'.format('workers', 'seconds', 'speedup'))
+        baseline = None
+        for workers in worker_counts:
+            elapsed = time_save(src_dir, os.path.join(tmp_dir, 'bench.big'), workers)
+            if baseline is None:
+                baseline = elapsed
+            sys.stdout.write('{0:>8d} {1:>10.2f} {2:>7.2f}x\n'.format(
+                workers, elapsed, baseline / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
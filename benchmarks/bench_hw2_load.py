@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Benchmark Homeworld2BigFile.load() time against the number of members, the
+time per member should stay flat as the archive grows.
+
+    python benchmarks/bench_hw2_load.py [max_member_count]
+"""
+
+import sys
+import os
+import os.path
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from naabal.formats.big.hw2 import Homeworld2BigFile
+from tests.test_formats_big_hw2 import build_hw2_archive
+
+def build_members(member_count):
+    return dict((os.path.join('data', 'dir%02d' % (i % 16), 'sub%d' % (i % 3), 'file%05d.txt' % i),
+        'member %d\n' % i) for i in range(member_count))
+
+def time_load(archive_filename):
+    with Homeworld2BigFile(archive_filename) as bigfile:
+        start = time.time()
+        bigfile.load()
+        return time.time() - start
+
+def main():
+    max_member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 16000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        archive_filename = os.path.join(tmp_dir, 'bench.big')
+        sys.stdout.write('{0:>8} {1:>10} {2:>14}\n'.format('members', 'seconds', 'us/member'))
+        member_count = 1000
+        while member_count <= max_member_count:
+            build_hw2_archive(archive_filename, build_members(member_count))
+            elapsed = time_load(archive_filename)
+            sys.stdout.write('{0:>8d} {1:>10.3f} {2:>14.1f}\n'.format(
+                member_count, elapsed, elapsed / member_count * 1e6))
+            member_count *= 2
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
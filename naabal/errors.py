@@ -28,3 +28,16 @@ class StructuredFileFormatException(NaabalException): pass
 
 class BigFormatException(StructuredFileFormatException): pass
 class GearboxEncryptionException(BigFormatException): pass
+class BigIndexException(BigFormatException): pass
+
+class CompressionException(NaabalException): pass
+class CompressionBudgetExceeded(CompressionException):
+    def __init__(self, max_output, consumed, written):
+        super(CompressionBudgetExceeded, self).__init__(max_output, consumed, written)
+        self.max_output = max_output
+        self.consumed = consumed
+        self.written = written
+
+    def __str__(self):
+        return 'Compressed output exceeded budget of %d bytes (%d bytes written after consuming %d input bytes)' % \
+            (self.max_output, self.written, self.consumed)
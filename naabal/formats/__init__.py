@@ -38,6 +38,7 @@ class StructuredFile(object):
     _mode = None
     _name = None
     _closed = True
+    _owns_handle = True
     _data = None
     softspace = 0
 
@@ -62,10 +63,15 @@ class StructuredFile(object):
         return None
 
     def __init__(self, filename, mode='rb'):
-        handle = open(filename, mode)
+        if hasattr(filename, 'read') or hasattr(filename, 'write'):
+            # an already open file object, it is left open by close()
+            handle = filename
+            self._owns_handle = False
+        else:
+            handle = open(filename, mode)
         self._mode = mode
         self._closed = False
-        self._name = handle.name
+        self._name = getattr(handle, 'name', None)
         self._handle = handle
         self._load_defaults()
 
@@ -87,7 +93,10 @@ class StructuredFile(object):
         self._name = None
         self._mode = None
         self._closed = True
-        return handle.close()
+        if self._owns_handle:
+            return handle.close()
+        else:
+            handle.flush()
 
     def flush(self):
         self._handle.flush()
@@ -25,13 +25,17 @@
 import struct
 import os
 import os.path
+import tempfile
+import tarfile
 import logging
 
 from naabal.formats import StructuredFile, StructuredFileSection, StructuredFileSequence
-from naabal.util import StringIO, datetime_to_timestamp, timestamp_to_datetime
-from naabal.util.file_io import FileInFile, chunked_copy
+from naabal.util import StringIO, datetime_to_timestamp, timestamp_to_datetime, crc32
+from naabal.util.file_io import FileInFile, chunked_copy, LARGE_CHUNK_SIZE
+from naabal.util.cache import BlockCache
 from naabal.util.gbx_crypt import GearboxCrypt
-from naabal.errors import GearboxEncryptionException
+from naabal.util.scan import scan_tree, read_manifest
+from naabal.errors import BigFormatException, GearboxEncryptionException
 
 logger = logging.getLogger('naabal.formats.big')
 
@@ -42,6 +46,7 @@ class BigInfo(object):
     _mtime          = None
     _real_size      = 0
     _stored_size    = 0
+    _crc32          = None
 
     def __init__(self, bigfile):
         self._bigfile = bigfile
@@ -55,6 +60,19 @@ class BigInfo(object):
     def load(self, data):
         raise NotImplemented()
 
+    def load_index_entry(self, entry):
+        name, offset, real_size, stored_size, mtime, crc = entry
+        self._offset        = offset
+        self._name          = name
+        self._mtime         = timestamp_to_datetime(mtime)
+        self._real_size     = real_size
+        self._stored_size   = stored_size
+        self._crc32         = crc
+
+    def get_index_entry(self):
+        return (self.name, self._offset, self.real_size, self.stored_size,
+            datetime_to_timestamp(self.mtime), self.crc32)
+
     @property
     def name(self):
         return self._name
@@ -63,6 +81,14 @@ class BigInfo(object):
     def mtime(self):
         return self._mtime
 
+    @property
+    def crc32(self):
+        return self._crc32
+
+    @property
+    def compression_algorithm(self):
+        return None
+
     @property
     def is_compressed(self):
         return self.real_size > self.stored_size
@@ -79,26 +105,91 @@ class ExternalBigInfo(BigInfo):
     def open(self, mode='rb'):
         return open(self._real_filename, mode)
 
-    def load(self, file, alt_filename=None):
+    def load(self, file, alt_filename=None, fstat=None):
         if hasattr(file, 'read'):
             real_filename = file.name
         else:
             real_filename = file
 
         if alt_filename is None:
-            alt_filename = filename
+            alt_filename = real_filename
         self._real_filename = real_filename
         logger.debug('Loading metadata for (%s) from: %s', alt_filename, real_filename)
 
-        fstat = os.stat(real_filename)
+        if fstat is None:
+            fstat = os.stat(real_filename)
         self._offset         = 0
         self._name           = alt_filename
         self._mtime          = timestamp_to_datetime(fstat.st_mtime)
         self._real_size      = fstat.st_size
         self._stored_size    = fstat.st_size
 
+    def compute_crc32(self):
+        """Read the file to get the CRC32 of its content, it is kept as crc32."""
+
+        if self._crc32 is None:
+            value = 0
+            with self.open() as handle:
+                for chunk in iter(lambda: handle.read(LARGE_CHUNK_SIZE), ''):
+                    value = crc32(chunk, value)
+            self._crc32 = value
+        return self._crc32
+
+class ForeignBigInfo(BigInfo):
+    """A member of another (open) archive that is being added to this one.
+
+    open() gives the decompressed data like an ExternalBigInfo would, while
+    open_stored() gives the data exactly as it is stored in the source archive
+    so writers using the same compression algorithm can copy it as-is.
+    """
+
+    SPOOL_SIZE      = 8 * 1024 * 1024 # 8MB
+
+    def __init__(self, bigfile, source_member):
+        super(ForeignBigInfo, self).__init__(bigfile)
+        self._source        = source_member
+        self._offset        = 0
+        self._name          = source_member.name
+        self._mtime         = source_member.mtime
+        self._real_size     = source_member.real_size
+        self._stored_size   = source_member.stored_size
+        self._crc32         = source_member.crc32
+
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def compression_algorithm(self):
+        return self._source._bigfile.COMPRESSION_ALGORITHM
+
+    def open(self, mode='rb'):
+        if not self._source.is_compressed:
+            return self.open_stored(mode)
+        handle = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE)
+        self._source._bigfile.extract_file(self._source, handle)
+        handle.seek(0)
+        return handle
+
+    def open_stored(self, mode='rb'):
+        return self._source._bigfile.open_member(self._source, mode)
+
 class BigFile(StructuredFile):
+    # CompressionProfiles choosing how writers store each member, None gives
+    # every member the format's default treatment
+    COMPRESSION_PROFILES    = None
+
     _members        = []
+    _member_cache   = None
+    _deduplicator   = None
+    _save_counters  = None
+    _save_stats     = None
+    _member_profiles = None
+
+    def __init__(self, filename, mode='rb', member_cache=None):
+        super(BigFile, self).__init__(filename, mode)
+        self._members = []
+        self._member_cache = member_cache
 
     def __iter__(self):
         return iter(self.get_members())
@@ -111,6 +202,14 @@ class BigFile(StructuredFile):
         self._members = self._get_members()
         self._sort_members()
 
+    def load_index(self, big_index):
+        logger.debug('Loading members from index: %r', big_index)
+        members = []
+        for entry in big_index.members:
+            members.append(self._get_index_member(entry))
+        self._members = members
+        self._sort_members()
+
     def check_format(self):
         key, member_type = self.STRUCTURE[0]
         self.seek(0)
@@ -135,19 +234,91 @@ class BigFile(StructuredFile):
     def get_members(self):
         return self._members
 
+    def load_metadata(self, members=None):
+        """Make sure the mtime and crc32 of members (all by default) are
+        loaded, for formats that only read them on first access. Code about to
+        use them for many members should call this first so they can be read
+        in bulk.
+        """
+
+        pass
+
     def get_filenames(self):
         return [member.name for member in self.get_members()]
 
+    @property
+    def member_cache(self):
+        return self._member_cache
+
+    @property
+    def save_stats(self):
+        """Statistics about the last save()/update() of this archive."""
+        return self._save_stats
+
+    def get_archive_id(self):
+        fstat = os.fstat(self.fileno())
+        return (fstat.st_dev, fstat.st_ino, fstat.st_size, fstat.st_mtime)
+
+    def _use_member_cache(self, member, decompress):
+        # members too big for the cache would only be buffered in memory to be
+        # turned away by it, so they are always streamed instead
+        cache = self._member_cache
+        return cache is not None and decompress and member.is_compressed and \
+            member.real_size <= cache.max_bytes
+
+    def read_member(self, member, decompress=True):
+        cache = self._member_cache
+        use_cache = self._use_member_cache(member, decompress)
+        if use_cache:
+            archive_id = self.get_archive_id()
+            data = cache.get_member(archive_id, member._offset)
+            if data is not None:
+                logger.debug('Member cache hit for: %r', member)
+                return data
+
+        output = StringIO()
+        self._extract_file(member, output, decompress)
+        data = output.getvalue()
+
+        if use_cache:
+            cache.put_member(archive_id, member._offset, data)
+        return data
+
     def extract_file(self, member, fileobj, decompress=True):
-        with self.open_member(member) as infile:
-            if decompress and member.is_compressed:
-                logger.debug('Extracting and decompressing member: %r', member)
-                self.COMPRESSION_ALGORITHM.decompress_stream(infile, fileobj)
-            else:
-                chunked_copy(infile.read, fileobj.write)
-            logger.info('Extracted %r to %r', infile, fileobj)
+        if self._use_member_cache(member, decompress):
+            fileobj.write(self.read_member(member))
+            logger.info('Extracted %r to %r', member, fileobj)
+        else:
+            self._extract_file(member, fileobj, decompress)
+
+    def open_decompressed(self, member):
+        """Open a member for reading its decompressed data. Compressed members
+        are decompressed as they are read, so memory use stays bounded however
+        big the member is, and the amount of data is checked against the
+        member's real_size.
+        """
+
+        handle = self.open_member(member)
+        if member.is_compressed:
+            return self.COMPRESSION_ALGORITHM.decompressor(handle, member.real_size)
+        else:
+            return handle
+
+    def _extract_file(self, member, fileobj, decompress=True):
+        if decompress and member.is_compressed:
+            logger.debug('Extracting and decompressing member: %r', member)
+            open_func = self.open_decompressed
+        else:
+            open_func = self.open_member
+        with open_func(member) as infile:
+            chunked_copy(infile.read, fileobj.write)
+        logger.info('Extracted %r to %r', member, fileobj)
 
     def extract(self, member, path='', decompress=True):
+        self._extract_to_path(member, path,
+            lambda outfile: self.extract_file(member, outfile, decompress))
+
+    def _extract_to_path(self, member, path, write_func):
         full_filename = os.path.join(path, member.name)
         dir_name = os.path.dirname(full_filename)
         mtime = datetime_to_timestamp(member.mtime)
@@ -156,48 +327,232 @@ class BigFile(StructuredFile):
             os.makedirs(dir_name)
 
         with open(full_filename, 'wb') as outfile:
-            self.extract_file(member, outfile, decompress)
+            write_func(outfile)
         os.utime(full_filename, (mtime, mtime))
 
-    def extract_all(self, members=None, path='', decompress=True):
+    def extract_all(self, members=None, path='', decompress=True, workers=None):
+        """Extract members (all of them by default) under path. Formats that
+        can decompress in parallel use `workers` for it, others ignore it.
+        """
+
         if members is None:
             members = self.get_members()
+        self.load_metadata(members)
         for member in members:
             self.extract(member, path, decompress)
 
+    def export_tar(self, fileobj, members=None):
+        """Write members (decompressed) to a tar stream. fileobj only needs
+        to support write() so this can go straight to a pipe or socket, members
+        are decompressed as they are written so memory use stays bounded.
+        """
+
+        if members is None:
+            members = self.get_members()
+        self.load_metadata(members)
+        tar = tarfile.open(fileobj=fileobj, mode='w|')
+        try:
+            for member in members:
+                tar_info = tarfile.TarInfo('/'.join(member.name.split(os.sep)))
+                tar_info.size = member.real_size
+                tar_info.mtime = datetime_to_timestamp(member.mtime)
+                with self.open_decompressed(member) as member_handle:
+                    tar.addfile(tar_info, member_handle)
+                logger.info('Exported %r to tar stream', member)
+        finally:
+            tar.close()
+
     def add_file(self, fileobj):
         self.add(self.get_biginfo(fileobj))
 
-    def add(self, biginfo, sort_after=True):
+    def add(self, biginfo, sort_after=True, replace=False):
         logger.info('Adding member to archive: %r', biginfo)
+        if replace:
+            self._members = [m for m in self._members if m.name != biginfo.name]
         self._members.append(biginfo)
         if sort_after:
             self._sort_members()
 
-    def add_all(self, path='', exclude=None):
-        if exclude is None:
-            exclude = lambda fn: False
-
-        logger.debug('Walking path: %s', path)
-        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
-            logger.debug('Found %d files in dir: %s', len(filenames), dirpath)
-            for filename in (os.path.join(dirpath, fn) for fn in filenames):
-                if not exclude(filename):
-                    partial_filename = filename.replace(path, '', 1)
-                    logger.info('Adding file as: %s => %s', filename, partial_filename)
-                    self.add(self.get_biginfo(filename, alt_filename=partial_filename), False)
-                else:
-                    logger.debug('Excluding file: %s', filename)
+    def remove(self, member):
+        if not isinstance(member, BigInfo):
+            member = self.get_member(member)
+        logger.info('Removing member from archive: %r', member)
+        self._members.remove(member)
+
+    def add_all(self, path='', exclude=None, replace=False, include=None,
+            manifest=None, workers=None):
+        """Add all the files under path, named by their path relative to it.
+
+        include and exclude are glob patterns (or lists of them) matched against
+        the member names, exclude may also be a callable given each file's full
+        path. The files are found by scanning the tree with `workers` threads,
+        or read from a manifest file (see naabal.util.scan.read_manifest).
+        """
+
+        exclude_func = None
+        if callable(exclude):
+            exclude_func, exclude = exclude, None
+
+        if manifest is not None:
+            logger.debug('Reading manifest: %s', manifest)
+            with open(manifest, 'rb') as handle:
+                source_files = read_manifest(handle, path, include, exclude)
+        else:
+            logger.debug('Scanning path: %s', path)
+            source_files = scan_tree(path or os.curdir, include, exclude, workers)
+
+        if exclude_func is not None:
+            source_files = [f for f in source_files if not exclude_func(f.path)]
+        if replace:
+            added_names = set(f.name for f in source_files)
+            self._members = [m for m in self._members if m.name not in added_names]
+        for source_file in source_files:
+            logger.info('Adding file as: %s => %s', source_file.path, source_file.name)
+            self.add(self.get_biginfo(source_file.path, source_file.name, source_file.stat), False)
         self._sort_members()
 
-    def get_biginfo(self, filename, alt_filename=None):
+    def add_from(self, bigfile, members=None):
+        if members is None:
+            members = bigfile.get_members()
+        bigfile.load_metadata(members)
+        logger.debug('Adding %d members from archive: %r', len(members), bigfile)
+        for member in members:
+            self.add(ForeignBigInfo(self, member), False)
+        self._sort_members()
+
+    def reuse_from(self, bigfile, check_content=False):
+        """Swap members added from local files that are unchanged since bigfile
+        was built for its copies of them, so their stored data is copied as-is
+        when saving instead of being compressed again. bigfile must be kept open
+        until this archive has been saved.
+
+        A file is unchanged if its size and mtime match the previous member. With
+        check_content, files with a different mtime are also reused if their
+        CRC32 matches the one the previous archive recorded (HW2 archives only,
+        HW1 doesn't store one). Returns the number of members reused.
+        """
+
+        bigfile.load_metadata()
+        previous_members = dict((m.name, m) for m in bigfile.get_members())
+        reused = 0
+        for idx, member in enumerate(self._members):
+            previous = previous_members.get(member.name)
+            if not isinstance(member, ExternalBigInfo) or previous is None or \
+                    previous.real_size != member.real_size:
+                continue
+            reuse = ForeignBigInfo(self, previous)
+            if not self._can_copy_stored(reuse):
+                continue
+            if datetime_to_timestamp(previous.mtime) != datetime_to_timestamp(member.mtime):
+                if not check_content or previous.crc32 is None or \
+                        previous.crc32 != member.compute_crc32():
+                    continue
+            logger.debug('Reusing stored data from previous archive for: %r', member)
+            reuse._mtime = member.mtime
+            self._members[idx] = reuse
+            reused += 1
+        logger.info('Reusing %d of %d members from: %r', reused, len(self), bigfile)
+        return reused
+
+    def get_biginfo(self, filename, alt_filename=None, fstat=None):
         big_info = ExternalBigInfo(self)
-        big_info.load(filename, alt_filename)
+        big_info.load(filename, alt_filename, fstat)
         return big_info
 
     def _get_members(self):
         raise NotImplemented()
 
+    def _get_index_member(self, entry):
+        """Create a member from an index entry. Formats give their own member
+        type here so members loaded from an index can be written back like ones
+        loaded from the archive.
+        """
+
+        member = BigInfo(self)
+        member.load_index_entry(entry)
+        return member
+
+    def _can_copy_stored(self, member):
+        """Check if a member's stored (possibly compressed) data can be written
+        to this archive as-is, instead of being decompressed and recompressed.
+        """
+
+        algorithm = member.compression_algorithm
+        return algorithm is not None and \
+            algorithm.__class__ is self.COMPRESSION_ALGORITHM.__class__
+
+    def _select_profile(self, member):
+        """Get the compression profile for a member being written, or None if
+        the archive has no profiles. The choice is remembered for the save
+        statistics.
+        """
+
+        profiles = self.COMPRESSION_PROFILES
+        if profiles is None:
+            return None
+        profile = profiles.select(member.name, member.real_size)
+        if self._member_profiles is None:
+            self._member_profiles = {}
+        self._member_profiles[member.name] = profile.name
+        return profile
+
+    def _finish_save_stats(self):
+        stats = {
+            'members':      len(self),
+            'real_size':    sum(m.real_size for m in self.get_members()),
+            'stored_size':  sum(m.stored_size for m in self.get_members()),
+        }
+        if self._member_profiles is not None:
+            profile_stats = {}
+            for member in self.get_members():
+                profile_name = self._member_profiles.get(member.name)
+                if profile_name is None:
+                    continue
+                counts = profile_stats.setdefault(profile_name,
+                    {'members': 0, 'real_size': 0, 'stored_size': 0})
+                counts['members'] += 1
+                counts['real_size'] += member.real_size
+                counts['stored_size'] += member.stored_size
+            stats['profiles'] = profile_stats
+            self._member_profiles = None
+        if self._deduplicator is not None:
+            stats.update(self._deduplicator.stats())
+            self._deduplicator = None
+        if self._save_counters is not None:
+            stats.update(self._save_counters)
+            self._save_counters = None
+        self._save_stats = stats
+        logger.info('Finished writing %r: %r', self, stats)
+
+    def _is_readable(self):
+        """Check if data written to the archive can be read back from it."""
+
+        return self.mode is not None and ('r' in self.mode or '+' in self.mode)
+
+    def _open_spill(self, max_spill_size, spool_size, spill_dir=None, max_allowed=None):
+        """Open a spool for up to max_spill_size bytes of member data, spilling
+        to a temporary file in spill_dir (the default temporary directory if
+        None) past spool_size. Raises BigFormatException if max_spill_size is
+        more than max_allowed, and warns if spill_dir looks too small for it.
+        """
+
+        if max_allowed is not None and max_spill_size > max_allowed:
+            raise BigFormatException('Writing needs to spool up to %d bytes of member data, '
+                'more than the %d bytes allowed' % (max_spill_size, max_allowed))
+        spill_dir = spill_dir or tempfile.gettempdir()
+        if max_spill_size > spool_size and hasattr(os, 'statvfs'):
+            spill_stat = os.statvfs(spill_dir)
+            if spill_stat.f_bavail * spill_stat.f_frsize < max_spill_size:
+                logger.warning('Spooling up to %d bytes to %s may run out of space',
+                    max_spill_size, spill_dir)
+        return tempfile.SpooledTemporaryFile(spool_size, dir=spill_dir)
+
+    def _copy_stored(self, member, handle=None):
+        if handle is None:
+            handle = self
+        with member.open_stored() as member_handle:
+            return chunked_copy(member_handle.read, handle.write, LARGE_CHUNK_SIZE)
+
     def _sort_members(self):
         self._members.sort(key=lambda m: m.name)
 
@@ -208,18 +563,37 @@ class GearboxEncryptedBigFile(BigFile):
     MASTER_KEY                  = None
     ENCRYPTION_KEY_MARKER       = 0x00000000
     ENCRYPTION_KEY_MAX_SIZE     = 1024 # 0x0400
+    # decrypted data is cached in aligned blocks of this size, up to
+    # DECRYPTED_CACHE_SIZE bytes of them (0 disables the cache)
+    DECRYPTED_BLOCK_SIZE        = 64 * 1024 # 64KB
+    DECRYPTED_CACHE_SIZE        = 16 * 1024 * 1024 # 16MB
+    # keep the blocks read while loading the archive (header, ToC and the other
+    # tables) cached for as long as it is open
+    PIN_LOADED_BLOCKS           = True
 
     _crypto                     = None
+    _real_handle                = None
+    _block_cache                = None
+    _pin_blocks                 = False
 
     @property
     def data_size(self):
         return self._crypto._data_size
 
     def load(self):
-        self._crypto = self._load_encryption()
-        self._real_handle = self._handle
-        self._handle = FileInFile(self._real_handle, 0, self.data_size)
-        super(GearboxEncryptedBigFile, self).load()
+        self._setup_encryption()
+        self._pin_blocks = self.PIN_LOADED_BLOCKS
+        try:
+            super(GearboxEncryptedBigFile, self).load()
+        finally:
+            self._pin_blocks = False
+
+    def save(self, *args, **kwargs):
+        raise GearboxEncryptionException('Writing encrypted archives is not supported')
+
+    def load_index(self, big_index):
+        self._setup_encryption()
+        super(GearboxEncryptedBigFile, self).load_index(big_index)
 
     def check_format(self):
         try:
@@ -236,7 +610,7 @@ class GearboxEncryptedBigFile(BigFile):
             cur_pos = self._handle.tell()
             if cur_pos < self.data_size:
                 # we're gonna read encrypted data
-                if size is None:
+                if size is None or size < 0:
                     # make sure we don't read past the encrypted data
                     size = self.data_size - cur_pos
                 else:
@@ -246,9 +620,56 @@ class GearboxEncryptedBigFile(BigFile):
             else:
                 return self._handle.read(size)
 
+    def export_decrypted(self, fileobj, buffer=None):
+        """Write the decrypted data of the archive to fileobj, a chunk at a time
+        through a single reused buffer. Returns the number of bytes written.
+        """
+
+        if self._real_handle is None:
+            self._setup_encryption()
+        self._handle.seek(0)
+        return self._crypto.decrypt_stream(self._handle, fileobj, buffer=buffer)
+
+    @property
+    def block_cache(self):
+        return self._block_cache
+
+    def _setup_encryption(self):
+        self._crypto = self._load_encryption()
+        self._real_handle = self._handle
+        self._handle = FileInFile(self._real_handle, 0, self.data_size)
+        if self.DECRYPTED_CACHE_SIZE:
+            self._block_cache = BlockCache(self.DECRYPTED_BLOCK_SIZE, self.DECRYPTED_CACHE_SIZE)
+
     def _read_encrypted(self, size):
         offset = self.tell()
-        return self._crypto.decrypt(self._handle.read(size), offset)
+        cache = self._block_cache
+        if cache is None:
+            return self._crypto.decrypt(self._handle.read(size), offset)
+
+        block_size = cache.block_size
+        end_offset = offset + size
+        pieces = []
+        while offset < end_offset:
+            block_idx = offset // block_size
+            block_start = block_idx * block_size
+            block = self._get_decrypted_block(cache, block_idx)
+            piece = block[offset - block_start:end_offset - block_start]
+            if not piece:
+                break
+            pieces.append(piece)
+            offset += len(piece)
+        self._handle.seek(offset)
+        return ''.join(pieces)
+
+    def _get_decrypted_block(self, cache, block_idx):
+        block = cache.get_block(block_idx)
+        if block is None:
+            block_start = block_idx * cache.block_size
+            self._handle.seek(block_start)
+            block = self._crypto.decrypt(self._handle.read(cache.block_size), block_start)
+            cache.put_block(block_idx, block, self._pin_blocks)
+        return block
 
     def _load_encryption(self):
         self.seek(-4, os.SEEK_END)
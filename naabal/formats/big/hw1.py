@@ -23,13 +23,20 @@
 # SOFTWARE.
 
 import datetime
+import os
 import os.path
+import stat
 import logging
+from collections import deque, Counter
+from tempfile import mkstemp
 
-from naabal.errors import BigFormatException
+from naabal.errors import BigFormatException, CompressionBudgetExceeded
 from naabal.util import timestamp_to_datetime, datetime_to_timestamp, crc32
 from naabal.util.lzss import LZSS
-from naabal.util.file_io import chunked_copy
+from naabal.util.dedup import ContentDeduplicator
+from naabal.util.file_io import FileInFile, copy_range, chunked_copy, replace_file, \
+    LARGE_CHUNK_SIZE
+from naabal.util.workers import get_pool, SerialPool, ImmediateResult
 from naabal.formats import StructuredFileSequence
 from naabal.formats.big import BigFile, BigSection, BigSequence, BigInfo
 
@@ -176,13 +183,22 @@ class HomeworldBigToc(BigSequence):
         return handle._data['header']['toc_entry_count']
 
 class HomeworldBigInfo(BigInfo):
+    _entry_offset       = 0
+
     def load(self, data):
+        self._entry_offset  = data['entry_offset']
         self._offset        = data['entry_offset'] + data['name_length'] + 1
         self._name          = self._bigfile._read_filename(data)
         self._mtime         = data['timestamp']
         self._real_size     = data['data_real_size']
         self._stored_size   = data['data_stored_size']
 
+    def load_index_entry(self, entry):
+        super(HomeworldBigInfo, self).load_index_entry(entry)
+        # the encoded filename in front of the data is the same length as the
+        # normalized name
+        self._entry_offset  = self._offset - len(self._name) - 1
+
 class HomeworldBigFile(BigFile):
     STRUCTURE       = [
         ('header',              HomeworldBigHeader),
@@ -191,6 +207,21 @@ class HomeworldBigFile(BigFile):
 
     MIN_COMPRESSION_RATIO       = 0.950
     COMPRESSION_ALGORITHM       = LZSS()
+    MAX_IN_FLIGHT_BYTES         = 64 * 1024 * 1024 # 64MB
+    # members bigger than this are never read into memory, they are compressed
+    # straight from their handle into the archive as they are written
+    STREAM_COMPRESSION_SIZE     = 16 * 1024 * 1024 # 16MB
+    # how much prepared member data save_stream() keeps in memory before
+    # spilling it to a temporary file in STREAM_SPILL_DIR (the default
+    # temporary directory if None). The spill file can grow to the size of all
+    # the member data, MAX_STREAM_SPILL_SIZE refuses to stream archives that
+    # could need more than that (None for no limit)
+    STREAM_SPOOL_SIZE           = 16 * 1024 * 1024 # 16MB
+    STREAM_SPILL_DIR            = None
+    MAX_STREAM_SPILL_SIZE       = 2 * 1024 * 1024 * 1024 # 2GB
+    # CompressibilityPredictor used to skip compressing members that won't
+    # compress well enough, None compresses everything
+    COMPRESSIBILITY_PREDICTOR   = None
 
     def _read_filename(self, toc_entry):
         self.seek(toc_entry['entry_offset'])
@@ -252,7 +283,16 @@ class HomeworldBigFile(BigFile):
             members.append(member)
         return members
 
-    def save(self):
+    def _get_index_member(self, entry):
+        member = HomeworldBigInfo(self)
+        member.load_index_entry(entry)
+        return member
+
+    def save(self, workers=None):
+        """Write the archive, member data is compressed by a pool of `workers`
+        processes (one per CPU by default) and written in order.
+        """
+
         logger.info('Writing bigfile: %r', self)
 
         members = self.get_members()
@@ -262,7 +302,7 @@ class HomeworldBigFile(BigFile):
         self['table_of_contents']._data_list = [self['table_of_contents'].CHILD_TYPE() \
             for i in range(member_count)]
 
-        offset = self['header'].data_size + (len(members) * self['table_of_contents'].CHILD_TYPE.data_size)
+        offset = self._get_data_start_offset(member_count)
         logger.debug('Preparing to start writing member data at offset: %d', offset)
 
         max_data_size = sum(len(m.name) + 1 + m.real_size for m in members)
@@ -272,51 +312,433 @@ class HomeworldBigFile(BigFile):
 
         self.truncate(max_file_size)
 
-        for i, member in enumerate(members):
-            crc_head, crc_tail = self._get_filename_crcs(self._denormalize_filename(member.name))
-            toc_entry = self['table_of_contents'][i]
-            toc_entry['name_crc_start'] = crc_head
-            toc_entry['name_crc_end'] = crc_tail
-            toc_entry['name_length'] = len(member.name)
-            toc_entry['data_real_size'] = member.real_size
-            toc_entry['data_stored_size'] = member.stored_size
-            toc_entry['timestamp'] = member.mtime
-            toc_entry['entry_offset'] = offset
+        self._deduplicator = ContentDeduplicator(members)
+        offset = self._write_members(zip(members, self['table_of_contents']), offset, workers)
 
-            self.seek(offset)
-            logger.debug('Writing encoded filename ("%s") at offset: %d',
-                member.name, offset)
-            self.write(self._encode_filename(self._denormalize_filename(member.name)) + '\x00')
+        # cut the file off at the end of the data we wrote
+        self.truncate(offset)
+        logger.debug('Truncating file to last written offset: %d', offset)
 
-            data_offset = self.tell()
+        self._write_toc()
+        self._finish_save_stats()
 
-            with self.open_member(member) as member_handle:
-                self.COMPRESSION_ALGORITHM.compress_stream(member_handle, self)
-                stored_size = self.tell() - data_offset
-                logger.debug('Wrote %d bytes (compressed) of file data at offset: %d',
-                    stored_size, data_offset)
-                compression_ratio = float(stored_size) / float(member.real_size)
-                if compression_ratio < self.MIN_COMPRESSION_RATIO:
-                    toc_entry['data_stored_size'] = stored_size
-                    member._stored_size = stored_size
-                else:
-                    logger.debug('Data did not compress enough: %03.2f %%', compression_ratio * 100.0)
-                    self.seek(data_offset)
-                    member_handle.seek(0)
-                    stored_size = chunked_copy(member_handle.read, self.write)
-                    logger.debug('Wrote %d bytes (uncompressed) of file data at offset: %d',
-                        stored_size, data_offset)
+    def save_stream(self, workers=None):
+        """Write the archive in a single forward-only pass, for bigfiles opened
+        on a file object that can't seek (a pipe or socket).
 
-            toc_entry['compression_flag'] = member.is_compressed
-            offset += len(member.name) + 1 + member.stored_size
+        The ToC holding the stored sizes comes before the member data, so all
+        of the member data is prepared first into a spool. It spills to a
+        temporary file in STREAM_SPILL_DIR past STREAM_SPOOL_SIZE, and once all
+        the stored sizes are known the header, ToC and spooled data are written
+        out in order. The result is identical to save().
 
-            logger.info('Wrote member %4d/%4d [%8d b]: %s',
-                i+1, member_count, member.stored_size, member.name)
+        The spill file needs up to the size of all the member data (less once
+        it is compressed), if that could be more than MAX_STREAM_SPILL_SIZE a
+        BigFormatException is raised before anything is written.
+        """
+
+        logger.info('Streaming bigfile: %r', self)
+
+        members = self.get_members()
+        member_count = len(members)
+        max_spill_size = sum(len(m.name) + 1 + max(m.real_size, m.stored_size) for m in members)
+        spool = self._open_spill(max_spill_size, self.STREAM_SPOOL_SIZE,
+            self.STREAM_SPILL_DIR, self.MAX_STREAM_SPILL_SIZE)
+        self['header']['toc_entry_count'] = member_count
+        self['table_of_contents']._data_list = [self['table_of_contents'].CHILD_TYPE() \
+            for i in range(member_count)]
+
+        offset = self._get_data_start_offset(member_count)
+        self._deduplicator = ContentDeduplicator(members)
+        with spool:
+            end_offset = self._write_members(zip(members, self['table_of_contents']),
+                offset, workers, spool)
+            logger.debug('Spooled %d bytes of member data', end_offset - offset)
+
+            self._write_toc(rewind=False)
+            spool.seek(0)
+            chunked_copy(spool.read, self.write, LARGE_CHUNK_SIZE)
+        self.flush()
+        self._finish_save_stats()
+
+    def update(self, workers=None):
+        """Write changes to the member list (added, replaced or removed members)
+        to an existing archive opened for update ("r+b") without rewriting it.
+
+        Data of members already in the archive is left in place, new member data
+        is appended and then the header and ToC are rewritten. Space used by
+        removed or replaced members is not reclaimed, see get_free_space() and
+        compact().
+        """
+
+        logger.info('Updating bigfile: %r', self)
+
+        members = self.get_members()
+        member_count = len(members)
+        self['header']['toc_entry_count'] = member_count
+        self['table_of_contents']._data_list = [self['table_of_contents'].CHILD_TYPE() \
+            for i in range(member_count)]
+
+        in_place = [m for m in members if self._is_stored_in_place(m)]
+        self._deduplicator = ContentDeduplicator(
+            [m for m in members if not self._is_stored_in_place(m)])
+        data_start = self._get_data_start_offset(member_count)
+        offset = max([data_start] + [self._get_entry_end(m) for m in in_place])
+        logger.debug('Appending new member data at offset: %d', offset)
+
+        # members whose data would be overwritten by a larger ToC are moved to
+        # the end of the archive, their stored data is copied as-is
+        for member in in_place:
+            if member._entry_offset < data_start:
+                entry_size = self._get_entry_end(member) - member._entry_offset
+                logger.debug('Relocating member from offset %d to %d: %r',
+                    member._entry_offset, offset, member)
+                copy_range(self, member._entry_offset, offset, entry_size)
+                member._offset += offset - member._entry_offset
+                member._entry_offset = offset
+                offset += entry_size
+
+        new_entries = []
+        for member, toc_entry in zip(members, self['table_of_contents']):
+            if self._is_stored_in_place(member):
+                self._fill_toc_entry(toc_entry, member, member._entry_offset)
+                toc_entry['compression_flag'] = member.is_compressed
+            else:
+                new_entries.append((member, toc_entry))
+        offset = self._write_members(new_entries, offset, workers)
 
-        # cut the file off at the end of the data we wrote
         self.truncate(offset)
-        logger.debug('Truncating file to last written offset: %d', offset)
+        self._write_toc()
+        self.flush()
+        self._finish_save_stats()
+
+        # reload the members so the ones just written are also in-place members
+        self._members = self._get_members()
+        self._sort_members()
+
+    def compact(self):
+        """Remove unused space from an archive opened for update ("r+b").
+
+        Member data keeps its order in the file but is moved down to be
+        contiguous, stored data is copied as-is and never recompressed.
+
+        The compacted archive is written to a temporary file next to the
+        archive (so as much free disk space as the compacted archive needs) and
+        renamed over it once it is complete, so a crash leaves either the old
+        or the new archive. Archives opened on a file object rather than a
+        filename are compacted in place instead, which is NOT crash-safe: data
+        is moved before the ToC is rewritten, so an interrupted compact()
+        leaves the archive corrupt.
+        """
+
+        if not all(self._is_stored_in_place(m) for m in self.get_members()):
+            raise BigFormatException('Archive has unsaved members, update() it before compacting')
+
+        self.flush()
+        original_size = os.fstat(self.fileno()).st_size
+        if self._owns_handle and self.name is not None:
+            self._compact_to_copy(self.name)
+        else:
+            logger.warning('Compacting in place, the archive will be corrupt if this is interrupted')
+            self._compact_in_place()
+        reclaimed = original_size - os.fstat(self.fileno()).st_size
+        logger.info('Compacted bigfile by %d bytes: %r', reclaimed, self)
+        return reclaimed
+
+    def _compact_to_copy(self, filename):
+        fd, tmp_filename = mkstemp(prefix='.compact-',
+            dir=os.path.dirname(os.path.abspath(filename)))
+        os.chmod(tmp_filename, stat.S_IMODE(os.stat(filename).st_mode))
+        original_handle = self._handle
+        try:
+            with os.fdopen(fd, 'w+b') as tmp_handle:
+                offset = self._get_data_start_offset(len(self))
+                tmp_handle.truncate(offset)
+                tmp_handle.seek(offset)
+                for member in sorted(self.get_members(), key=lambda m: m._entry_offset):
+                    entry_size = self._get_entry_end(member) - member._entry_offset
+                    entry = FileInFile(self, member._entry_offset, entry_size)
+                    chunked_copy(entry.read, tmp_handle.write, LARGE_CHUNK_SIZE)
+                    member._offset += offset - member._entry_offset
+                    member._entry_offset = offset
+                    offset += entry_size
+
+                # all members are now in place in the copy, so this just writes
+                # the header + toc
+                self._handle = tmp_handle
+                self.update()
+                tmp_handle.flush()
+                os.fsync(tmp_handle.fileno())
+            # Windows can't replace a file that is still open
+            original_handle.close()
+            replace_file(tmp_filename, filename)
+        except Exception:
+            if original_handle.closed:
+                # replace_file() leaves the original in place when it fails
+                original_handle = open(filename, 'r+b')
+            self._handle = original_handle
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            # member offsets may already point into the copy
+            self.load()
+            raise
+        self._handle = open(filename, 'r+b')
+
+    def _compact_in_place(self):
+        offset = self._get_data_start_offset(len(self))
+        for member in sorted(self.get_members(), key=lambda m: m._entry_offset):
+            entry_size = self._get_entry_end(member) - member._entry_offset
+            if member._entry_offset != offset:
+                logger.debug('Moving member from offset %d to %d: %r',
+                    member._entry_offset, offset, member)
+                copy_range(self, member._entry_offset, offset, entry_size)
+                member._offset += offset - member._entry_offset
+                member._entry_offset = offset
+            offset += entry_size
+
+        # all members are now in place, so this just rewrites the header + toc
+        self.update()
+
+    def get_free_space(self):
+        """Report how much of the archive file is not used by the header, ToC
+        or member data (i.e. the space a compact() would reclaim).
+        """
 
+        self.flush()
+        file_size = os.fstat(self.fileno()).st_size
+        used_size = self._get_data_start_offset(len(self)) + \
+            sum(len(m.name) + 1 + m.stored_size for m in self.get_members())
+        free_size = max(0, file_size - used_size)
+        return {
+            'file_size':    file_size,
+            'used_size':    used_size,
+            'free_size':    free_size,
+            'free_ratio':   float(free_size) / file_size if file_size else 0.0,
+        }
+
+    def _get_data_start_offset(self, member_count):
+        return self['header'].data_size + \
+            (member_count * self['table_of_contents'].CHILD_TYPE.data_size)
+
+    def _get_entry_end(self, member):
+        return member._entry_offset + len(member.name) + 1 + member.stored_size
+
+    def _is_stored_in_place(self, member):
+        return isinstance(member, HomeworldBigInfo) and member._bigfile is self
+
+    def _fill_toc_entry(self, toc_entry, member, offset):
+        crc_head, crc_tail = self._get_filename_crcs(self._denormalize_filename(member.name))
+        toc_entry['name_crc_start'] = crc_head
+        toc_entry['name_crc_end'] = crc_tail
+        toc_entry['name_length'] = len(member.name)
+        toc_entry['data_real_size'] = member.real_size
+        toc_entry['data_stored_size'] = member.stored_size
+        toc_entry['timestamp'] = member.mtime
+        toc_entry['entry_offset'] = offset
+
+    def _write_members(self, entries, offset, workers=None, handle=None):
+        """Write the names and data of (member, toc_entry) pairs sequentially
+        starting at offset, returns the offset after the last member. If handle
+        is given the entries are written to it in order instead of at their
+        offsets in the archive.
+
+        Members are compressed in a pool while earlier ones are being written,
+        at most MAX_IN_FLIGHT_BYTES of member data is held waiting to be written.
+        Once a member's stored data is ready it counts against that instead of
+        the member data it was prepared from. Members bigger than
+        STREAM_COMPRESSION_SIZE are not held at all, they are compressed as they
+        are written.
+        """
+
+        if self._save_counters is None:
+            self._save_counters = Counter()
+        pool = get_pool(workers)
+        if isinstance(pool, SerialPool):
+            max_in_flight = 0
+        else:
+            max_in_flight = self.MAX_IN_FLIGHT_BYTES
+        member_count = len(entries)
+        pending = deque()
+        state = {'offset': offset, 'in_flight': 0, 'written': 0}
+
+        def write_next():
+            member, toc_entry, prepared, data_size, blob, settled = pending.popleft()
+            state['offset'] = self._write_member(member, toc_entry, state['offset'],
+                prepared, handle, blob)
+            state['in_flight'] -= data_size
+            state['written'] += 1
+            logger.info('Wrote member %4d/%4d [%8d b]: %s',
+                state['written'], member_count, member.stored_size, member.name)
+
+        def settle_in_flight():
+            # count the stored data of finished members rather than the member
+            # data they were prepared from
+            for entry in pending:
+                prepared, data_size, blob, settled = entry[2:]
+                if data_size and not settled and prepared.ready():
+                    stored_size = len(prepared.get()[0])
+                    state['in_flight'] += stored_size - data_size
+                    entry[3] = stored_size
+                    entry[5] = True
+
+        try:
+            for member, toc_entry in entries:
+                if self._can_copy_stored(member) or \
+                        member.real_size > self.STREAM_COMPRESSION_SIZE:
+                    prepared, data_size, blob = None, 0, None
+                else:
+                    prepared, data_size, blob = self._submit_member(member, pool)
+                pending.append([member, toc_entry, prepared, data_size, blob, False])
+                state['in_flight'] += data_size
+                if state['in_flight'] > max_in_flight:
+                    settle_in_flight()
+                while pending and state['in_flight'] > max_in_flight:
+                    write_next()
+            while pending:
+                write_next()
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        return state['offset']
+
+    def _submit_member(self, member, pool):
+        """Start preparing the stored data for a member. Returns a result whose
+        get() gives the data to store and whether it is compressed, the size of
+        the member data being worked on and the dedup blob for the member's data.
+        """
+
+        with self.open_member(member) as member_handle:
+            data = member_handle.read()
+
+        profile = self._select_profile(member)
+        dedup = self._deduplicator
+        if dedup is not None and dedup.is_candidate(member):
+            key, blob = dedup.lookup(data)
+            if blob is not None:
+                logger.debug('Reusing stored data of duplicate content for: %r', member)
+                dedup.record_duplicate(member.real_size)
+                return blob['result'], 0, blob
+        else:
+            key = None
+
+        algorithm = self.COMPRESSION_ALGORITHM
+        predictor = self.COMPRESSIBILITY_PREDICTOR
+        if profile is not None and profile.store:
+            logger.debug('Profile %s stores data as-is: %r', profile.name, member)
+            result = ImmediateResult((data, False))
+        elif predictor is not None and \
+                not predictor.should_compress(member.name, data, algorithm):
+            logger.debug('Predicted data is not compressible, storing as-is: %r', member)
+            self._save_counters['compression_skipped'] += 1
+            self._save_counters['compression_skipped_bytes'] += len(data)
+            result = ImmediateResult((data, False))
+        else:
+            if profile is not None:
+                algorithm = profile.get_algorithm(algorithm)
+            result = pool.apply_async(compress_member_data,
+                (algorithm, data, self.MIN_COMPRESSION_RATIO))
+        blob = None
+        if key is not None:
+            blob = dedup.add(key, result)
+        return result, len(data), blob
+
+    def _write_member(self, member, toc_entry, offset, prepared=None, handle=None, blob=None):
+        self._fill_toc_entry(toc_entry, member, offset)
+
+        # the spool handle given by save_stream() can always be read back
+        readable = handle is not None or self._is_readable()
+        if handle is None:
+            handle = self
+            handle.seek(offset)
+        logger.debug('Writing encoded filename ("%s") at offset: %d',
+            member.name, offset)
+        handle.write(self._encode_filename(self._denormalize_filename(member.name)) + '\x00')
+
+        data_offset = offset + len(member.name) + 1
+
+        if self._can_copy_stored(member):
+            stored_size = self._copy_stored(member, handle)
+            logger.debug('Copied %d bytes of stored file data at offset: %d',
+                stored_size, data_offset)
+        else:
+            position = handle.tell()
+            if blob is not None and blob['position'] is not None:
+                # identical data has already been written, copy it from there
+                stored_size = blob['stored_size']
+                copy_range(handle, blob['position'], position, stored_size)
+                handle.seek(position + stored_size)
+                logger.debug('Copied %d bytes of duplicate file data at offset: %d',
+                    stored_size, data_offset)
+            else:
+                if prepared is None:
+                    stored_size, is_compressed = self._stream_member(member, handle)
+                else:
+                    stored_data, is_compressed = prepared.get()
+                    handle.write(stored_data)
+                    stored_size = len(stored_data)
+                logger.debug('Wrote %d bytes (%s) of file data at offset: %d',
+                    stored_size, 'compressed' if is_compressed else 'uncompressed', data_offset)
+                if blob is not None:
+                    self._deduplicator.set_written(blob,
+                        position if readable else None, stored_size)
+            toc_entry['data_stored_size'] = stored_size
+            member._stored_size = stored_size
+
+        toc_entry['compression_flag'] = member.is_compressed
+        return offset + len(member.name) + 1 + member.stored_size
+
+    def _stream_member(self, member, handle):
+        """Compress the data of a member too big to hold in memory straight
+        from its handle to the current position of handle, returns the stored
+        size and whether it is compressed. If the data won't compress below
+        MIN_COMPRESSION_RATIO it is copied as-is over the compressed output.
+        """
+
+        profile = self._select_profile(member)
+        algorithm = self.COMPRESSION_ALGORITHM
+        predictor = self.COMPRESSIBILITY_PREDICTOR
+        compress = True
+        if profile is not None and profile.store:
+            logger.debug('Profile %s stores data as-is: %r', profile.name, member)
+            compress = False
+        elif predictor is not None:
+            with self.open_member(member) as member_handle:
+                sample = member_handle.read(LARGE_CHUNK_SIZE)
+            if not predictor.should_compress(member.name, sample, algorithm):
+                logger.debug('Predicted data is not compressible, storing as-is: %r', member)
+                self._save_counters['compression_skipped'] += 1
+                self._save_counters['compression_skipped_bytes'] += member.real_size
+                compress = False
+
+        data_offset = handle.tell()
+        if compress:
+            if profile is not None:
+                algorithm = profile.get_algorithm(algorithm)
+            max_output = int(member.real_size * self.MIN_COMPRESSION_RATIO) + 1
+            try:
+                with self.open_member(member) as member_handle:
+                    stored_size = algorithm.compress_stream(member_handle, handle, max_output)
+            except CompressionBudgetExceeded as err:
+                logger.debug('Abandoned compression: %s', err)
+            else:
+                if float(stored_size) / member.real_size < self.MIN_COMPRESSION_RATIO:
+                    return stored_size, True
+                logger.debug('Data did not compress enough: %03.2f %%',
+                    float(stored_size) / member.real_size * 100.0)
+            handle.seek(data_offset)
+
+        with self.open_member(member) as member_handle:
+            stored_size = chunked_copy(member_handle.read, handle.write, LARGE_CHUNK_SIZE)
+        if compress:
+            # drop any compressed output that ran past the end of the data
+            handle.truncate()
+        return stored_size, False
+
+    def _write_toc(self, rewind=True):
         # file data is written sorted by filename, toc content is sorted by the
         # crc values
         logger.debug('Sorting ToC entries based on filename CRCs')
@@ -325,4 +747,38 @@ class HomeworldBigFile(BigFile):
             key=lambda e: crc_fix(e['name_crc_start'], e['name_crc_end']))
 
         # write the header + toc
-        super(HomeworldBigFile, self).save()
+        if rewind:
+            super(HomeworldBigFile, self).save()
+        else:
+            for key, member_type in self.STRUCTURE:
+                self._data[key].save(self)
+
+def compress_member_data(algorithm, data, min_compression_ratio):
+    """Compress member data, returning the data to store and whether it is
+    compressed. Data that does not compress below min_compression_ratio is
+    stored as-is.
+
+    The compressor is given an output budget so hopeless compressions are
+    abandoned as soon as they are known to miss the ratio.
+
+    This is a module-level function so it can be run in a worker process.
+    """
+
+    if not data:
+        return data, False
+
+    # one byte of slack so float rounding never abandons a compression that
+    # the ratio check below would have accepted
+    max_output = int(len(data) * min_compression_ratio) + 1
+    try:
+        compressed_data = algorithm.compress(data, max_output)
+    except CompressionBudgetExceeded as err:
+        logger.debug('Abandoned compression: %s', err)
+        return data, False
+
+    compression_ratio = float(len(compressed_data)) / float(len(data))
+    if compression_ratio < min_compression_ratio:
+        return compressed_data, True
+    else:
+        logger.debug('Data did not compress enough: %03.2f %%', compression_ratio * 100.0)
+        return data, False
@@ -23,20 +23,26 @@
 # SOFTWARE.
 
 import os.path
+import zlib
 import hashlib
 import logging
+from collections import deque
 
-from naabal.errors import BigFormatException
+from naabal.errors import BigFormatException, CompressionBudgetExceeded
 from naabal.formats.big import BigSection, BigFile, BigSequence, BigInfo
 from naabal.util import crc32, datetime_to_timestamp, timestamp_to_datetime, \
-    pad_null_string, trim_null_string
+    pad_null_string, trim_null_string, StringIO
 from naabal.util.zlib_wrapper import ZLIB
-from naabal.util.file_io import FileInFile, chunked_copy
+from naabal.util.file_io import FileInFile, HashingWriter, CRC32Reader, chunked_copy, \
+    copy_range, LARGE_CHUNK_SIZE
+from naabal.util.dedup import ContentDeduplicator
+from naabal.util.workers import get_pool, SerialPool, ImmediateResult, BatchItemResult
 from naabal.util.keys import RELIC_HW2_TOOL_SECURITY_KEY, RELIC_HW2_ROOT_SECURITY_KEY
 
 logger = logging.getLogger('naabal.formats.big.hw2')
 
 MAX_FILENAME_LENGTH             = 256
+MAX_TABLE_COUNT                 = 0xFFFF
 
 
 class Homeworld2BigArchiveHeader(BigSection):
@@ -373,14 +379,35 @@ class Homeworld2BigFileEntryList(BigSequence):
         return handle._data['section_header']['filename_list_count']
 
 class Homeworld2BigInfo(BigInfo):
-    def load(self, data):
-        metadata = self._bigfile._get_file_metadata(data)
+    # offset of the member's Homeworld2BigFileEntry, None once it has been loaded
+    _metadata_offset    = None
+
+    def load(self, data, file_info_idx, name=None):
         self._offset        = self._bigfile._get_file_data_offset(data)
-        self._name          = self._bigfile._get_full_filename(data)
-        self._mtime         = metadata['timestamp']
+        self._metadata_offset = self._offset - Homeworld2BigFileEntry.data_size
+        if name is None:
+            name = self._bigfile._get_full_filename(file_info_idx)
+        self._name          = name
         self._real_size     = data['data_real_size']
         self._stored_size   = data['data_stored_size']
 
+    def load_metadata(self, metadata):
+        self._mtime         = metadata['timestamp']
+        self._crc32         = metadata['crc32']
+        self._metadata_offset = None
+
+    @property
+    def mtime(self):
+        if self._metadata_offset is not None:
+            self._bigfile.load_metadata([self])
+        return self._mtime
+
+    @property
+    def crc32(self):
+        if self._metadata_offset is not None:
+            self._bigfile.load_metadata([self])
+        return self._crc32
+
 class Homeworld2BigFile(BigFile):
     STRUCTURE           = [
         ('archive_header',          Homeworld2BigArchiveHeader),
@@ -393,26 +420,638 @@ class Homeworld2BigFile(BigFile):
     ROOT_KEY                    = RELIC_HW2_ROOT_SECURITY_KEY
     TOOL_KEY                    = RELIC_HW2_TOOL_SECURITY_KEY
     COMPRESSION_ALGORITHM       = ZLIB()
+    # members smaller than this are compressed in batches
     MIN_BATCH_COMPRESSION_SIZE  = 4 * 1024 # 4KB
+    MAX_IN_FLIGHT_BYTES         = 64 * 1024 * 1024 # 64MB
+    # members bigger than this are never read into memory by save(), they are
+    # compressed straight from their handle as they are written
+    STREAM_COMPRESSION_SIZE     = 16 * 1024 * 1024 # 16MB
+    # members bigger than this are streamed out by extract_all() instead of
+    # being decompressed in a batch
+    MAX_BATCH_EXTRACT_SIZE      = 4 * 1024 * 1024 # 4MB
+    # archives opened write-only can't be read back to hash, so save() prepares
+    # their member data into a spool holding up to SPOOL_SIZE in memory and
+    # spilling the rest to a temporary file in SPILL_DIR (the default temporary
+    # directory if None). The spill file can grow to the size of all the member
+    # data, MAX_SPILL_SIZE refuses to save archives that could need more than
+    # that (None for no limit)
+    SPOOL_SIZE                  = 16 * 1024 * 1024 # 16MB
+    SPILL_DIR                   = None
+    MAX_SPILL_SIZE              = 2 * 1024 * 1024 * 1024 # 2GB
+    # per-file metadata records closer together than this are fetched with a
+    # single read, up to MAX_METADATA_READ_SIZE at a time
+    METADATA_READ_GAP           = 64 * 1024 # 64KB
+    MAX_METADATA_READ_SIZE      = 1024 * 1024 # 1MB
+
+    TABLE_OFFSET_KEYS           = {
+        'folders':      'folder_list_offset',
+        'file_info':    'file_info_list_offset',
+    }
+
+    _filename_table             = None
+
+    def load_header(self):
+        """Read just the archive header, section header and ToC. Members can
+        then be looked up with get_member(), which only reads the folders and
+        files along the member's path, without loading the whole archive.
+        """
+
+        self.seek(0)
+        self._data = {}
+        for key, member_type in self.STRUCTURE[:3]:
+            self._data[key] = member_type(self)
+        self._members = []
+        self._filename_table = None
+
+    def get_member(self, filename):
+        if self._members:
+            return super(Homeworld2BigFile, self).get_member(filename)
+        else:
+            return self._resolve_member(filename)
+
+    def _resolve_member(self, filename):
+        """Find a member by descending the folder table one path component at
+        a time, only the names of each folder's children on the way are read.
+        """
+
+        parts = filename.split(os.sep)
+        for toc_entry in self._data['table_of_contents']:
+            toc_name = toc_entry['filename']
+            if toc_name:
+                if parts[0] != toc_name:
+                    continue
+                path = parts[1:]
+            else:
+                path = parts
+            if not path:
+                continue
+
+            folder_entry = self._get_table_entry('folders', toc_entry['start_folder_idx'])
+            for depth in xrange(1, len(path)):
+                folder_name = os.path.join(*path[:depth])
+                for folder_idx in xrange(folder_entry['first_subfolder_idx'],
+                        folder_entry['last_subfolder_idx']):
+                    subfolder_entry = self._get_table_entry('folders', folder_idx)
+                    if self._read_filename(subfolder_entry) == folder_name:
+                        folder_entry = subfolder_entry
+                        break
+                else:
+                    folder_entry = None
+                    break
+            if folder_entry is None:
+                continue
+
+            for file_info_idx in xrange(folder_entry['first_fileinfo_idx'],
+                    folder_entry['last_fileinfo_idx']):
+                file_info = self._get_table_entry('file_info', file_info_idx)
+                if self._read_filename(file_info) == path[-1]:
+                    member = Homeworld2BigInfo(self)
+                    member.load(file_info, file_info_idx, filename)
+                    return member
+        raise KeyError(filename)
+
+    def _get_table_entry(self, key, idx):
+        """Get an entry of the folder or file info table, reading just that
+        entry if the tables haven't been loaded.
+        """
+
+        table = self._data.get(key)
+        if table is not None and len(table):
+            return table[idx]
+        entry_type = dict(self.STRUCTURE)[key].CHILD_TYPE
+        self.seek(Homeworld2BigArchiveHeader.data_size + \
+            self._data['section_header'][self.TABLE_OFFSET_KEYS[key]] + \
+            idx * entry_type.data_size)
+        return entry_type(self)
 
     def _get_members(self):
+        self._filename_table = self._read_filename_table()
         self._filename_map = self._build_filename_map()
         members = []
-        for file_info in self._data['file_info']:
+        for file_info_idx, file_info in enumerate(self._data['file_info']):
             member = Homeworld2BigInfo(self)
-            member.load(file_info)
+            member.load(file_info, file_info_idx)
             members.append(member)
         return members
 
+    def load_index(self, big_index):
+        super(Homeworld2BigFile, self).load_index(big_index)
+        # keep the archive name if the archive is saved again
+        self.seek(0)
+        self._data['archive_header'] = Homeworld2BigArchiveHeader(self)
+
+    def _get_index_member(self, entry):
+        member = Homeworld2BigInfo(self)
+        member.load_index_entry(entry)
+        return member
+
+    def save(self, workers=None):
+        """Write the archive. Member data is compressed by a pool of `workers`
+        threads (one per CPU by default), zlib releases the GIL while it works
+        so this scales across cores. Members smaller than
+        MIN_BATCH_COMPRESSION_SIZE are handed to the pool in batches so tiny
+        files don't cost a task each.
+
+        Member data is written in place after room is left for the tables,
+        which are written once the stored sizes are known. The key hashes cover
+        the member data too, so it is then read back once to hash it. Archives
+        opened write-only ("wb") can't be read back, their member data is
+        prepared into a spool instead (see SPOOL_SIZE and MAX_SPILL_SIZE) and
+        copied in after the tables.
+        """
+
+        logger.info('Writing bigfile: %r', self)
+
+        members = self.get_members()
+        ordered_members, filename_data = self._build_tables(members)
+        section_size = self._get_section_size(len(filename_data))
+        file_data_offset = self['archive_header'].data_size + section_size
+        self['archive_header']['section_header_size'] = section_size
+        self['archive_header']['file_data_offset'] = file_data_offset
+        logger.debug('Preparing to start writing member data at offset: %d', file_data_offset)
+
+        self._deduplicator = ContentDeduplicator(members)
+        entries = zip(ordered_members, self['file_info'])
+        # the root key hash covers the tables, the tool key hash covers
+        # everything after the archive header
+        root_hash = hashlib.md5(self.ROOT_KEY)
+        tool_hash = hashlib.md5(self.TOOL_KEY)
+        if self._is_readable():
+            end_offset = self._write_members(entries, file_data_offset, workers)
+            self.truncate(end_offset)
+            self.seek(self['archive_header'].data_size)
+            self._write_tables(HashingWriter(self.write, root_hash, tool_hash), filename_data)
+            self.flush()
+            chunked_copy(self.read, tool_hash.update, LARGE_CHUNK_SIZE)
+        else:
+            max_spill_size = sum(Homeworld2BigFileEntry.data_size + \
+                max(m.real_size, m.stored_size) for m in members)
+            with self._open_spill(max_spill_size, self.SPOOL_SIZE,
+                    self.SPILL_DIR, self.MAX_SPILL_SIZE) as spool:
+                end_offset = self._write_members(entries, file_data_offset, workers, spool)
+                logger.debug('Spooled %d bytes of member data', end_offset - file_data_offset)
+
+                self.seek(self['archive_header'].data_size)
+                self._write_tables(HashingWriter(self.write, root_hash, tool_hash), filename_data)
+                spool.seek(0)
+                chunked_copy(spool.read, HashingWriter(self.write, tool_hash).write, LARGE_CHUNK_SIZE)
+            self.truncate(end_offset)
+
+        self['archive_header']['root_key_hash'] = root_hash.digest()
+        self['archive_header']['tool_key_hash'] = tool_hash.digest()
+        logger.debug('Calculated key hashes as: tool=%s root=%s',
+            tool_hash.hexdigest(), root_hash.hexdigest())
+        self.seek(0)
+        self['archive_header'].save(self)
+        self.flush()
+        self._finish_save_stats()
+
+    def _write_tables(self, handle, filename_data):
+        self['section_header'].save(handle)
+        for key in ('table_of_contents', 'folders', 'file_info'):
+            for entry in self[key]:
+                entry.save(handle)
+        handle.write(filename_data)
+
+    def _build_tables(self, members):
+        """Fill in the ToC, folder and file info tables for members, there is a
+        ToC entry for each top level directory and folders are numbered breadth
+        first so the subfolders and files of each folder are contiguous.
+
+        Returns the members in file info order and the filename list data.
+        """
+
+        tocs = {}
+        for member in members:
+            parts = member.name.split(os.sep)
+            if len(parts) == 1:
+                parts.insert(0, '')
+            node = tocs.setdefault(parts[0], {})
+            for part in parts[1:-1]:
+                node = node.setdefault(part, {})
+            node.setdefault(None, []).append((parts[-1], member))
+
+        filenames = []
+        filename_offsets = {}
+        filename_size = [0]
+        def get_filename_offset(filename):
+            if filename not in filename_offsets:
+                filename_offsets[filename] = filename_size[0]
+                filename_size[0] += len(filename) + 1
+                filenames.append(filename)
+            return filename_offsets[filename]
+
+        toc_entries = []
+        folder_entries = []
+        file_info_entries = []
+        ordered_members = []
+        for toc_idx, toc_name in enumerate(sorted(tocs)):
+            toc_entry = Homeworld2BigTocEntry()
+            toc_entry['namespace'] = 'TOC%d' % toc_idx
+            toc_entry['filename'] = toc_name
+            toc_entry['first_folder_idx'] = toc_entry['start_folder_idx'] = len(folder_entries)
+            toc_entry['first_fileinfo_idx'] = len(file_info_entries)
+
+            pending = deque([('', tocs[toc_name], Homeworld2BigFolderEntry())])
+            folder_entries.append(pending[0][2])
+            while pending:
+                folder_name, node, folder_entry = pending.popleft()
+                folder_entry['filename_offset'] = get_filename_offset(folder_name)
+                folder_entry['first_subfolder_idx'] = len(folder_entries)
+                for subfolder_name in sorted(k for k in node if k is not None):
+                    subfolder_entry = Homeworld2BigFolderEntry()
+                    pending.append(('\\'.join(filter(None, [folder_name, subfolder_name])),
+                        node[subfolder_name], subfolder_entry))
+                    folder_entries.append(subfolder_entry)
+                folder_entry['last_subfolder_idx'] = len(folder_entries)
+                folder_entry['first_fileinfo_idx'] = len(file_info_entries)
+                for filename, member in sorted(node.get(None, []), key=lambda f: f[0]):
+                    file_info = Homeworld2BigFileInfoEntry()
+                    file_info['filename_offset'] = get_filename_offset(filename)
+                    file_info_entries.append(file_info)
+                    ordered_members.append(member)
+                folder_entry['last_fileinfo_idx'] = len(file_info_entries)
+
+            toc_entry['last_folder_idx'] = len(folder_entries)
+            toc_entry['last_fileinfo_idx'] = len(file_info_entries)
+            toc_entries.append(toc_entry)
+
+        # the counts and the indices bounded by them are stored as uint16
+        for kind, count in (('ToC entries', len(toc_entries)), ('folders', len(folder_entries)),
+                ('files', len(file_info_entries)), ('filenames', len(filenames))):
+            if count > MAX_TABLE_COUNT:
+                raise BigFormatException('Too many %s for a HW2 archive: %d > %d' %
+                    (kind, count, MAX_TABLE_COUNT))
+
+        self['table_of_contents']._data_list = toc_entries
+        self['folders']._data_list = folder_entries
+        self['file_info']._data_list = file_info_entries
+
+        section_header = self['section_header']
+        section_header['toc_list_offset'] = section_header.data_size
+        section_header['toc_list_count'] = len(toc_entries)
+        section_header['folder_list_offset'] = section_header['toc_list_offset'] + \
+            len(toc_entries) * Homeworld2BigTocEntry.data_size
+        section_header['folder_list_count'] = len(folder_entries)
+        section_header['file_info_list_offset'] = section_header['folder_list_offset'] + \
+            len(folder_entries) * Homeworld2BigFolderEntry.data_size
+        section_header['file_info_list_count'] = len(file_info_entries)
+        section_header['filename_list_offset'] = section_header['file_info_list_offset'] + \
+            len(file_info_entries) * Homeworld2BigFileInfoEntry.data_size
+        section_header['filename_list_count'] = len(filenames)
+        logger.debug('Built tables for %d members: %d ToC entries, %d folders, %d filenames',
+            len(ordered_members), len(toc_entries), len(folder_entries), len(filenames))
+
+        return ordered_members, ''.join(fn + '\x00' for fn in filenames)
+
+    def _get_section_size(self, filename_list_size):
+        return self['section_header']['filename_list_offset'] + filename_list_size
+
+    def _write_members(self, entries, offset, workers=None, handle=None):
+        """Write the metadata records and data of (member, file_info) pairs
+        sequentially starting at offset, returns the offset after the last
+        member. If handle is given the entries are written to it in order
+        instead of at their offsets in the archive.
+
+        Members are compressed in a thread pool while earlier ones are being
+        written, at most MAX_IN_FLIGHT_BYTES of member data is held waiting to
+        be written. Once a member's stored data is ready it counts against that
+        instead of the member data it was prepared from. Members bigger than
+        STREAM_COMPRESSION_SIZE are not held at all, they are compressed as they
+        are written.
+        """
+
+        pool = get_pool(workers, threads=True)
+        if isinstance(pool, SerialPool):
+            max_in_flight = 0
+        else:
+            max_in_flight = self.MAX_IN_FLIGHT_BYTES
+        member_count = len(entries)
+        pending = deque()
+        batch = []
+        state = {'offset': offset, 'in_flight': 0, 'written': 0, 'batch_size': 0}
+
+        def submit_batch():
+            if batch:
+                batch_result = pool.apply_async(compress_member_batch, ([j for j, r in batch],))
+                for idx, (job, result) in enumerate(batch):
+                    result.append(BatchItemResult(batch_result, idx))
+                del batch[:]
+                state['batch_size'] = 0
+
+        def write_next():
+            member, file_info, prepared, data_size, blob, settled = pending.popleft()
+            if isinstance(prepared, list):
+                prepared = prepared[0]
+            state['offset'] = self._write_member(member, file_info, state['offset'],
+                prepared, blob, handle)
+            state['in_flight'] -= data_size
+            state['written'] += 1
+            logger.info('Wrote member %4d/%4d [%8d b]: %s',
+                state['written'], member_count, member.stored_size, member.name)
+
+        def settle_in_flight():
+            # count the stored data of finished members rather than the member
+            # data they were prepared from
+            for entry in pending:
+                prepared, data_size, blob, settled = entry[2:]
+                if isinstance(prepared, list):
+                    prepared = prepared[0] if prepared else None
+                if data_size and not settled and prepared is not None and prepared.ready():
+                    stored_size = len(prepared.get()[0])
+                    state['in_flight'] += stored_size - data_size
+                    entry[3] = stored_size
+                    entry[5] = True
+
+        try:
+            for member, file_info in entries:
+                blob = None
+                if self._can_copy_stored(member) or \
+                        member.real_size > self.STREAM_COMPRESSION_SIZE:
+                    prepared, data_size = None, 0
+                else:
+                    with self.open_member(member) as member_handle:
+                        data = member_handle.read()
+                    prepared, data_size, blob, batch_job = self._submit_member(member, data, pool)
+                    if batch_job is not None:
+                        batch.append((batch_job, prepared))
+                        state['batch_size'] += data_size
+                        if state['batch_size'] >= self.MIN_BATCH_COMPRESSION_SIZE:
+                            submit_batch()
+                pending.append([member, file_info, prepared, data_size, blob, False])
+                state['in_flight'] += data_size
+                if pending and state['in_flight'] > max_in_flight:
+                    submit_batch()
+                    settle_in_flight()
+                    while pending and state['in_flight'] > max_in_flight:
+                        write_next()
+            submit_batch()
+            while pending:
+                write_next()
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        return state['offset']
+
+    def extract_all(self, members=None, path='', decompress=True, workers=None):
+        """Extract members under path, decompressing them in a pool of
+        `workers` threads. Members are read in archive order and decompressed
+        in batches of up to MAX_IN_FLIGHT_BYTES of output, members bigger than
+        MAX_BATCH_EXTRACT_SIZE are streamed out one at a time instead.
+        """
+
+        if not decompress:
+            return super(Homeworld2BigFile, self).extract_all(members, path, decompress)
+        if members is None:
+            members = self.get_members()
+        self.load_metadata(members)
+
+        pool = get_pool(workers, threads=True)
+        batch = []
+        batch_size = 0
+        try:
+            for member in sorted(members, key=lambda m: m._offset):
+                if member.real_size > self.MAX_BATCH_EXTRACT_SIZE:
+                    self.extract(member, path, decompress)
+                    continue
+                batch.append(member)
+                batch_size += member.real_size
+                if batch_size >= self.MAX_IN_FLIGHT_BYTES:
+                    self._extract_batch(batch, path, pool)
+                    batch = []
+                    batch_size = 0
+            if batch:
+                self._extract_batch(batch, path, pool)
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def _extract_batch(self, members, path, pool):
+        stored_data = []
+        for member in members:
+            with self.open_member(member) as member_handle:
+                stored_data.append(member_handle.read())
+        compressed_idxs = [idx for idx, member in enumerate(members) if member.is_compressed]
+        decompressed_data = self.COMPRESSION_ALGORITHM.decompress_batch(
+            [(stored_data[idx], members[idx].real_size) for idx in compressed_idxs], pool=pool)
+        for idx, data in zip(compressed_idxs, decompressed_data):
+            stored_data[idx] = data
+        logger.debug('Decompressed batch of %d members (%d compressed)',
+            len(members), len(compressed_idxs))
+
+        for member, data in zip(members, stored_data):
+            self._extract_to_path(member, path, lambda outfile: outfile.write(data))
+            logger.info('Extracted %r', member)
+
+    def _submit_member(self, member, data, pool):
+        """Start compressing a member's data. Returns the result, the size of
+        the data being worked on, the dedup blob for the member's data and the
+        (data, algorithm) job to add to the current batch, if the member is
+        batched.
+
+        Batched members get an empty list as their result, the member's
+        BatchItemResult is added to it once the batch is submitted.
+        """
+
+        profile = self._select_profile(member)
+        dedup = self._deduplicator
+        key = None
+        if dedup is not None and dedup.is_candidate(member):
+            key, blob = dedup.lookup(data)
+            if blob is not None:
+                logger.debug('Reusing stored data of duplicate content for: %r', member)
+                return blob['result'], 0, blob, None
+
+        algorithm = self.COMPRESSION_ALGORITHM
+        if profile is not None:
+            algorithm = profile.get_algorithm(algorithm)
+        batch_job = None
+        if profile is not None and profile.store:
+            logger.debug('Profile %s stores data as-is: %r', profile.name, member)
+            result = ImmediateResult((data, False, crc32(data)))
+        elif len(data) < self.MIN_BATCH_COMPRESSION_SIZE:
+            result = []
+            batch_job = (data, algorithm)
+        else:
+            result = pool.apply_async(compress_member_data, (data, algorithm))
+        blob = None
+        if key is not None:
+            blob = dedup.add(key, result, timestamp=datetime_to_timestamp(member.mtime),
+                basename=os.path.basename(member.name), file_info=None, crc32=None)
+        return result, len(data), blob, batch_job
+
+    def _write_member(self, member, file_info, offset, prepared=None, blob=None, handle=None):
+        """Write the metadata record and data of a member at offset and fill in
+        its file info entry, returns the offset after the member's data.
+        """
+
+        file_data_base = self['archive_header']['file_data_offset']
+        timestamp = datetime_to_timestamp(member.mtime)
+        basename = os.path.basename(member.name)
+        if blob is not None and blob['file_info'] is not None:
+            if blob['timestamp'] == timestamp and blob['basename'] == basename:
+                # identical data and metadata record, the entry can point at
+                # the copy already written
+                shared = blob['file_info']
+                for key in ('compression_flag', 'file_data_offset', 'data_stored_size', 'data_real_size'):
+                    file_info[key] = shared[key]
+                member._stored_size = shared['data_stored_size']
+                self._deduplicator.record_duplicate(member.real_size,
+                    member.stored_size + Homeworld2BigFileEntry.data_size)
+                return offset
+            self._deduplicator.record_duplicate(member.real_size)
+
+        data_offset = offset + Homeworld2BigFileEntry.data_size
+        stored_data = None
+        copy_stored = self._can_copy_stored(member)
+        copy_written = not copy_stored and blob is not None and blob['position'] is not None
+        if copy_stored:
+            member_crc32 = member.crc32
+            if member_crc32 is None:
+                member_crc32 = self._compute_crc32(member)
+        elif copy_written:
+            member_crc32 = blob['crc32']
+        elif prepared is not None:
+            stored_data, is_compressed, member_crc32 = prepared.get()
+        else:
+            # streamed, the record is rewritten once the CRC32 is known
+            member_crc32 = 0
+
+        metadata = Homeworld2BigFileEntry()
+        metadata['filename'] = basename
+        metadata['timestamp'] = member.mtime
+        metadata['crc32'] = member_crc32
+        # the spool handle given by save() can always be read back
+        readable = handle is not None or self._is_readable()
+        if handle is None:
+            handle = self
+            handle.seek(offset)
+        record_position = handle.tell()
+        metadata.save(handle)
+
+        position = handle.tell()
+        if copy_stored:
+            stored_size = self._copy_stored(member, handle)
+            logger.debug('Copied %d bytes of stored file data at offset: %d',
+                stored_size, data_offset)
+        elif copy_written:
+            # identical data has already been written, copy it from there
+            stored_size = blob['stored_size']
+            copy_range(handle, blob['position'], position, stored_size)
+            handle.seek(position + stored_size)
+            logger.debug('Copied %d bytes of duplicate file data at offset: %d',
+                stored_size, data_offset)
+            member._stored_size = stored_size
+        else:
+            if stored_data is None:
+                stored_size, is_compressed, member_crc32 = self._stream_member(member, handle)
+                metadata['crc32'] = member_crc32
+                handle.seek(record_position)
+                metadata.save(handle)
+                handle.seek(position + stored_size)
+            else:
+                handle.write(stored_data)
+                stored_size = len(stored_data)
+            logger.debug('Wrote %d bytes (%s) of file data at offset: %d',
+                stored_size, 'compressed' if is_compressed else 'uncompressed', data_offset)
+            member._stored_size = stored_size
+            if blob is not None:
+                self._deduplicator.set_written(blob,
+                    position if readable else None, stored_size)
+                blob['crc32'] = member_crc32
+
+        file_info['compression_flag'] = 1 if member.is_compressed else 0
+        file_info['file_data_offset'] = data_offset - file_data_base
+        file_info['data_stored_size'] = member.stored_size
+        file_info['data_real_size'] = member.real_size
+        if blob is not None and blob['file_info'] is None and \
+                blob['timestamp'] == timestamp and blob['basename'] == basename:
+            blob['file_info'] = file_info
+        return data_offset + member.stored_size
+
+    def _compute_crc32(self, member):
+        """Get the CRC32 of a member's decompressed data a chunk at a time."""
+
+        source = getattr(member, 'source', member)
+        value = 0
+        with source._bigfile.open_decompressed(source) as member_handle:
+            for chunk in iter(lambda: member_handle.read(LARGE_CHUNK_SIZE), ''):
+                value = crc32(chunk, value)
+        return value
+
+    def _stream_member(self, member, handle):
+        """Compress the data of a member too big to hold in memory straight
+        from its handle to the current position of handle, returns the stored
+        size, whether it is compressed and the CRC32 of the data. If the data
+        doesn't get smaller it is copied as-is over the compressed output.
+        """
+
+        profile = self._select_profile(member)
+        compress = profile is None or not profile.store
+        data_offset = handle.tell()
+        if compress:
+            algorithm = self.COMPRESSION_ALGORITHM
+            if profile is not None:
+                algorithm = profile.get_algorithm(algorithm)
+            with self.open_member(member) as member_handle:
+                reader = CRC32Reader(member_handle)
+                try:
+                    stored_size = algorithm.compress_stream(reader, handle, member.real_size - 1)
+                except CompressionBudgetExceeded as err:
+                    logger.debug('Abandoned compression: %s', err)
+                else:
+                    return stored_size, True, reader.crc32
+            handle.seek(data_offset)
+        else:
+            logger.debug('Profile %s stores data as-is: %r', profile.name, member)
+
+        with self.open_member(member) as member_handle:
+            reader = CRC32Reader(member_handle)
+            stored_size = chunked_copy(reader.read, handle.write, LARGE_CHUNK_SIZE)
+        if compress:
+            # drop any compressed output that ran past the end of the data
+            handle.truncate()
+        return stored_size, False, reader.crc32
+
     def _build_filename_map(self):
         fn_map = [None] * len(self._data['file_info'])
-        for fn, fi in self._walk_contents():
-            fn_map[self._data['file_info']._data_list.index(fi)] = fn
+        for fn, file_info_idx in self._walk_contents():
+            fn_map[file_info_idx] = fn
         return fn_map
 
+    def _read_filename_table(self):
+        """Read the whole filename list in one go, it runs from its offset in
+        the section header up to the start of the file data.
+        """
+
+        table_offset = self._get_filename_offset({'filename_offset': 0})
+        table_size = self._data['archive_header']['file_data_offset'] - table_offset
+        if table_size <= 0:
+            logger.warning('Filename list has no size, reading filenames one at a time')
+            return None
+        self.seek(table_offset)
+        logger.debug('Reading %d byte filename list at offset: %d', table_size, table_offset)
+        return self.read(table_size)
+
     def _read_filename(self, file_info_entry):
-        self.seek(self._get_filename_offset(file_info_entry))
-        filename = self.read(MAX_FILENAME_LENGTH).split('\x00', 1)[0]
+        table = self._filename_table
+        name_offset = file_info_entry['filename_offset']
+        if table is not None and name_offset < len(table):
+            name_end = table.find('\x00', name_offset, name_offset + MAX_FILENAME_LENGTH)
+            if name_end < 0:
+                name_end = min(len(table), name_offset + MAX_FILENAME_LENGTH)
+            filename = table[name_offset:name_end]
+        else:
+            self.seek(self._get_filename_offset(file_info_entry))
+            filename = self.read(MAX_FILENAME_LENGTH).split('\x00', 1)[0]
         filename = self._normalize_filename(filename)
         return filename
 
@@ -420,18 +1059,30 @@ class Homeworld2BigFile(BigFile):
         return os.path.join(*filename.split('\\'))
 
     def _walk_contents(self):
+        """Yield (full filename, file info index) for every file in the archive."""
+
         for toc_entry in self._data['table_of_contents']:
-            for item_path, item in self._walk_folder(self._data['folders'][toc_entry['start_folder_idx']]):
-                yield os.path.join(toc_entry['filename'], item_path), item
-
-    def _walk_folder(self, folder_entry):
-        folder_name = self._read_filename(folder_entry) or ''
-        if folder_entry['first_subfolder_idx'] != folder_entry['last_subfolder_idx']:
-            for subfolder in self._data['folders'][folder_entry['first_subfolder_idx']:folder_entry['last_subfolder_idx']]:
-                for item_path, item in self._walk_folder(subfolder):
-                    yield item_path, item
-        for file_info in self._data['file_info'][folder_entry['first_fileinfo_idx']:folder_entry['last_fileinfo_idx']]:
-            yield os.path.join(folder_name, self._read_filename(file_info)), file_info
+            for item_path, file_info_idx in self._walk_folder(toc_entry['start_folder_idx']):
+                yield os.path.join(toc_entry['filename'], item_path), file_info_idx
+
+    def _walk_folder(self, folder_idx):
+        """Yield (filename, file info index) for the files in a folder and all
+        of its subfolders. Folder names are already the full path so this uses
+        a stack instead of recursing through nested generators.
+        """
+
+        folders = self._data['folders']
+        file_infos = self._data['file_info']
+        pending = [folder_idx]
+        while pending:
+            folder_entry = folders[pending.pop()]
+            folder_name = self._read_filename(folder_entry) or ''
+            pending.extend(reversed(xrange(folder_entry['first_subfolder_idx'],
+                folder_entry['last_subfolder_idx'])))
+            for file_info_idx in xrange(folder_entry['first_fileinfo_idx'],
+                    folder_entry['last_fileinfo_idx']):
+                yield os.path.join(folder_name, self._read_filename(file_infos[file_info_idx])), \
+                    file_info_idx
 
     def _get_file_data_offset(self, file_info_entry):
         return self._data['archive_header']['file_data_offset'] + file_info_entry['file_data_offset']
@@ -441,25 +1092,88 @@ class Homeworld2BigFile(BigFile):
             self._data['section_header']['filename_list_offset'] + \
             entry['filename_offset']
 
-    def _get_file_metadata(self, file_info_entry):
-        self.seek(self._get_file_data_offset(file_info_entry) - Homeworld2BigFileEntry.data_size)
-        file_metadata = Homeworld2BigFileEntry(self)
-        return file_metadata
-
-    def _get_full_filename(self, file_info_entry):
-        return self._filename_map[self._data['file_info']._data_list.index(file_info_entry)]
-
-    def _get_tool_key_hash(self):
-        md5_hash = hashlib.md5(self.TOOL_KEY)
-        self.seek(self['archive_header'].data_size)
-        chunked_copy(self.read, md5_hash.update)
-        logger.debug('Calculated tool key hash as: %s', md5_hash.hexdigest())
-        return md5_hash.digest()
-
-    def _get_root_key_hash(self):
-        md5_hash = hashlib.md5(self.ROOT_KEY)
-        data_handle = FileInFile(self, self['archive_header'].data_size,
-            size=self['archive_header']['file_data_offset'] - self['archive_header'].data_size)
-        chunked_copy(data_handle.read, md5_hash.update)
-        logger.debug('Calculated root key hash as: %s', md5_hash.hexdigest())
-        return md5_hash.digest()
+    def load_metadata(self, members=None):
+        """Load the per-file metadata records (mtime and crc32) of members,
+        these sit just before each member's data so they are only read when
+        needed. Records are read in offset order with nearby records fetched
+        together.
+        """
+
+        if members is None:
+            members = self.get_members()
+        pending = sorted((m for m in members \
+                if getattr(m, '_metadata_offset', None) is not None and m._bigfile is self),
+            key=lambda m: m._metadata_offset)
+        record_size = Homeworld2BigFileEntry.data_size
+
+        idx = 0
+        while idx < len(pending):
+            read_start = pending[idx]._metadata_offset
+            read_end = read_start + record_size
+            batch_end = idx + 1
+            while batch_end < len(pending):
+                next_offset = pending[batch_end]._metadata_offset
+                if next_offset - read_end > self.METADATA_READ_GAP or \
+                        next_offset + record_size - read_start > self.MAX_METADATA_READ_SIZE:
+                    break
+                read_end = next_offset + record_size
+                batch_end += 1
+
+            logger.debug('Reading %d metadata records from %d bytes at offset: %d',
+                batch_end - idx, read_end - read_start, read_start)
+            self.seek(read_start)
+            data = self.read(read_end - read_start)
+            for member in pending[idx:batch_end]:
+                record_offset = member._metadata_offset - read_start
+                member.load_metadata(Homeworld2BigFileEntry(
+                    StringIO(data[record_offset:record_offset + record_size])))
+            idx = batch_end
+
+    def _get_full_filename(self, file_info_idx):
+        return self._filename_map[file_info_idx]
+
+    def check_key_hashes(self):
+        """Check the tool and root key hashes in the archive header match the
+        archive's content.
+        """
+
+        tool_key_hash, root_key_hash = self._get_key_hashes()
+        return tool_key_hash == self['archive_header']['tool_key_hash'] and \
+            root_key_hash == self['archive_header']['root_key_hash']
+
+    def _get_key_hashes(self):
+        """Calculate (tool_key_hash, root_key_hash) in a single pass over the
+        archive. The root key hash covers the section header and tables, which
+        the tool key hash also covers along with the rest of the file.
+        """
+
+        tool_hash = hashlib.md5(self.TOOL_KEY)
+        root_hash = hashlib.md5(self.ROOT_KEY)
+        header_size = self['archive_header'].data_size
+        file_data_offset = self['archive_header']['file_data_offset']
+        data_handle = FileInFile(self, header_size, size=file_data_offset - header_size)
+        chunked_copy(data_handle.read, HashingWriter(None, tool_hash, root_hash).write,
+            LARGE_CHUNK_SIZE)
+        self.seek(file_data_offset)
+        chunked_copy(self.read, tool_hash.update, LARGE_CHUNK_SIZE)
+        logger.debug('Calculated key hashes as: tool=%s root=%s',
+            tool_hash.hexdigest(), root_hash.hexdigest())
+        return tool_hash.digest(), root_hash.digest()
+
+def compress_member_data(data, algorithm=None):
+    """Compress member data, returning the data to store, whether it is
+    compressed and the CRC32 of the uncompressed data. Data that doesn't get
+    smaller is stored as-is.
+    """
+
+    if algorithm is None:
+        compressed_data = zlib.compress(data)
+    else:
+        compressed_data = algorithm.compress(data)
+    if len(compressed_data) < len(data):
+        return compressed_data, True, crc32(data)
+    else:
+        return data, False, crc32(data)
+
+def compress_member_batch(jobs):
+    return [compress_member_data(data, algorithm) for data, algorithm in jobs]
@@ -134,3 +134,11 @@ class Homeworld2ClassicBigFile(Homeworld2BigFile): pass
 class HomeworldRemasteredBigFile(GearboxEncryptedBigFile, Homeworld2BigFile):
     MASTER_KEY                      = GEARBOX_HWRM_GLOBAL_KEY
     ENCRYPTION_KEY_MARKER           = 0xDEADBE7A
+
+    def load_header(self):
+        self._setup_encryption()
+        self._pin_blocks = self.PIN_LOADED_BLOCKS
+        try:
+            super(HomeworldRemasteredBigFile, self).load_header()
+        finally:
+            self._pin_blocks = False
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import struct
+import os
+import hashlib
+import logging
+
+from naabal.errors import BigIndexException
+from naabal.util import crc32
+from naabal.util.file_io import replace_file
+
+logger = logging.getLogger('naabal.formats.big.index')
+
+def partial_hash(filename, sample_size=64 * 1024):
+    """Cheap fingerprint of a (potentially very large) file, the MD5 of its
+    size and the first and last `sample_size` bytes.
+    """
+
+    md5_hash = hashlib.md5()
+    with open(filename, 'rb') as handle:
+        handle.seek(0, os.SEEK_END)
+        file_size = handle.tell()
+        md5_hash.update(struct.pack('<Q', file_size))
+        handle.seek(0)
+        md5_hash.update(handle.read(sample_size))
+        if file_size > sample_size:
+            handle.seek(max(sample_size, file_size - sample_size))
+            md5_hash.update(handle.read(sample_size))
+    return md5_hash.digest()
+
+class BigIndex(object):
+    """Sidecar index of an archive's members, so the archive can be re-opened
+    without parsing its ToC or per-file metadata.
+
+    The index is keyed to the archive by size, mtime and a partial hash, any
+    mismatch means the index is stale and should be rebuilt.
+    """
+
+    MAGIC_COOKIE        = 'NBIX'
+    VERSION             = 1
+    HEADER_FORMAT       = '<4sHLL'  # magic, version, body crc32, body length
+    KEY_FORMAT          = '<Qd16sH' # archive size, mtime, partial hash, format name length
+    COUNT_FORMAT        = '<L'
+    ENTRY_FORMAT        = '<QQQLBLH' # offset, real size, stored size, mtime, has crc, crc, name length
+
+    def __init__(self, format_name=None, archive_key=None, members=None):
+        self._format_name   = format_name
+        self._archive_key   = archive_key
+        self._members       = members or []
+
+    def __repr__(self):
+        return '<{0}({1}, {2} members)>'.format(
+            self.__class__.__name__, self._format_name, len(self._members))
+
+    @property
+    def format_name(self):
+        return self._format_name
+
+    @property
+    def members(self):
+        return self._members
+
+    @classmethod
+    def get_archive_key(cls, filename):
+        fstat = os.stat(filename)
+        return (fstat.st_size, fstat.st_mtime, partial_hash(filename))
+
+    @classmethod
+    def get_index_filename(cls, filename):
+        return filename + '.idx'
+
+    @classmethod
+    def build(cls, bigfile, filename):
+        bigfile.load_metadata()
+        members = [member.get_index_entry() for member in bigfile.get_members()]
+        return cls(bigfile.__class__.__name__, cls.get_archive_key(filename), members)
+
+    def matches(self, filename):
+        return self._archive_key == self.get_archive_key(filename)
+
+    def save(self, index_filename):
+        body = self._pack_body()
+        header = struct.pack(self.HEADER_FORMAT,
+            self.MAGIC_COOKIE, self.VERSION, crc32(body), len(body))
+        # write to a temp file first so readers never see a partial index
+        tmp_filename = '{0}.{1}.tmp'.format(index_filename, os.getpid())
+        with open(tmp_filename, 'wb') as handle:
+            handle.write(header + body)
+        replace_file(tmp_filename, index_filename)
+        logger.debug('Wrote index with %d members to: %s', len(self._members), index_filename)
+
+    @classmethod
+    def load(cls, index_filename):
+        with open(index_filename, 'rb') as handle:
+            data = handle.read()
+
+        header_size = struct.calcsize(cls.HEADER_FORMAT)
+        if len(data) < header_size:
+            raise BigIndexException('Index file is truncated: %s' % index_filename)
+        magic, version, body_crc, body_length = \
+            struct.unpack(cls.HEADER_FORMAT, data[:header_size])
+        if magic != cls.MAGIC_COOKIE:
+            raise BigIndexException('Incorrect magic cookie: %r' % magic)
+        if version != cls.VERSION:
+            raise BigIndexException('Unsupported index version: %d' % version)
+        body = data[header_size:]
+        if len(body) != body_length or crc32(body) != body_crc:
+            raise BigIndexException('Index data is corrupt: %s' % index_filename)
+
+        index = cls()
+        index._unpack_body(body)
+        logger.debug('Loaded index with %d members from: %s', len(index._members), index_filename)
+        return index
+
+    def _pack_body(self):
+        archive_size, archive_mtime, archive_hash = self._archive_key
+        parts = [
+            struct.pack(self.KEY_FORMAT, archive_size, archive_mtime, archive_hash,
+                len(self._format_name)),
+            self._format_name,
+            struct.pack(self.COUNT_FORMAT, len(self._members)),
+        ]
+        for name, offset, real_size, stored_size, mtime, crc in self._members:
+            parts.append(struct.pack(self.ENTRY_FORMAT, offset, real_size, stored_size,
+                mtime, crc is not None, crc or 0, len(name)))
+            parts.append(name)
+        return ''.join(parts)
+
+    def _unpack_body(self, body):
+        try:
+            pos = 0
+            key_size = struct.calcsize(self.KEY_FORMAT)
+            archive_size, archive_mtime, archive_hash, name_length = \
+                struct.unpack(self.KEY_FORMAT, body[pos:pos+key_size])
+            pos += key_size
+            self._archive_key = (archive_size, archive_mtime, archive_hash)
+            self._format_name = body[pos:pos+name_length]
+            pos += name_length
+
+            count_size = struct.calcsize(self.COUNT_FORMAT)
+            member_count = struct.unpack(self.COUNT_FORMAT, body[pos:pos+count_size])[0]
+            pos += count_size
+
+            entry_size = struct.calcsize(self.ENTRY_FORMAT)
+            members = []
+            for i in xrange(member_count):
+                offset, real_size, stored_size, mtime, has_crc, crc, name_length = \
+                    struct.unpack(self.ENTRY_FORMAT, body[pos:pos+entry_size])
+                pos += entry_size
+                name = body[pos:pos+name_length]
+                pos += name_length
+                members.append((name, offset, real_size, stored_size, mtime,
+                    crc if has_crc else None))
+        except struct.error as err:
+            raise BigIndexException(err)
+        self._members = members
@@ -29,7 +29,10 @@ import os
 import fnmatch
 import datetime
 
-from naabal.util.helpers import big_load
+from naabal.errors import BigFormatException, GearboxEncryptionException
+from naabal.util.helpers import big_load, big_convert
+from naabal.util.compressibility import PREDICTORS
+from naabal.util.profiles import PROFILES
 from naabal.formats.big.hw1 import HomeworldBigFile
 from naabal.formats.big.hw2 import Homeworld2BigFile
 from naabal.formats.big.hwrm import HomeworldRemasteredBigFile, HomeworldClassicBigFile
@@ -81,9 +84,12 @@ def big_ls():
     parser = argparse.ArgumentParser(prog='big-ls',
         description='List contents of a .big file')
     parser.add_argument('-l', '--long', action='store_true')
+    parser.add_argument('-I', '--use-index', action='store_true')
     parser.add_argument('filename')
     args = parser.parse_args()
-    with big_load(args.filename) as bigfile:
+    with big_load(args.filename, use_index=args.use_index) as bigfile:
+        if args.long:
+            bigfile.load_metadata()
         for member in bigfile:
             if args.long:
                 sys.stdout.write('{0} {1:8d} +{2:8d} {3} {4}\n'.format(
@@ -102,17 +108,29 @@ def big_extract():
         description='Extract contents of a .big file to a directory')
     parser.add_argument('-i', '--include-matching')
     parser.add_argument('--no-decompress', action='store_false')
+    parser.add_argument('-I', '--use-index', action='store_true')
+    parser.add_argument('-t', '--tar', metavar='TAR_FILENAME',
+        help='Write members to a tar file instead of a directory, "-" for stdout')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='Number of threads to decompress with, defaults to one per CPU')
     parser.add_argument('filename')
     parser.add_argument('destination', default=os.getcwd(), nargs='?')
     args = parser.parse_args()
 
-    with big_load(args.filename) as bigfile:
+    with big_load(args.filename, use_index=args.use_index) as bigfile:
         if args.include_matching:
             member_list = [m for m in bigfile.get_members() if fnmatch.fnmatch(m.name, args.include_matching)]
         else:
             member_list = bigfile.get_members()
+        if args.tar == '-':
+            bigfile.export_tar(getattr(sys.stdout, 'buffer', sys.stdout), member_list)
+            return 0
+        elif args.tar:
+            with open(args.tar, 'wb') as tar_handle:
+                bigfile.export_tar(tar_handle, member_list)
+            return 0
+        bigfile.extract_all(member_list, args.destination, args.no_decompress, workers=args.jobs)
         for member in member_list:
-            bigfile.extract(member, args.destination, args.no_decompress)
             sys.stdout.write('Extracted {size:8d} bytes: {name}\n'.format(
                 size=member.real_size, name=member.name))
     return 0
@@ -120,20 +138,26 @@ def big_extract():
 def big_decrypt():
     parser = argparse.ArgumentParser(prog='big-decrypt',
         description='Extract contents of a .big file to a directory')
-    parser.add_argument('-c', '--chunk-size', type=int, default=1024 * 4)
+    parser.add_argument('-c', '--chunk-size', type=int, default=1024 * 1024)
     parser.add_argument('src_filename')
     parser.add_argument('dest_filename')
     args = parser.parse_args()
 
     with HomeworldRemasteredBigFile(args.src_filename) as infile:
-        bigfile.load()
-        with open(args.dest_filename, 'w') as outfile:
-            chunk_size = args.chunk_size
-            data_size = infile.data_size
-            for i in xrange(0, data_size, chunk_size):
-                outfile.write(infile.read(chunk_size))
+        with open(args.dest_filename, 'wb') as outfile:
+            infile.export_decrypted(outfile, bytearray(args.chunk_size))
     return 0
 
+def write_profile_stats(handle, profile_stats):
+    if not profile_stats:
+        return
+    handle.write('{0:<12} {1:>8} {2:>12} {3:>12} {4:>7}\n'.format(
+        'profile', 'members', 'real', 'stored', 'ratio'))
+    for name, counts in sorted(profile_stats.items()):
+        ratio = float(counts['stored_size']) / counts['real_size'] if counts['real_size'] else 1.0
+        handle.write('{0:<12} {1:>8d} {2:>12d} {3:>12d} {4:>6.1f}%\n'.format(
+            name, counts['members'], counts['real_size'], counts['stored_size'], ratio * 100.0))
+
 CREATE_FORMATS = {
     'hw1':      HomeworldBigFile,
     'hw1c':     HomeworldClassicBigFile,
@@ -144,18 +168,127 @@ def big_create():
     parser = argparse.ArgumentParser(prog='big-create',
         description='Create a big file')
     parser.add_argument('-f', '--format', choices=CREATE_FORMATS, default='hw2')
-    parser.add_argument('-x', '--exclude-matching')
-    parser.add_argument('filename')
+    parser.add_argument('-x', '--exclude-matching', action='append', metavar='GLOB')
+    parser.add_argument('-i', '--include-matching', action='append', metavar='GLOB')
+    parser.add_argument('-m', '--manifest',
+        help='File listing the files under source to add, instead of scanning it')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+        help='Number of processes to compress with, defaults to one per CPU')
+    parser.add_argument('-p', '--predict', choices=PREDICTORS, default='none',
+        help='How to predict which files are not worth compressing')
+    parser.add_argument('-P', '--profile', choices=PROFILES, default='none',
+        help='Compression profiles to pick the level (or storing as-is) per file')
+    parser.add_argument('-r', '--reuse', metavar='PREVIOUS_BIG',
+        help='Copy compressed data for unchanged files from a previous build')
+    parser.add_argument('-c', '--check-content', action='store_true',
+        help='With --reuse, also compare CRC32s of files whose mtime changed')
+    parser.add_argument('-S', '--max-spill-size', type=int, default=None, metavar='MB',
+        help='When streaming, the most member data to spool to a temporary file, '
+            '0 for no limit (defaults to 2048)')
+    parser.add_argument('filename', help='Big file to create, "-" streams it to stdout')
     parser.add_argument('source', default=os.getcwd(), nargs='?')
     args = parser.parse_args()
 
-    with CREATE_FORMATS[args.format](args.filename, 'w') as bigfile:
-        if args.exclude_matching:
-            exclude = lambda fn: not fnmatch.fnmatch(fn, args.exclude_matching)
-        else:
-            exclude = None
-        bigfile.add_all(args.source, exclude)
-        bigfile.save()
+    big_format = CREATE_FORMATS[args.format]
+    if args.predict != 'none' and not hasattr(big_format, 'COMPRESSIBILITY_PREDICTOR'):
+        sys.stderr.write('Compressibility prediction is not supported for: {0}\n'.format(
+            big_format.__name__))
+        return 1
+    streaming = args.filename == '-'
+    if streaming and not hasattr(big_format, 'save_stream'):
+        sys.stderr.write('Streaming is not supported for: {0}\n'.format(big_format.__name__))
+        return 1
+
+    # stdout needs to be written as bytes, a file is opened for reading too so
+    # duplicate content can be copied from where it was first written
+    if streaming:
+        output, mode = getattr(sys.stdout, 'buffer', sys.stdout), 'wb'
+    else:
+        output, mode = args.filename, 'w+b'
+    with big_format(output, mode) as bigfile:
+        if streaming and args.max_spill_size is not None:
+            bigfile.MAX_STREAM_SPILL_SIZE = args.max_spill_size * 1024 * 1024 or None
+        if args.predict != 'none':
+            bigfile.COMPRESSIBILITY_PREDICTOR = PREDICTORS[args.predict]()
+        bigfile.COMPRESSION_PROFILES = PROFILES[args.profile]()
+        bigfile.add_all(args.source, args.exclude_matching, include=args.include_matching,
+            manifest=args.manifest, workers=args.jobs)
+        previous = big_load(args.reuse) if args.reuse else None
+        try:
+            if previous is not None:
+                bigfile.reuse_from(previous, args.check_content)
+            if streaming:
+                bigfile.save_stream(workers=args.jobs)
+            else:
+                bigfile.save(workers=args.jobs)
+        except BigFormatException as err:
+            sys.stderr.write('{0}\n'.format(err))
+            return 1
+        finally:
+            if previous is not None:
+                previous.close()
+        write_profile_stats(sys.stderr, bigfile.save_stats.get('profiles'))
+    return 0
+
+def big_update():
+    parser = argparse.ArgumentParser(prog='big-update',
+        description='Add, replace or delete members of an existing HW1 big file in place')
+    parser.add_argument('-x', '--exclude-matching', action='append', metavar='GLOB')
+    parser.add_argument('-d', '--delete', action='append', default=[], metavar='MEMBER_NAME')
+    parser.add_argument('filename')
+    parser.add_argument('source', nargs='?')
+    args = parser.parse_args()
+
+    with big_load(args.filename, mode='r+b') as bigfile:
+        if not isinstance(bigfile, HomeworldBigFile):
+            sys.stderr.write('In-place updates are not supported for: {0}\n'.format(
+                bigfile.__class__.__name__))
+            return 1
+        for member_name in args.delete:
+            bigfile.remove(member_name)
+        if args.source:
+            bigfile.add_all(args.source, args.exclude_matching, replace=True)
+        bigfile.update()
+        free_space = bigfile.get_free_space()
+        sys.stdout.write('Free space: {free_size:d} of {file_size:d} bytes ({pct:.1f}%)\n'.format(
+            pct=free_space['free_ratio'] * 100.0, **free_space))
+    return 0
+
+def big_compact():
+    parser = argparse.ArgumentParser(prog='big-compact',
+        description='Remove unused space from a HW1 big file in place')
+    parser.add_argument('filename')
+    args = parser.parse_args()
+
+    with big_load(args.filename, mode='r+b') as bigfile:
+        if not isinstance(bigfile, HomeworldBigFile):
+            sys.stderr.write('Compaction is not supported for: {0}\n'.format(
+                bigfile.__class__.__name__))
+            return 1
+        reclaimed = bigfile.compact()
+        sys.stdout.write('Reclaimed {0:d} bytes\n'.format(reclaimed))
+    return 0
+
+# HWRM is accepted so asking for it gets a clear error instead of an unknown
+# format, encrypted archives can't be written
+CONVERT_FORMATS = dict(CREATE_FORMATS, hwrm=HomeworldRemasteredBigFile)
+
+def big_convert_cmd():
+    parser = argparse.ArgumentParser(prog='big-convert',
+        description='Convert a big file to another format')
+    parser.add_argument('-f', '--format', choices=CONVERT_FORMATS, required=True)
+    parser.add_argument('src_filename')
+    parser.add_argument('dest_filename')
+    args = parser.parse_args()
+
+    try:
+        member_count = big_convert(args.src_filename, args.dest_filename,
+            CONVERT_FORMATS[args.format])
+    except GearboxEncryptionException as err:
+        sys.stderr.write('{0}\n'.format(err))
+        return 1
+    sys.stdout.write('Converted {count:d} members to: {name}\n'.format(
+        count=member_count, name=args.dest_filename))
     return 0
 
 
@@ -165,6 +298,9 @@ MAIN_IDX = {
     'extract':      big_extract,
     'decrypt':      big_decrypt,
     'create':       big_create,
+    'convert':      big_convert_cmd,
+    'update':       big_update,
+    'compact':      big_compact,
 }
 
 if __name__ == '__main__':
@@ -48,8 +48,8 @@ class classproperty(property):
 def split_by(iterable, chunk_size):
     return (iterable[pos:pos+chunk_size] for pos in xrange(0, len(iterable), chunk_size))
 
-def crc32(data):
-    return zlib.crc32(data) & 0xFFFFFFFF
+def crc32(data, value=0):
+    return zlib.crc32(data, value) & 0xFFFFFFFF
 
 def unpack_key(key):
     return bytearray(key.strip().decode('base64'))
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger('naabal.util.cache')
+
+class LRUByteCache(object):
+    """Thread-safe least-recently-used cache bounded by the total size (in bytes)
+    of the values it holds rather than by the number of entries.
+
+    Values larger than the whole budget are never stored.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self._max_bytes     = max_bytes
+        self._entries       = OrderedDict()
+        self._size          = 0
+        self._lock          = threading.Lock()
+        self._hits          = 0
+        self._misses        = 0
+        self._evictions     = 0
+
+    def __repr__(self):
+        return '<{0}({1}/{2} bytes, {3} entries)>'.format(
+            self.__class__.__name__, self._size, self._max_bytes, len(self))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self._entries[key] = value
+            self._hits += 1
+            return value
+
+    def put(self, key, value):
+        value_size = len(value)
+        if value_size > self._max_bytes:
+            logger.debug('Not caching value of %d bytes, larger than cache size: %d',
+                value_size, self._max_bytes)
+            return False
+        with self._lock:
+            old_value = self._entries.pop(key, None)
+            if old_value is not None:
+                self._size -= len(old_value)
+            self._entries[key] = value
+            self._size += value_size
+            while self._size > self._max_bytes:
+                evicted_key, evicted_value = self._entries.popitem(last=False)
+                self._size -= len(evicted_value)
+                self._evictions += 1
+                logger.debug('Evicted cache entry: %r (%d bytes)',
+                    evicted_key, len(evicted_value))
+        return True
+
+    def discard(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._size -= len(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def reset_stats(self):
+        with self._lock:
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits':         self._hits,
+                'misses':       self._misses,
+                'hit_ratio':    float(self._hits) / lookups if lookups else 0.0,
+                'evictions':    self._evictions,
+                'entries':      len(self._entries),
+                'size':         self._size,
+                'max_bytes':    self._max_bytes,
+            }
+
+class MemberCache(LRUByteCache):
+    """Cache of decompressed archive member data, keyed by the identity of the
+    archive file and the offset of the member inside it. A single instance can
+    be shared between any number of open archives.
+    """
+
+    def get_member(self, archive_id, offset):
+        return self.get((archive_id, offset))
+
+    def put_member(self, archive_id, offset, data):
+        return self.put((archive_id, offset), data)
+
+class BlockCache(LRUByteCache):
+    """Cache of aligned, fixed-size blocks of a file keyed by block index.
+
+    Blocks can be pinned, pinned blocks are held outside of the LRU and don't
+    count against its budget so they are never evicted.
+    """
+
+    def __init__(self, block_size, max_bytes=16 * 1024 * 1024):
+        super(BlockCache, self).__init__(max_bytes)
+        self._block_size    = block_size
+        self._pinned        = {}
+        self._pinned_size   = 0
+
+    def __contains__(self, key):
+        return key in self._pinned or key in self._entries
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    def get_block(self, block_idx):
+        with self._lock:
+            block = self._pinned.get(block_idx)
+            if block is not None:
+                self._hits += 1
+                return block
+        return self.get(block_idx)
+
+    def put_block(self, block_idx, data, pin=False):
+        if not pin:
+            return self.put(block_idx, data)
+        self.discard(block_idx)
+        with self._lock:
+            old_data = self._pinned.pop(block_idx, None)
+            if old_data is not None:
+                self._pinned_size -= len(old_data)
+            self._pinned[block_idx] = data
+            self._pinned_size += len(data)
+        return True
+
+    def unpin_all(self):
+        """Move the pinned blocks into the LRU, where they can be evicted."""
+
+        with self._lock:
+            pinned = self._pinned
+            self._pinned = {}
+            self._pinned_size = 0
+        for block_idx in sorted(pinned):
+            self.put(block_idx, pinned[block_idx])
+
+    def clear(self):
+        super(BlockCache, self).clear()
+        with self._lock:
+            self._pinned.clear()
+            self._pinned_size = 0
+
+    def stats(self):
+        stats = super(BlockCache, self).stats()
+        with self._lock:
+            stats['pinned_entries'] = len(self._pinned)
+            stats['pinned_size'] = self._pinned_size
+        return stats
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import math
+import os.path
+import logging
+from collections import Counter
+
+logger = logging.getLogger('naabal.util.compressibility')
+
+class CompressibilityPredictor(object):
+    """Decides up front whether member data is worth compressing, so writers
+    can skip a full compression pass that would end up being thrown away.
+    """
+
+    def should_compress(self, name, data, algorithm):
+        return True
+
+class ExtensionPredictor(CompressibilityPredictor):
+    """Skips files whose extension says they are already compressed.
+    """
+
+    INCOMPRESSIBLE_EXTENSIONS = frozenset([
+        '.big', '.bz2', '.gz', '.jpeg', '.jpg', '.mp3', '.ogg', '.png',
+        '.xz', '.zip',
+    ])
+
+    def __init__(self, extensions=None):
+        if extensions is None:
+            extensions = self.INCOMPRESSIBLE_EXTENSIONS
+        self._extensions = frozenset(ext.lower() for ext in extensions)
+
+    def should_compress(self, name, data, algorithm):
+        return os.path.splitext(name)[1].lower() not in self._extensions
+
+class EntropyPredictor(CompressibilityPredictor):
+    """Skips data whose byte entropy, sampled from the start, middle and end,
+    is too close to random. With a sample_count of 1 only the start is sampled.
+    """
+
+    def __init__(self, max_entropy=7.5, sample_size=4 * 1024, sample_count=3):
+        if sample_count < 1:
+            raise ValueError('sample_count must be at least 1: %r' % sample_count)
+        self._max_entropy = max_entropy
+        self._sample_size = sample_size
+        self._sample_count = sample_count
+
+    def should_compress(self, name, data, algorithm):
+        entropy = self.sample_entropy(data)
+        logger.debug('Sampled entropy of %s: %.3f bits/byte', name, entropy)
+        return entropy < self._max_entropy
+
+    def sample_entropy(self, data):
+        data_size = len(data)
+        if data_size <= self._sample_size * self._sample_count:
+            sample = data
+        elif self._sample_count == 1:
+            sample = data[:self._sample_size]
+        else:
+            step = (data_size - self._sample_size) // (self._sample_count - 1)
+            sample = ''.join(data[pos:pos+self._sample_size] \
+                for pos in range(0, step * self._sample_count, step))
+        return shannon_entropy(sample)
+
+class TrialPredictor(CompressibilityPredictor):
+    """Compresses a prefix of the data and skips the rest if it didn't compress
+    to less than max_ratio.
+    """
+
+    def __init__(self, max_ratio=0.950, sample_size=4 * 1024):
+        self._max_ratio = max_ratio
+        self._sample_size = sample_size
+
+    def should_compress(self, name, data, algorithm):
+        if len(data) <= self._sample_size:
+            # the trial would be the full compression anyway
+            return True
+        sample = data[:self._sample_size]
+        ratio = float(len(algorithm.compress(sample))) / float(len(sample))
+        logger.debug('Trial compression ratio of %s: %03.2f %%', name, ratio * 100.0)
+        return ratio < self._max_ratio
+
+class CombinedPredictor(CompressibilityPredictor):
+    """Only compresses when all the wrapped predictors agree, they are checked
+    in order so cheap predictors should come first.
+    """
+
+    def __init__(self, predictors):
+        self._predictors = list(predictors)
+
+    def should_compress(self, name, data, algorithm):
+        return all(p.should_compress(name, data, algorithm) for p in self._predictors)
+
+def shannon_entropy(data):
+    if not data:
+        return 0.0
+    data_size = float(len(data))
+    return -sum((count / data_size) * math.log(count / data_size, 2) \
+        for count in Counter(data).values())
+
+PREDICTORS = {
+    'none':         lambda: None,
+    'extension':    ExtensionPredictor,
+    'entropy':      EntropyPredictor,
+    'trial':        TrialPredictor,
+    'auto':         lambda: CombinedPredictor([ExtensionPredictor(), EntropyPredictor()]),
+}
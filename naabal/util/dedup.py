@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import logging
+from collections import Counter
+
+logger = logging.getLogger('naabal.util.dedup')
+
+class ContentDeduplicator(object):
+    """Tracks member content by hash so identical data only has to be
+    compressed (and, where the format allows it, stored) once.
+
+    Only members sharing their size with at least one other member can have a
+    duplicate, so content of any other size is never hashed or remembered.
+
+    Each distinct content gets a blob holding the pending result preparing its
+    stored data. Once that data has been written the result is dropped and only
+    where it was written is kept, so at most the data still waiting to be
+    written is held in memory.
+    """
+
+    def __init__(self, members):
+        size_counts = Counter(m.real_size for m in members)
+        self._candidate_sizes = set(size for size, count in size_counts.items() if count > 1)
+        self._blobs = {}
+        self._duplicate_count = 0
+        self._duplicate_bytes = 0
+        self._saved_bytes = 0
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha1(data).digest()
+
+    def is_candidate(self, member):
+        return member.real_size in self._candidate_sizes
+
+    def lookup(self, data):
+        """Get the key for data and the blob of identical content seen before,
+        or None if there is none that can still be used.
+        """
+
+        key = (len(data), self.digest(data))
+        blob = self._blobs.get(key)
+        if blob is not None and blob['result'] is None and blob['position'] is None:
+            blob = None
+        return key, blob
+
+    def add(self, key, result, **extra):
+        """Remember the pending result preparing the stored data of content,
+        returns its blob. Any extra values are kept in the blob too.
+        """
+
+        blob = dict(extra, result=result, position=None, stored_size=None)
+        self._blobs[key] = blob
+        return blob
+
+    @staticmethod
+    def set_written(blob, position=None, stored_size=None):
+        """Drop the pending result of a blob once its stored data has been
+        written. position is where the data can be read back from in the handle
+        it was written to, if it can't be the content is forgotten and later
+        duplicates prepare their data again.
+        """
+
+        blob['result'] = None
+        blob['position'] = position
+        blob['stored_size'] = stored_size if position is not None else None
+
+    def record_duplicate(self, real_size, saved_size=0):
+        """Count a duplicate of real_size bytes that did not need to be
+        compressed again, saved_size is the number of stored bytes that did not
+        need to be written at all (when the format lets entries share data).
+        """
+
+        self._duplicate_count += 1
+        self._duplicate_bytes += real_size
+        self._saved_bytes += saved_size
+
+    def stats(self):
+        return {
+            'duplicate_members':    self._duplicate_count,
+            'duplicate_bytes':      self._duplicate_bytes,
+            'dedup_saved_bytes':    self._saved_bytes,
+        }
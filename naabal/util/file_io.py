@@ -25,9 +25,15 @@
 import functools
 import os
 import logging
+from abc import ABCMeta, abstractmethod
+
+from naabal.errors import CompressionException
+from naabal.util import crc32
 
 logger = logging.getLogger('naabal.util.file_io')
 
+LARGE_CHUNK_SIZE    = 1024 * 1024 # 1MB
+
 def only_if_open(orig_func):
     @functools.wraps(orig_func)
     def new_func(self, *pargs, **kwargs):
@@ -56,6 +62,161 @@ def chunked_copy(read_func, write_func, chunk_size=4 * 1024):
         chunk = read()
     return bytes_copied
 
+def replace_file(src_filename, dest_filename):
+    """Rename src_filename to dest_filename, replacing dest_filename if it
+    exists. os.rename() does that atomically on POSIX but refuses to overwrite
+    on Windows, so there the old file is moved aside first and put back if the
+    rename fails.
+    """
+
+    if os.name != 'nt' or not os.path.exists(dest_filename):
+        os.rename(src_filename, dest_filename)
+        return
+    backup_filename = '{0}.{1}.bak'.format(dest_filename, os.getpid())
+    os.rename(dest_filename, backup_filename)
+    try:
+        os.rename(src_filename, dest_filename)
+    except OSError:
+        os.rename(backup_filename, dest_filename)
+        raise
+    try:
+        os.remove(backup_filename)
+    except OSError as err:
+        logger.warning('Failed to remove replaced file %s: %s', backup_filename, err)
+
+class HashingWriter(object):
+    """Feeds everything written to it to a set of hash objects, and passes it
+    on to write_func if one is given.
+    """
+
+    def __init__(self, write_func=None, *hashes):
+        self._write_func = write_func
+        self.hashes = hashes
+
+    def write(self, data):
+        for hash_obj in self.hashes:
+            hash_obj.update(data)
+        if self._write_func is not None:
+            self._write_func(data)
+
+class CRC32Reader(object):
+    """Passes reads through to handle, keeping the CRC32 of everything read
+    as crc32.
+    """
+
+    def __init__(self, handle):
+        self._handle = handle
+        self.crc32 = 0
+
+    def read(self, size=-1):
+        data = self._handle.read(size)
+        self.crc32 = crc32(data, self.crc32)
+        return data
+
+class DecompressingReader(object):
+    """Read-only file-like object giving the decompressed data of a compressed
+    stream, pulling and decompressing input only as read() asks for more so at
+    most about one read's worth of output is held at a time.
+
+    If expected_size is given, producing more or less data than that raises
+    CompressionException. This is an abstract class, subclasses implement
+    _decompress() for their compression algorithm.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, input_buffer, expected_size=None, chunk_size=4 * 1024):
+        self._input_buffer = input_buffer
+        self._expected_size = expected_size
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._produced = 0
+        self._eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    @property
+    def produced(self):
+        return self._produced
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(iter(lambda: self.read(self._chunk_size), ''))
+        while len(self._buffer) < size and not self._eof:
+            chunk = self._decompress(size - len(self._buffer))
+            if chunk:
+                self._produced += len(chunk)
+                if self._expected_size is not None and self._produced > self._expected_size:
+                    raise CompressionException('Decompressed more than the expected %d bytes' % \
+                        self._expected_size)
+                self._buffer += chunk
+            else:
+                self._eof = True
+                if self._expected_size is not None and self._produced != self._expected_size:
+                    raise CompressionException('Decompressed %d bytes, expected %d' % \
+                        (self._produced, self._expected_size))
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        self._buffer = ''
+        self._input_buffer.close()
+
+    @abstractmethod
+    def _decompress(self, max_size):
+        """Return the next (non-empty) piece of output of about max_size
+        bytes, or an empty string at the end of the stream.
+        """
+
+def copy_range(handle, src_offset, dest_offset, size, chunk_size=LARGE_CHUNK_SIZE):
+    """Copy size bytes inside a single file from src_offset to dest_offset.
+    Overlapping ranges are handled by copying in the appropriate direction,
+    copy_file_range() is used for non-overlapping ranges where available.
+    """
+
+    if src_offset == dest_offset or size == 0:
+        return 0
+    overlapping = abs(dest_offset - src_offset) < size
+    copied = 0
+    if not overlapping and hasattr(os, 'copy_file_range'):
+        handle.flush()
+        fd = handle.fileno()
+        try:
+            while copied < size:
+                count = os.copy_file_range(fd, fd, size - copied,
+                    src_offset + copied, dest_offset + copied)
+                if count == 0:
+                    raise IOError('Unexpected EOF at offset: %d' % (src_offset + copied))
+                copied += count
+            return size
+        except OSError as err:
+            logger.debug('copy_file_range() failed, falling back to read/write: %s', err)
+    if overlapping and dest_offset > src_offset:
+        # overlapping move towards the end of the file, copy backwards
+        remaining = size
+        while remaining > 0:
+            chunk_len = min(chunk_size, remaining)
+            remaining -= chunk_len
+            handle.seek(src_offset + remaining)
+            chunk = handle.read(chunk_len)
+            handle.seek(dest_offset + remaining)
+            handle.write(chunk)
+    else:
+        while copied < size:
+            handle.seek(src_offset + copied)
+            chunk = handle.read(min(chunk_size, size - copied))
+            if not chunk:
+                raise IOError('Unexpected EOF at offset: %d' % (src_offset + copied))
+            handle.seek(dest_offset + copied)
+            handle.write(chunk)
+            copied += len(chunk)
+    return size
+
 class FileInFile(object):
     _handle = None
     _mode = None
@@ -140,6 +301,20 @@ class FileInFile(object):
         self._position += size
         return self._handle.read(size)
 
+    @only_if_open
+    def readinto(self, buffer):
+        size = self._normalize_size(len(buffer))
+        self._handle.seek(self._offset + self._position)
+        readinto = getattr(self._handle, 'readinto', None)
+        if readinto is not None:
+            size = readinto(memoryview(buffer)[:size])
+        else:
+            data = self._handle.read(size)
+            size = len(data)
+            memoryview(buffer)[:size] = data
+        self._position += size
+        return size
+
     @only_if_open
     @only_if_writable
     def write(self, data):
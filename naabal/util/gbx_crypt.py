@@ -28,6 +28,11 @@ try:
 except ImportError:
     # py3k
     izip = zip
+try:
+    import numpy
+except ImportError:
+    # optional, the pure-python version is used without it
+    numpy = None
 import logging
 
 from naabal.util import split_by
@@ -35,55 +40,154 @@ from naabal.util.c_macros import COMBINE_BYTES, SPLIT_TO_BYTES, ROTL, CAST_TO_CH
 
 logger = logging.getLogger('naabal.util.gbx_crypt')
 
+# translate() tables adding k (mod 256) to every byte, indexed by k
+_IDENTITY_TABLE = bytearray(range(256))
+ADD_TABLES = [str(_IDENTITY_TABLE[k:] + _IDENTITY_TABLE[:k]) for k in xrange(256)]
+
 class GearboxCrypt(object):
-    def __init__(self, data_size, local_key, global_key, chunk_size=4 * 1024):
+    # the key repeated to cover at least this many bytes, for applying it to
+    # whole buffers with numpy
+    KEY_PERIOD_SIZE = 64 * 1024 # 64KB
+    # data shorter than this many key lengths is done a byte at a time, the
+    # strided translate()s cost more than they save on it
+    SMALL_DATA_KEY_COUNT = 4
+
+    def __init__(self, data_size, local_key, global_key, chunk_size=1024 * 1024, use_numpy=None):
         logger.debug('Setting up crypto for data size: %d', data_size)
         self._chunk_size = chunk_size
         self._data_size = data_size
         self._key_size = len(local_key)
         self._encryption_key = self._combine_keys(local_key, global_key)
+        # decrypting adds the key to each byte and encrypting subtracts it, so
+        # both are done as adding one of these. They're repeated so any small
+        # data's worth of key can be sliced out of them
+        self._decryption_offsets = bytearray(self._encryption_key) * \
+            (self.SMALL_DATA_KEY_COUNT + 1)
+        self._encryption_offsets = bytearray(-k & 0xFF for k in self._encryption_key) * \
+            (self.SMALL_DATA_KEY_COUNT + 1)
+
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        if use_numpy:
+            repeats = self.KEY_PERIOD_SIZE // self._key_size + 2
+            self._decryption_period = numpy.tile(numpy.frombuffer(
+                str(self._decryption_offsets[:self._key_size]), dtype=numpy.uint8), repeats)
+            self._encryption_period = numpy.tile(numpy.frombuffer(
+                str(self._encryption_offsets[:self._key_size]), dtype=numpy.uint8), repeats)
+            self._apply_key = self._apply_key_numpy
+        else:
+            self._apply_key = self._apply_key_translate
 
     @property
     def encryption_key(self):
         return self._encryption_key
 
-    def decrypt_stream(self, input_buffer, output_buffer, offset=0):
+    def decrypt_stream(self, input_buffer, output_buffer, offset=0, buffer=None):
         start_pos = input_buffer.tell()
-        offset += start_pos
-        chunk = input_buffer.read(self._chunk_size)
-        while chunk:
-            output_buffer.write(self.decrypt(chunk, offset))
-            offset += len(chunk)
-            chunk = input_buffer.read(self._chunk_size)
-        logger.debug('Decrypted %d bytes', input_buffer.tell() - start_pos)
-        return input_buffer.tell() - start_pos
+        size = self._transform_stream(input_buffer, output_buffer, offset + start_pos,
+            buffer, True)
+        logger.debug('Decrypted %d bytes', size)
+        return size
 
     def decrypt(self, data, offset=0):
         data = bytearray(data)
-        key_data = self._key_stream(len(data), offset)
-        return str(bytearray(0xFF & (c + k) for c, k in izip(data, key_data)))
+        self._apply_key(data, offset, True)
+        return str(data)
+
+    def decrypt_into(self, buffer, offset=0):
+        """Decrypt a bytearray or writable memoryview in place, offset is the
+        position of its data in the encrypted stream.
+        """
+
+        self._apply_key(buffer, offset, True)
 
-    def encrypt_stream(self, input_buffer, output_buffer, offset=0):
+    def encrypt_stream(self, input_buffer, output_buffer, offset=0, buffer=None):
         start_pos = input_buffer.tell()
-        offset += start_pos
-        chunk = input_buffer.read(self._chunk_size)
-        while chunk:
-            output_buffer.write(self.encrypt(chunk, offset))
-            offset += len(chunk)
-            chunk = input_buffer.read(self._chunk_size)
-        logger.debug('Encrypted %d bytes', input_buffer.tell() - start_pos)
-        return input_buffer.tell() - start_pos
+        size = self._transform_stream(input_buffer, output_buffer, offset + start_pos,
+            buffer, False)
+        logger.debug('Encrypted %d bytes', size)
+        return size
 
     def encrypt(self, data, offset=0):
         data = bytearray(data)
-        key_data = self._key_stream(len(data), offset)
-        return str(bytearray(0xFF & (c - k) for c, k in izip(data, key_data)))
+        self._apply_key(data, offset, False)
+        return str(data)
 
-    def _key_stream(self, length, start_pos=0):
-        key = self._encryption_key
+    def encrypt_into(self, buffer, offset=0):
+        """Encrypt a bytearray or writable memoryview in place, offset is the
+        position of its data in the encrypted stream.
+        """
+
+        self._apply_key(buffer, offset, False)
+
+    def _transform_stream(self, input_buffer, output_buffer, offset, buffer, decrypting):
+        """Decrypt or encrypt everything left in input_buffer into output_buffer
+        one chunk at a time, reading into and transforming a single buffer in
+        place. The buffer is a new bytearray of chunk_size unless one is given.
+        """
+
+        if buffer is None:
+            buffer = bytearray(self._chunk_size)
+        view = memoryview(buffer)
+        readinto = getattr(input_buffer, 'readinto', None)
+        total_size = 0
+        while True:
+            if readinto is not None:
+                size = readinto(buffer)
+            else:
+                chunk = input_buffer.read(len(buffer))
+                size = len(chunk)
+                view[:size] = chunk
+            if not size:
+                break
+            chunk_view = buffer if size == len(buffer) else view[:size]
+            self._apply_key(chunk_view, offset, decrypting)
+            output_buffer.write(chunk_view)
+            offset += size
+            total_size += size
+        return total_size
+
+    def _apply_key_translate(self, data, offset, decrypting):
+        """Add the key to (or subtract it from) a buffer in place. Every
+        key_size'th byte gets the same key byte, so each of those strided
+        slices is done with a single translate().
+        """
+
+        offsets = self._decryption_offsets if decrypting else self._encryption_offsets
         ks = self._key_size
-        for i in xrange(start_pos, start_pos + length):
-            yield key[i % ks]
+        # memoryviews can't do strided slices (or give ints when iterated), so
+        # they go through a copy
+        work = data if isinstance(data, bytearray) else bytearray(data)
+        if len(work) < ks * self.SMALL_DATA_KEY_COUNT:
+            start = offset % ks
+            key_data = offsets[start:start+len(work)]
+            work[:] = bytearray((c + k) & 0xFF for c, k in izip(work, key_data))
+        else:
+            for i in xrange(ks):
+                k = offsets[(offset + i) % ks]
+                if k:
+                    work[i::ks] = work[i::ks].translate(ADD_TABLES[k])
+        if work is not data:
+            data[:] = work
+
+    def _apply_key_numpy(self, data, offset, decrypting):
+        """Add the key to (or subtract it from) a buffer in place, using
+        slices of the precomputed repeating key as uint8 arrays that wrap
+        around on overflow.
+        """
+
+        period = self._decryption_period if decrypting else self._encryption_period
+        span = len(period) - self._key_size
+        # numpy on py2 only gives a writable array over a bytearray, so
+        # memoryviews (like the filled part of a stream buffer) go through a copy
+        work = data if isinstance(data, bytearray) else bytearray(data)
+        values = numpy.frombuffer(work, dtype=numpy.uint8)
+        for pos in xrange(0, len(values), span):
+            count = min(span, len(values) - pos)
+            start = (offset + pos) % self._key_size
+            values[pos:pos+count] += period[start:start+count]
+        if work is not data:
+            data[:] = work
 
     def _combine_keys(self, local_key, global_key):
         logger.debug('Creating combined key from local key of %d bytes', len(local_key))
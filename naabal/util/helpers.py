@@ -22,8 +22,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os.path
 import logging
 
+from naabal.errors import BigIndexException, GearboxEncryptionException
+from naabal.formats.big import GearboxEncryptedBigFile
+from naabal.formats.big.index import BigIndex
 from naabal.formats.big.hw1 import HomeworldBigFile
 from naabal.formats.big.hw2 import Homeworld2BigFile
 from naabal.formats.big.hwrm import HomeworldClassicBigFile, HomeworldRemasteredBigFile
@@ -37,11 +41,59 @@ BIG_FORMATS     = [
     HomeworldBigFile,
 ]
 
-def big_load(filename):
+BIG_FORMATS_BY_NAME = dict((big_fmt.__name__, big_fmt) for big_fmt in BIG_FORMATS)
+
+def big_load(filename, member_cache=None, use_index=False, index_filename=None, mode='rb'):
+    if use_index:
+        if index_filename is None:
+            index_filename = BigIndex.get_index_filename(filename)
+        bigfile = _big_load_indexed(filename, index_filename, member_cache, mode)
+        if bigfile is not None:
+            return bigfile
+
+    bigfile = _big_load(filename, member_cache, mode)
+
+    if use_index:
+        try:
+            BigIndex.build(bigfile, filename).save(index_filename)
+        except (IOError, OSError) as err:
+            logger.warning('Failed to write index file %s: %s', index_filename, err)
+    return bigfile
+
+def _big_load_indexed(filename, index_filename, member_cache=None, mode='rb'):
+    if not os.path.exists(index_filename):
+        logger.debug('No index file found: %s', index_filename)
+        return None
+    try:
+        big_index = BigIndex.load(index_filename)
+    except (BigIndexException, IOError) as err:
+        logger.info('Ignoring unreadable index file %s: %s', index_filename, err)
+        return None
+    if not big_index.matches(filename):
+        logger.info('Ignoring stale index file: %s', index_filename)
+        return None
+    try:
+        big_fmt = BIG_FORMATS_BY_NAME[big_index.format_name]
+    except KeyError:
+        logger.info('Ignoring index with unknown format: %s', big_index.format_name)
+        return None
+
+    logger.info('Loading big file as %s from index: %s', big_fmt, index_filename)
+    bigfile = big_fmt(filename, mode, member_cache=member_cache)
+    try:
+        bigfile.load_index(big_index)
+    except Exception as err:
+        logger.info('Loading from index failed, ignoring index: %s', index_filename)
+        logger.exception(err)
+        bigfile.close()
+        return None
+    return bigfile
+
+def _big_load(filename, member_cache=None, mode='rb'):
     logger.info('Attempting to determine format for big file: %s', filename)
     for big_fmt in BIG_FORMATS:
         logger.debug('Trying format: %s', big_fmt)
-        bigfile = big_fmt(filename)
+        bigfile = big_fmt(filename, mode, member_cache=member_cache)
         try:
             bigfile.load()
         except Exception as err:
@@ -53,5 +105,28 @@ def big_load(filename):
     else:
         raise ValueError('Unable to determine appropriate .big format')
 
+def big_convert(src_filename, dest_filename, dest_format, member_cache=None):
+    """Copy all members of an archive into a new archive of another format.
+
+    Members are streamed from one archive to the other without touching the
+    filesystem, stored data is copied as-is when both formats use the same
+    compression algorithm.
+
+    Encrypted (Gearbox) formats like HomeworldRemasteredBigFile can't be
+    written, converting to one raises GearboxEncryptionException before
+    anything is read or written.
+    """
+
+    if issubclass(dest_format, GearboxEncryptedBigFile):
+        raise GearboxEncryptionException(
+            'Converting to %s is not supported, encrypted archives can\'t be written' %
+                dest_format.__name__)
+    with big_load(src_filename, member_cache=member_cache) as src_bigfile:
+        logger.info('Converting %r to format: %s', src_bigfile, dest_format)
+        with dest_format(dest_filename, 'w+b') as dest_bigfile:
+            dest_bigfile.add_from(src_bigfile)
+            dest_bigfile.save()
+            return len(dest_bigfile)
+
 def big_open(filename, mode='rb'):
     pass
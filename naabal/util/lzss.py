@@ -27,8 +27,10 @@ __all__ = ['decompress', 'compress', 'LZSS']
 import struct
 import logging
 
+from naabal.errors import CompressionBudgetExceeded
 from naabal.util import StringIO
 from naabal.util.bitio import BitReader, BitWriter
+from naabal.util.file_io import DecompressingReader, chunked_copy
 
 logger = logging.getLogger('naabal.util.lzss')
 
@@ -46,7 +48,19 @@ class LZSS(object):
     END_OF_STREAM           = 0x000
     UNUSED                  = 0
 
-    def compress_stream(self, input_buffer, output_buffer):
+    def configure(self, level=None, strategy=None):
+        """LZSS only has the one mode, so there is nothing to configure."""
+        return self
+
+    def compress_stream(self, input_buffer, output_buffer, max_output=None):
+        """Compress input_buffer into output_buffer, returning the number of
+        bytes written.
+
+        If max_output is given, raises CompressionBudgetExceeded as soon as
+        more than max_output bytes have been written, leaving output_buffer
+        holding a truncated stream.
+        """
+
         current_position    = 1
         match_length        = 0
         match_position      = 0
@@ -59,6 +73,7 @@ class LZSS(object):
             window[current_position + i] = ord(c)
 
         look_ahead_bytes = i + 1
+        consumed = look_ahead_bytes
         tree = LZSSTree(current_position, window)
 
         with BitWriter(output_buffer) as bit_writer:
@@ -76,6 +91,10 @@ class LZSS(object):
                     bit_writer.write_bits(match_length - (self.BREAK_EVEN + 1), self.LENGTH_BIT_COUNT)
                     replace_count = match_length
 
+                if max_output is not None and bit_writer.index > max_output:
+                    raise CompressionBudgetExceeded(max_output,
+                        consumed - look_ahead_bytes, bit_writer.index)
+
                 for i in xrange(replace_count):
                     tree.delete_string(MOD_WINDOW(current_position + self.LOOK_AHEAD_SIZE))
                     c = input_buffer.read(1)
@@ -83,6 +102,7 @@ class LZSS(object):
                     if len(c) == 0:
                         look_ahead_bytes -= 1
                     else:
+                        consumed += 1
                         window[MOD_WINDOW(current_position + self.LOOK_AHEAD_SIZE)] = ord(c)
 
                     current_position = MOD_WINDOW(current_position + 1)
@@ -91,43 +111,26 @@ class LZSS(object):
             # end while
             bit_writer.write_bit(0)
             bit_writer.write_bits(self.END_OF_STREAM, self.INDEX_BIT_COUNT)
-            size = bit_writer.index
 
-        return size
+        # counted after the writer has flushed its last partial byte
+        return bit_writer.index
 
-    def compress(self, input_data):
+    def compress(self, input_data, max_output=None):
         input_handle = StringIO(input_data)
         output_handle = StringIO()
-        self.compress_stream(input_handle, output_handle)
+        self.compress_stream(input_handle, output_handle, max_output)
         return output_handle.getvalue()
 
-    def decompress_stream(self, input_buffer, output_buffer):
-        current_position = 1
-        window = bytearray(self.WINDOW_SIZE)
-        output_buffer_pos_start = output_buffer.tell()
-
-        with BitReader(input_buffer) as bit_reader:
-            while True:
-                pass_through = bit_reader.read_bit()
-                if pass_through:
-                    c = bit_reader.read_bits(8)
-                    output_buffer.write(chr(c))
-                    window[current_position] = c
-                    current_position = MOD_WINDOW(current_position + 1)
-                else:
-                    match_position = bit_reader.read_bits(self.INDEX_BIT_COUNT)
-                    if match_position == self.END_OF_STREAM:
-                        break
-                    match_length = bit_reader.read_bits(self.LENGTH_BIT_COUNT)
-                    match_length += self.BREAK_EVEN
+    def decompressor(self, input_buffer, expected_size=None):
+        """Get a file-like object that decompresses input_buffer as it is read
+        from, see DecompressingReader.
+        """
 
-                    for i in xrange(match_length + 1):
-                        c = window[MOD_WINDOW(match_position + i)]
-                        output_buffer.write(chr(c))
-                        window[current_position] = c
-                        current_position = MOD_WINDOW(current_position + 1)
+        return LZSSDecompressingReader(input_buffer, expected_size)
 
-        return output_buffer.tell() - output_buffer_pos_start
+    def decompress_stream(self, input_buffer, output_buffer, expected_size=None):
+        reader = self.decompressor(input_buffer, expected_size)
+        return chunked_copy(reader.read, output_buffer.write)
 
     def decompress(self, input_data):
         input_handle = StringIO(input_data)
@@ -135,11 +138,54 @@ class LZSS(object):
         self.decompress_stream(input_handle, output_handle)
         return output_handle.getvalue()
 
+class LZSSDecompressingReader(DecompressingReader):
+    def __init__(self, input_buffer, expected_size=None, chunk_size=4 * 1024):
+        super(LZSSDecompressingReader, self).__init__(input_buffer, expected_size, chunk_size)
+        self._bit_reader = BitReader(input_buffer)
+        self._window = bytearray(LZSS.WINDOW_SIZE)
+        self._current_position = 1
+        self._finished = False
+
+    def _decompress(self, max_size):
+        if self._finished:
+            return ''
+        # a match can take the output up to LOOK_AHEAD_SIZE bytes past max_size,
+        # the extra is buffered by read()
+        output = bytearray()
+        window = self._window
+        current_position = self._current_position
+        read_bit = self._bit_reader.read_bit
+        read_bits = self._bit_reader.read_bits
+
+        while len(output) < max_size:
+            pass_through = read_bit()
+            if pass_through:
+                c = read_bits(8)
+                output.append(c)
+                window[current_position] = c
+                current_position = MOD_WINDOW(current_position + 1)
+            else:
+                match_position = read_bits(LZSS.INDEX_BIT_COUNT)
+                if match_position == LZSS.END_OF_STREAM:
+                    self._finished = True
+                    break
+                match_length = read_bits(LZSS.LENGTH_BIT_COUNT)
+                match_length += LZSS.BREAK_EVEN
+
+                for i in xrange(match_length + 1):
+                    c = window[MOD_WINDOW(match_position + i)]
+                    output.append(c)
+                    window[current_position] = c
+                    current_position = MOD_WINDOW(current_position + 1)
+
+        self._current_position = current_position
+        return str(output)
+
 def decompress(data):
     return LZSS().decompress(data)
 
-def compress(data):
-    return LZSS().compress(data)
+def compress(data, max_output=None):
+    return LZSS().compress(data, max_output)
 
 class LZSSTreeNode(object):
     parent = 0
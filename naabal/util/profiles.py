@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import fnmatch
+import os.path
+import zlib
+import logging
+
+from naabal.util.compressibility import ExtensionPredictor
+
+logger = logging.getLogger('naabal.util.profiles')
+
+class CompressionProfile(object):
+    """How to store a member: either as-is (store) or compressed with the
+    archive's algorithm at a given level and strategy. A level or strategy of
+    None keeps the algorithm's default, algorithms without levels ignore them.
+    """
+
+    def __init__(self, name, store=False, level=None, strategy=None):
+        self.name = name
+        self.store = store
+        self.level = level
+        self.strategy = strategy
+
+    def __repr__(self):
+        return '<CompressionProfile %s: store=%r level=%r strategy=%r>' % \
+            (self.name, self.store, self.level, self.strategy)
+
+    def get_algorithm(self, algorithm):
+        return algorithm.configure(self.level, self.strategy)
+
+class ProfileRule(object):
+    """Picks a profile for members matching all of the given conditions:
+    extension (case-insensitive), path glob and size range (min_size
+    inclusive, max_size exclusive).
+    """
+
+    def __init__(self, profile, extensions=None, paths=None, min_size=None, max_size=None):
+        self.profile = profile
+        self._extensions = None if extensions is None else \
+            frozenset(ext.lower() for ext in extensions)
+        self._paths = None if paths is None else list(paths)
+        self._min_size = min_size
+        self._max_size = max_size
+
+    def matches(self, name, size):
+        if self._extensions is not None and \
+                os.path.splitext(name)[1].lower() not in self._extensions:
+            return False
+        if self._paths is not None and \
+                not any(fnmatch.fnmatch(name, pattern) for pattern in self._paths):
+            return False
+        if self._min_size is not None and size < self._min_size:
+            return False
+        if self._max_size is not None and size >= self._max_size:
+            return False
+        return True
+
+class CompressionProfiles(object):
+    """Ordered rules choosing a profile per member, the first matching rule
+    wins and members no rule matches get the default profile.
+    """
+
+    def __init__(self, rules=(), default=None):
+        self._rules = list(rules)
+        if default is None:
+            default = DEFAULT_PROFILE
+        self._default = default
+
+    def select(self, name, size):
+        for rule in self._rules:
+            if rule.matches(name, size):
+                profile = rule.profile
+                break
+        else:
+            profile = self._default
+        logger.debug('Selected profile for %s [%d b]: %r', name, size, profile)
+        return profile
+
+DEFAULT_PROFILE = CompressionProfile('default')
+STORE_PROFILE = CompressionProfile('store', store=True)
+FAST_PROFILE = CompressionProfile('fast', level=zlib.Z_BEST_SPEED)
+SMALL_PROFILE = CompressionProfile('small', level=zlib.Z_BEST_COMPRESSION)
+
+TEXT_EXTENSIONS = frozenset([
+    '.events', '.ini', '.level', '.lua', '.madstate', '.miss', '.ship',
+    '.subs', '.txt', '.wepn', '.xml',
+])
+# members at least this big are compressed for speed by the auto profiles
+LARGE_MEMBER_SIZE = 16 * 1024 * 1024 # 16MB
+
+def auto_profiles():
+    """Store already-compressed files, squeeze text and scripts as small as
+    possible and compress very large members quickly.
+    """
+
+    return CompressionProfiles([
+        ProfileRule(STORE_PROFILE, extensions=ExtensionPredictor.INCOMPRESSIBLE_EXTENSIONS),
+        ProfileRule(SMALL_PROFILE, extensions=TEXT_EXTENSIONS),
+        ProfileRule(FAST_PROFILE, min_size=LARGE_MEMBER_SIZE),
+    ])
+
+PROFILES = {
+    'none':         lambda: None,
+    'fast':         lambda: CompressionProfiles(default=FAST_PROFILE),
+    'small':        lambda: CompressionProfiles(default=SMALL_PROFILE),
+    'auto':         auto_profiles,
+}
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import os.path
+import re
+import stat
+import fnmatch
+import logging
+from collections import namedtuple
+
+try:
+    # py3.5+
+    from os import scandir
+except ImportError:
+    try:
+        # py2 with the scandir backport installed
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from naabal.util.workers import get_pool
+
+logger = logging.getLogger('naabal.util.scan')
+
+# a file found under the source root, stat may be None when it came from a
+# manifest and needs to be stat()'d when loaded
+SourceFile = namedtuple('SourceFile', ['path', 'name', 'stat'])
+
+class ManifestStat(object):
+    """Just enough of an os.stat() result for ExternalBigInfo.load()."""
+
+    def __init__(self, st_size, st_mtime):
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+
+def compile_globs(patterns):
+    """Compile a sequence of glob patterns into a single match function that
+    takes a member name, returns None for no patterns.
+    """
+
+    if not patterns:
+        return None
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    regex = re.compile('|'.join('(?:%s)' % fnmatch.translate(os.path.normcase(p)) \
+        for p in patterns))
+    return lambda name: regex.match(os.path.normcase(name)) is not None
+
+def _scan_dir_listdir(dirpath):
+    dirs = []
+    files = []
+    try:
+        filenames = os.listdir(dirpath)
+    except OSError as err:
+        logger.warning('Skipping unreadable directory %s: %s', dirpath, err)
+        return dirs, files
+    for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        try:
+            fstat = os.lstat(path)
+            if stat.S_ISDIR(fstat.st_mode):
+                dirs.append(path)
+                continue
+            if stat.S_ISLNK(fstat.st_mode):
+                fstat = os.stat(path)
+        except OSError as err:
+            logger.warning('Skipping unreadable file %s: %s', path, err)
+            continue
+        if stat.S_ISDIR(fstat.st_mode):
+            logger.debug('Not following symlink to directory: %s', path)
+        else:
+            files.append((path, fstat))
+    return dirs, files
+
+def _scan_dir_scandir(dirpath):
+    dirs = []
+    files = []
+    try:
+        entries = list(scandir(dirpath))
+    except OSError as err:
+        logger.warning('Skipping unreadable directory %s: %s', dirpath, err)
+        return dirs, files
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif entry.is_dir():
+                logger.debug('Not following symlink to directory: %s', entry.path)
+            else:
+                files.append((entry.path, entry.stat()))
+        except OSError as err:
+            logger.warning('Skipping unreadable file %s: %s', entry.path, err)
+    return dirs, files
+
+scan_dir = _scan_dir_listdir if scandir is None else _scan_dir_scandir
+
+def scan_tree(path, include=None, exclude=None, workers=None):
+    """Find all the files under path, returns a list of SourceFiles with names
+    relative to path and matching the include/exclude glob patterns.
+
+    Directories are scanned a level at a time by a pool of threads, using
+    scandir() where available so stat results come with the listing. Like
+    os.walk(), symlinks to files are included but symlinks to directories are
+    not followed, and directories that can't be read are skipped with a warning.
+    """
+
+    include = compile_globs(include)
+    exclude = compile_globs(exclude)
+    found = []
+    pool = get_pool(workers, threads=True)
+    try:
+        pending = [path]
+        while pending:
+            next_pending = []
+            for dirs, files in pool.map(scan_dir, pending):
+                next_pending.extend(dirs)
+                for filename, fstat in files:
+                    name = os.path.relpath(filename, path)
+                    if (include is None or include(name)) and \
+                            (exclude is None or not exclude(name)):
+                        found.append(SourceFile(filename, name, fstat))
+                    else:
+                        logger.debug('Excluding file: %s', filename)
+            pending = next_pending
+    finally:
+        pool.close()
+        pool.join()
+    logger.debug('Found %d files under: %s', len(found), path)
+    return found
+
+def read_manifest(handle, path, include=None, exclude=None):
+    """Read a manifest of files under path instead of scanning for them. Each
+    line is a name relative to path, optionally followed by a tab separated
+    size and mtime so the file doesn't need to be stat()'d, as written by:
+
+        find . -type f -printf '%P\t%s\t%T@\n'
+
+    Blank lines and lines starting with "#" are ignored.
+    """
+
+    include = compile_globs(include)
+    exclude = compile_globs(exclude)
+    found = []
+    for line in handle:
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        name = os.path.normpath(fields[0])
+        if (include is not None and not include(name)) or \
+                (exclude is not None and exclude(name)):
+            continue
+        if len(fields) >= 3:
+            fstat = ManifestStat(int(fields[1]), float(fields[2]))
+        else:
+            fstat = None
+        found.append(SourceFile(os.path.join(path, name), name, fstat))
+    logger.debug('Read %d files from manifest for: %s', len(found), path)
+    return found
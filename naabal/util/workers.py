@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import multiprocessing
+import multiprocessing.pool
+import logging
+
+logger = logging.getLogger('naabal.util.workers')
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+class ImmediateResult(object):
+    """Stand-in for multiprocessing's AsyncResult for work that was done
+    synchronously.
+    """
+
+    def __init__(self, value=None, error=None):
+        self._value = value
+        self._error = error
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+class BatchItemResult(object):
+    """Result for one item of a batch submitted to a pool as a single task,
+    get() gives the item's entry of the list the batch's task returned.
+    """
+
+    def __init__(self, batch_result, index):
+        self._batch_result = batch_result
+        self._index = index
+
+    def ready(self):
+        return self._batch_result.ready()
+
+    def get(self, timeout=None):
+        return self._batch_result.get(timeout)[self._index]
+
+class SerialPool(object):
+    """Minimal pool-like object that runs everything in the calling thread, used
+    when only a single worker is wanted so there is no pool overhead.
+    """
+
+    def apply_async(self, func, args=(), kwds={}):
+        try:
+            return ImmediateResult(func(*args, **kwds))
+        except Exception as err:
+            return ImmediateResult(error=err)
+
+    def map(self, func, iterable):
+        return [func(item) for item in iterable]
+
+    def imap(self, func, iterable):
+        return (func(item) for item in iterable)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+def get_pool(workers=None, threads=False):
+    """Get a pool of worker processes (or threads), workers=None means one per
+    CPU and workers=1 gives a SerialPool.
+    """
+
+    if workers is None:
+        workers = cpu_count()
+    if workers <= 1:
+        return SerialPool()
+    logger.debug('Starting pool of %d worker %s', workers, 'threads' if threads else 'processes')
+    if threads:
+        return multiprocessing.pool.ThreadPool(workers)
+    else:
+        return multiprocessing.Pool(workers)
@@ -24,35 +24,163 @@
 
 import zlib
 
+from naabal.errors import CompressionException, CompressionBudgetExceeded
+from naabal.util import StringIO
+from naabal.util.file_io import DecompressingReader, chunked_copy
+from naabal.util.workers import get_pool
+
 class ZLIB(object):
-    def __init__(self, chunk_size=4 * 1024):
+    # jobs are handed to the pool in groups of about this much compressed data
+    BATCH_TASK_SIZE         = 256 * 1024 # 256KB
+
+    def __init__(self, chunk_size=4 * 1024, level=zlib.Z_DEFAULT_COMPRESSION,
+            strategy=zlib.Z_DEFAULT_STRATEGY):
         self._chunk_size = chunk_size
+        self._level = level
+        self._strategy = strategy
 
-    def compress_stream(self, input_buffer, output_buffer):
-        output_buffer_pos_start = output_buffer.tell()
-        worker = zlib.compressobj()
-        chunk = input_buffer.read(self._chunk_size)
-        while len(chunk) != 0:
-            output_buffer.write(worker.compress(chunk))
-            chunk = input_buffer.read(self._chunk_size)
-        output_buffer.write(worker.flush())
-        return output_buffer.tell() - output_buffer_pos_start
+    def configure(self, level=None, strategy=None):
+        """Get a ZLIB like this one but with a different compression level
+        and/or strategy, None keeps the current setting.
+        """
+
+        return ZLIB(self._chunk_size,
+            self._level if level is None else level,
+            self._strategy if strategy is None else strategy)
+
+    def compress_stream(self, input_buffer, output_buffer, max_output=None):
+        """Compress input_buffer into output_buffer, returning the number of
+        bytes written.
 
-    def compress(self, input_data):
-        return zlib.compress(input_data)
+        If max_output is given, raises CompressionBudgetExceeded as soon as
+        more than max_output bytes have been written. zlib holds back output
+        internally so the overrun is noticed a little late, but always before
+        the whole input has been compressed when it is large.
+        """
 
-    def decompress_stream(self, input_buffer, output_buffer):
         output_buffer_pos_start = output_buffer.tell()
-        worker = zlib.decompressobj()
+        worker = zlib.compressobj(self._level, zlib.DEFLATED, zlib.MAX_WBITS,
+            zlib.DEF_MEM_LEVEL, self._strategy)
+        consumed = 0
+        written = 0
         chunk = input_buffer.read(self._chunk_size)
         while len(chunk) != 0:
-            output_buffer.write(worker.decompress(worker.unconsumed_tail + chunk))
+            consumed += len(chunk)
+            output_chunk = worker.compress(chunk)
+            output_buffer.write(output_chunk)
+            written += len(output_chunk)
+            if max_output is not None and written > max_output:
+                raise CompressionBudgetExceeded(max_output, consumed, written)
             chunk = input_buffer.read(self._chunk_size)
-        output_buffer.write(worker.flush())
+        output_chunk = worker.flush()
+        output_buffer.write(output_chunk)
+        written += len(output_chunk)
+        if max_output is not None and written > max_output:
+            raise CompressionBudgetExceeded(max_output, consumed, written)
         return output_buffer.tell() - output_buffer_pos_start
 
+    def compress(self, input_data, max_output=None):
+        if max_output is None and self._strategy == zlib.Z_DEFAULT_STRATEGY:
+            return zlib.compress(input_data, self._level)
+        output_handle = StringIO()
+        self.compress_stream(StringIO(input_data), output_handle, max_output)
+        return output_handle.getvalue()
+
+    def decompressor(self, input_buffer, expected_size=None):
+        """Get a file-like object that decompresses input_buffer as it is read
+        from, see DecompressingReader.
+        """
+
+        return ZLIBDecompressingReader(input_buffer, expected_size, self._chunk_size)
+
+    def decompress_stream(self, input_buffer, output_buffer, expected_size=None):
+        reader = self.decompressor(input_buffer, expected_size)
+        return chunked_copy(reader.read, output_buffer.write, self._chunk_size)
+
     def decompress(self, input_data):
         return zlib.decompress(input_data)
 
+    def decompress_batch(self, jobs, outputs=None, workers=None, pool=None):
+        """Decompress many (compressed data, expected size) jobs, returning the
+        list of decompressed data in the same order.
+
+        Jobs are decompressed in a pool of `workers` threads (zlib releases the
+        GIL while it works), or in `pool` if one is given. Small jobs are grouped
+        so each task has about BATCH_TASK_SIZE of compressed data. Each job's
+        output buffer is allocated at its expected size up front so zlib doesn't
+        have to grow it, and a result that doesn't match the expected size
+        raises CompressionException. If outputs is given the results are stored
+        in it, it must already have an entry for every job.
+        """
+
+        jobs = list(jobs)
+        if outputs is None:
+            outputs = [None] * len(jobs)
+
+        groups = []
+        group = []
+        group_size = 0
+        for idx, (data, expected_size) in enumerate(jobs):
+            group.append(idx)
+            group_size += len(data)
+            if group_size >= self.BATCH_TASK_SIZE:
+                groups.append(group)
+                group = []
+                group_size = 0
+        if group:
+            groups.append(group)
+
+        def decompress_group(group):
+            for idx in group:
+                data, expected_size = jobs[idx]
+                output = zlib.decompress(data, zlib.MAX_WBITS, max(expected_size, 1))
+                if len(output) != expected_size:
+                    raise CompressionException('Decompressed %d bytes, expected %d' % \
+                        (len(output), expected_size))
+                outputs[idx] = output
+
+        if pool is not None:
+            pool.map(decompress_group, groups)
+        else:
+            pool = get_pool(workers, threads=True)
+            try:
+                pool.map(decompress_group, groups)
+            except Exception:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+        return outputs
+
+class ZLIBDecompressingReader(DecompressingReader):
+    def __init__(self, input_buffer, expected_size=None, chunk_size=4 * 1024):
+        super(ZLIBDecompressingReader, self).__init__(input_buffer, expected_size, chunk_size)
+        self._worker = zlib.decompressobj()
+        self._flushed = False
+
+    def _decompress(self, max_size):
+        worker = self._worker
+        while True:
+            data = worker.unconsumed_tail
+            if not data:
+                data = self._input_buffer.read(self._chunk_size)
+                if not data:
+                    if self._flushed:
+                        return ''
+                    # all the input has been consumed, so this is at most
+                    # what zlib was still holding back
+                    self._flushed = True
+                    return worker.flush()
+            # max_size bounds the output, input it didn't get to is kept in
+            # unconsumed_tail for the next call
+            chunk = worker.decompress(data, max_size)
+            if chunk:
+                return chunk
+
 decompress = zlib.decompress
 compress = zlib.compress
+
+def decompress_batch(jobs, workers=None):
+    return ZLIB().decompress_batch(jobs, workers=workers)
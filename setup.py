@@ -65,6 +65,9 @@ SETUP_ARGS = {
             'big-decrypt        = naabal.scripts.big:big_decrypt',
             'big-create         = naabal.scripts.big:big_create',
             'big-diff           = naabal.scripts.big:big_diff',
+            'big-convert        = naabal.scripts.big:big_convert_cmd',
+            'big-update         = naabal.scripts.big:big_update',
+            'big-compact        = naabal.scripts.big:big_compact',
         ],
     },
     'test_suite':       'tests',
@@ -24,8 +24,47 @@
 # SOFTWARE.
 
 import unittest
+import tempfile
+import tarfile
+import shutil
+import os
+import os.path
 
+from naabal.errors import BigFormatException
+from naabal.formats.big import hw1
 from naabal.formats.big.hw1 import HomeworldBigFile
+from naabal.formats.big.hwrm import HomeworldClassicBigFile
+from naabal.util import StringIO, datetime_to_timestamp
+from naabal.util.cache import MemberCache
+from naabal.util.compressibility import EntropyPredictor
+from naabal.util.file_io import replace_file
+from naabal.util.helpers import big_convert
+
+TEST_MEMBERS = {
+    os.path.join('data', 'compressible.txt'):   'Lorem ipsum dolor sit amet. ' * 64,
+    os.path.join('data', 'scripts', 'a.lua'):   'print("hello")\n' * 32,
+    os.path.join('data', 'random.bin'):         ''.join(chr((i * 7919) % 251) for i in range(2048)),
+}
+
+class ForwardOnlyWriter(object):
+    """A write-only file object that can't seek, like a pipe."""
+
+    def __init__(self):
+        self.buffer = StringIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+def build_source_tree(path, members=TEST_MEMBERS):
+    for name, data in members.items():
+        filename = os.path.join(path, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(data)
 
 class TestFormatsBigHomeworld1(unittest.TestCase):
     def setUp(self):
@@ -43,5 +82,343 @@ class TestFormatsBigHomeworld1(unittest.TestCase):
         self.assertEqual(TEST_FILENAME, self.bigfile._normalize_filename(
             self.bigfile._denormalize_filename(TEST_FILENAME)))
 
+class TestFormatsBigHomeworld1Archive(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.archive_filename = os.path.join(self.tmp_dir, 'test.big')
+        build_source_tree(self.src_dir)
+        with HomeworldBigFile(self.archive_filename, 'wb') as bigfile:
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_roundtrip(self):
+        with HomeworldBigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertEqual(sorted(TEST_MEMBERS), bigfile.get_filenames())
+            for member in bigfile.get_members():
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+
+    def test_member_cache(self):
+        cache = MemberCache()
+        with HomeworldBigFile(self.archive_filename, member_cache=cache) as bigfile:
+            bigfile.load()
+            member = bigfile.get_member(os.path.join('data', 'compressible.txt'))
+            self.assertTrue(member.is_compressed)
+            for i in range(3):
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+
+        stats = cache.stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(len(TEST_MEMBERS[member.name]), stats['size'])
+
+    def test_member_cache_large_member(self):
+        cache = MemberCache(max_bytes=256)
+        with HomeworldBigFile(self.archive_filename, member_cache=cache) as bigfile:
+            bigfile.load()
+            member = bigfile.get_member(os.path.join('data', 'compressible.txt'))
+            self.assertTrue(member.is_compressed)
+            self.assertTrue(member.real_size > cache.max_bytes)
+            output = StringIO()
+            bigfile.extract_file(member, output)
+            self.assertEqual(TEST_MEMBERS[member.name], output.getvalue())
+
+        stats = cache.stats()
+        self.assertEqual(0, stats['misses'])
+        self.assertEqual(0, stats['entries'])
+
+    def test_convert_passthrough(self):
+        dest_filename = os.path.join(self.tmp_dir, 'converted.big')
+        self.assertEqual(len(TEST_MEMBERS),
+            big_convert(self.archive_filename, dest_filename, HomeworldClassicBigFile))
+
+        with HomeworldBigFile(self.archive_filename) as src_bigfile:
+            src_bigfile.load()
+            with HomeworldClassicBigFile(dest_filename) as dest_bigfile:
+                dest_bigfile.load()
+                self.assertEqual(src_bigfile.get_filenames(), dest_bigfile.get_filenames())
+                for src_member, dest_member in zip(src_bigfile, dest_bigfile):
+                    self.assertEqual(src_member.stored_size, dest_member.stored_size)
+                    self.assertEqual(src_member.mtime, dest_member.mtime)
+                    self.assertEqual(src_bigfile.read_member(src_member, decompress=False),
+                        dest_bigfile.read_member(dest_member, decompress=False))
+                    self.assertEqual(TEST_MEMBERS[dest_member.name],
+                        dest_bigfile.read_member(dest_member))
+
+    def test_export_tar(self):
+        class WriteOnlyPipe(object):
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(data)
+
+        pipe = WriteOnlyPipe()
+        with HomeworldBigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            bigfile.export_tar(pipe)
+            mtimes = dict((m.name, m.mtime) for m in bigfile)
+
+        tar = tarfile.open(fileobj=StringIO(''.join(pipe.chunks)))
+        tar_names = [os.path.join(*ti.name.split('/')) for ti in tar.getmembers()]
+        self.assertEqual(sorted(TEST_MEMBERS), tar_names)
+        for tar_info, name in zip(tar.getmembers(), tar_names):
+            self.assertEqual(TEST_MEMBERS[name], tar.extractfile(tar_info).read())
+            self.assertEqual(datetime_to_timestamp(mtimes[name]), tar_info.mtime)
+
+    def test_update_in_place(self):
+        patch_dir = os.path.join(self.tmp_dir, 'patch')
+        patch_members = {
+            os.path.join('data', 'compressible.txt'):   'Lorem ipsum dolor sit amet. ' * 128,
+            os.path.join('data', 'new.txt'):            'brand new member ' * 16,
+        }
+        build_source_tree(patch_dir, patch_members)
+        expected = dict(TEST_MEMBERS)
+        expected.update(patch_members)
+        del expected[os.path.join('data', 'random.bin')]
+
+        with HomeworldBigFile(self.archive_filename, 'r+b') as bigfile:
+            bigfile.load()
+            untouched = bigfile.get_member(os.path.join('data', 'scripts', 'a.lua'))
+            untouched_offset = untouched._entry_offset
+            bigfile.remove(os.path.join('data', 'random.bin'))
+            bigfile.add_all(patch_dir + os.sep, replace=True)
+            bigfile.update()
+            self.assertEqual(untouched_offset,
+                bigfile.get_member(untouched.name)._entry_offset)
+            free_space = bigfile.get_free_space()
+
+        # the old data of the removed and replaced members is left as holes
+        self.assertTrue(free_space['free_size'] > 0)
+        self.assertEqual(free_space['file_size'],
+            free_space['used_size'] + free_space['free_size'])
+        with HomeworldBigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertEqual(sorted(expected), bigfile.get_filenames())
+            for member in bigfile.get_members():
+                self.assertEqual(expected[member.name], bigfile.read_member(member))
+
+    def test_update_relocates_for_toc(self):
+        patch_dir = os.path.join(self.tmp_dir, 'patch')
+        patch_members = dict((os.path.join('data', 'extra%d.txt' % i), 'extra %d' % i * 8) \
+            for i in range(4))
+        build_source_tree(patch_dir, patch_members)
+        expected = dict(TEST_MEMBERS)
+        expected.update(patch_members)
+
+        with HomeworldBigFile(self.archive_filename, 'r+b') as bigfile:
+            bigfile.load()
+            bigfile.add_all(patch_dir + os.sep)
+            bigfile.update()
+
+        with HomeworldBigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertEqual(sorted(expected), bigfile.get_filenames())
+            for member in bigfile.get_members():
+                self.assertEqual(expected[member.name], bigfile.read_member(member))
+
+    def test_compact(self):
+        with HomeworldBigFile(self.archive_filename, 'r+b') as bigfile:
+            bigfile.load()
+            bigfile.remove(os.path.join('data', 'random.bin'))
+            bigfile.update()
+            free_size = bigfile.get_free_space()['free_size']
+            self.assertTrue(free_size > 0)
+
+            self.assertEqual(free_size, bigfile.compact())
+            self.assertEqual(0, bigfile.get_free_space()['free_size'])
+            for member in bigfile.get_members():
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+        self.assertEqual(['src', 'test.big'], sorted(os.listdir(self.tmp_dir)))
+
+        with HomeworldBigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertEqual(2, len(bigfile))
+            for member in bigfile.get_members():
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+
+    def test_compact_replace_failure(self):
+        def failing_replace_file(src_filename, dest_filename):
+            raise OSError('Replace failed')
+
+        with HomeworldBigFile(self.archive_filename, 'r+b') as bigfile:
+            bigfile.load()
+            bigfile.remove(os.path.join('data', 'random.bin'))
+            bigfile.update()
+            free_size = bigfile.get_free_space()['free_size']
+
+            hw1.replace_file = failing_replace_file
+            try:
+                self.assertRaises(OSError, bigfile.compact)
+            finally:
+                hw1.replace_file = replace_file
+            self.assertEqual(['src', 'test.big'], sorted(os.listdir(self.tmp_dir)))
+            # the original archive is open again and untouched
+            self.assertEqual(free_size, bigfile.get_free_space()['free_size'])
+            for member in bigfile.get_members():
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+            self.assertEqual(free_size, bigfile.compact())
+
+    def test_compact_file_object(self):
+        # without a filename to rename over the archive is compacted in place
+        with open(self.archive_filename, 'r+b') as handle:
+            with HomeworldBigFile(handle, 'r+b') as bigfile:
+                bigfile.load()
+                bigfile.remove(os.path.join('data', 'random.bin'))
+                bigfile.update()
+                self.assertTrue(bigfile.compact() > 0)
+
+        with HomeworldBigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertEqual(0, bigfile.get_free_space()['free_size'])
+            for member in bigfile.get_members():
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+
+    def test_duplicate_content(self):
+        dup_members = dict(TEST_MEMBERS)
+        dup_name = os.path.join('data', 'copy', 'compressible.txt')
+        dup_members[dup_name] = TEST_MEMBERS[os.path.join('data', 'compressible.txt')]
+        dup_src_dir = os.path.join(self.tmp_dir, 'dup_src')
+        build_source_tree(dup_src_dir, dup_members)
+
+        with HomeworldBigFile(self.archive_filename, 'w+b') as bigfile:
+            bigfile.add_all(dup_src_dir + os.sep)
+            bigfile.save(workers=1)
+            stats = bigfile.save_stats
+        self.assertEqual(1, stats['duplicate_members'])
+        self.assertEqual(len(dup_members[dup_name]), stats['duplicate_bytes'])
+
+        # written data can't be read back to copy it, so once the first copy
+        # is out the duplicate is compressed again
+        write_only_filename = os.path.join(self.tmp_dir, 'write_only.big')
+        with HomeworldBigFile(write_only_filename, 'wb') as bigfile:
+            bigfile.add_all(dup_src_dir + os.sep)
+            bigfile.save(workers=1)
+            self.assertEqual(0, bigfile.save_stats['duplicate_members'])
+
+        for filename in (self.archive_filename, write_only_filename):
+            with HomeworldBigFile(filename) as bigfile:
+                bigfile.load()
+                for member in bigfile.get_members():
+                    self.assertEqual(dup_members[member.name], bigfile.read_member(member))
+        with open(self.archive_filename, 'rb') as handle:
+            with open(write_only_filename, 'rb') as write_only_handle:
+                self.assertEqual(handle.read(), write_only_handle.read())
+
+    def test_parallel_save_identical(self):
+        parallel_filename = os.path.join(self.tmp_dir, 'parallel.big')
+        with HomeworldBigFile(parallel_filename, 'wb') as bigfile:
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.MAX_IN_FLIGHT_BYTES = 1024
+            bigfile.save(workers=3)
+
+        serial_filename = os.path.join(self.tmp_dir, 'serial.big')
+        with HomeworldBigFile(serial_filename, 'wb') as bigfile:
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.save(workers=1)
+
+        with open(serial_filename, 'rb') as serial_handle:
+            with open(parallel_filename, 'rb') as parallel_handle:
+                self.assertEqual(serial_handle.read(), parallel_handle.read())
+
+    def test_save_stream(self):
+        output = ForwardOnlyWriter()
+        with HomeworldBigFile(output, 'wb') as bigfile:
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.STREAM_SPOOL_SIZE = 512
+            bigfile.save_stream()
+            stats = bigfile.save_stats
+
+        self.assertEqual(len(TEST_MEMBERS), stats['members'])
+        with open(self.archive_filename, 'rb') as handle:
+            self.assertEqual(handle.read(), output.buffer.getvalue())
+
+        with HomeworldBigFile(ForwardOnlyWriter(), 'wb') as bigfile:
+            self.assertIsNotNone(bigfile.MAX_STREAM_SPILL_SIZE)
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.MAX_STREAM_SPILL_SIZE = 1024
+            self.assertRaises(BigFormatException, bigfile.save_stream)
+
+    def test_stream_large_members(self):
+        incompressible = ''.join(chr(b) for b in bytearray(os.urandom(4096)))
+        build_source_tree(self.src_dir, {os.path.join('data', 'noise.bin'): incompressible})
+        expected_filename = os.path.join(self.tmp_dir, 'expected.big')
+        with HomeworldBigFile(expected_filename, 'wb') as bigfile:
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.save()
+
+        streamed_filename = os.path.join(self.tmp_dir, 'streamed.big')
+        with HomeworldBigFile(streamed_filename, 'wb') as bigfile:
+            bigfile.STREAM_COMPRESSION_SIZE = 0
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.save(workers=2)
+        output = ForwardOnlyWriter()
+        with HomeworldBigFile(output, 'wb') as bigfile:
+            bigfile.STREAM_COMPRESSION_SIZE = 0
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.save_stream()
+
+        with open(expected_filename, 'rb') as handle:
+            expected = handle.read()
+        with open(streamed_filename, 'rb') as handle:
+            self.assertEqual(expected, handle.read())
+        self.assertEqual(expected, output.buffer.getvalue())
+        with HomeworldBigFile(streamed_filename) as bigfile:
+            bigfile.load()
+            noise = bigfile.get_member(os.path.join('data', 'noise.bin'))
+            self.assertFalse(noise.is_compressed)
+            self.assertEqual(incompressible, bigfile.read_member(noise))
+
+    def test_reuse_from(self):
+        changed_name = os.path.join('data', 'scripts', 'a.lua')
+        changed_members = dict(TEST_MEMBERS)
+        changed_members[changed_name] = 'print("goodbye")\n' * 32
+        build_source_tree(self.src_dir, {changed_name: changed_members[changed_name]})
+        os.utime(os.path.join(self.src_dir, changed_name), (0, 0))
+
+        reused_filename = os.path.join(self.tmp_dir, 'reused.big')
+        with HomeworldBigFile(self.archive_filename) as previous:
+            previous.load()
+            with HomeworldBigFile(reused_filename, 'wb') as bigfile:
+                bigfile.add_all(self.src_dir + os.sep)
+                self.assertEqual(len(TEST_MEMBERS) - 1, bigfile.reuse_from(previous))
+                bigfile.save()
+
+        fresh_filename = os.path.join(self.tmp_dir, 'fresh.big')
+        with HomeworldBigFile(fresh_filename, 'wb') as bigfile:
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.save()
+
+        with open(fresh_filename, 'rb') as fresh_handle:
+            with open(reused_filename, 'rb') as reused_handle:
+                self.assertEqual(fresh_handle.read(), reused_handle.read())
+
+        with HomeworldBigFile(reused_filename) as bigfile:
+            bigfile.load()
+            for member in bigfile.get_members():
+                self.assertEqual(changed_members[member.name], bigfile.read_member(member))
+
+    def test_compressibility_predictor(self):
+        predicted_filename = os.path.join(self.tmp_dir, 'predicted.big')
+        with HomeworldBigFile(predicted_filename, 'wb') as bigfile:
+            bigfile.COMPRESSIBILITY_PREDICTOR = EntropyPredictor(max_entropy=7.0)
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.save()
+            stats = bigfile.save_stats
+        self.assertEqual(1, stats['compression_skipped'])
+        self.assertEqual(len(TEST_MEMBERS[os.path.join('data', 'random.bin')]),
+            stats['compression_skipped_bytes'])
+
+        with HomeworldBigFile(predicted_filename) as bigfile:
+            bigfile.load()
+            for member in bigfile.get_members():
+                self.assertEqual(member.name != os.path.join('data', 'random.bin'),
+                    member.is_compressed)
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import shutil
+import struct
+import zlib
+import os
+import os.path
+
+from naabal.formats.big.hw2 import Homeworld2BigFile
+from naabal.formats.big.hwrm import HomeworldRemasteredBigFile
+from naabal.util.gbx_crypt import GearboxCrypt
+from naabal.util import crc32, datetime_to_timestamp
+from naabal.errors import BigFormatException, GearboxEncryptionException
+
+from naabal.formats.big.hw1 import HomeworldBigFile
+from naabal.util.helpers import big_convert
+from naabal.util.profiles import CompressionProfiles, ProfileRule, \
+    STORE_PROFILE, SMALL_PROFILE
+
+from tests.test_formats_big_hw1 import TEST_MEMBERS, build_source_tree
+
+TEST_TIMESTAMP = 1420070400 # 2015-01-01
+
+def build_hw2_archive(filename, members, timestamp=TEST_TIMESTAMP):
+    """Write a minimal HW2 archive by hand, with a ToC for each top level
+    directory of the member names and zeroed hashes.
+    """
+
+    tocs = {}
+    for name in members:
+        toc_name, path = name.split(os.sep, 1)
+        node = tocs.setdefault(toc_name, {})
+        for part in path.split(os.sep)[:-1]:
+            node = node.setdefault(part, {})
+        node.setdefault(None, []).append(os.path.basename(name))
+
+    # folders are numbered breadth first so the subfolders of each folder are
+    # contiguous, as are the files in each folder
+    toc_entries = []
+    folders = []
+    files = []
+    for toc_name in sorted(tocs):
+        first_folder, first_file = len(folders), len(files)
+        queue = [('', tocs[toc_name])]
+        folders.append(None)
+        while queue:
+            path, node = queue.pop(0)
+            idx = len(folders) - len(queue) - 1
+            subfolders = sorted(k for k in node if k is not None)
+            first_subfolder = len(folders)
+            for subfolder in subfolders:
+                queue.append(('\\'.join(filter(None, [path, subfolder])), node[subfolder]))
+                folders.append(None)
+            first_fileinfo = len(files)
+            for fn in sorted(node.get(None, [])):
+                files.append((os.path.join(toc_name, *(path.split('\\') + [fn])), fn))
+            folders[idx] = (path, first_subfolder, len(folders), first_fileinfo, len(files))
+        toc_entries.append((toc_name, first_folder, len(folders), first_file, len(files)))
+
+    name_list = []
+    name_offsets = {}
+    def name_offset(name):
+        if name not in name_offsets:
+            name_offsets[name] = name_offsets.get(None, 0)
+            name_offsets[None] = name_offsets[name] + len(name) + 1
+            name_list.append(name)
+        return name_offsets[name]
+
+    toc_offset = 24
+    folder_offset = toc_offset + 138 * len(toc_entries)
+    file_info_offset = folder_offset + 12 * len(folders)
+    filename_offset = file_info_offset + 17 * len(files)
+
+    toc_data = ''.join(struct.pack('<64s64sHHHHH', 'TOC%d' % i, toc_name,
+        first_folder, last_folder, first_file, last_file, first_folder) \
+        for i, (toc_name, first_folder, last_folder, first_file, last_file) in enumerate(toc_entries))
+    folder_data = ''.join(struct.pack('<LHHHH', name_offset(f[0]), *f[1:]) for f in folders)
+    file_info_data = []
+    data_region = []
+    data_size = 0
+    for name, fn in files:
+        data = members[name]
+        stored = zlib.compress(data)
+        compressed = len(stored) < len(data)
+        if not compressed:
+            stored = data
+        data_region.append(struct.pack('<256sLL', fn, timestamp, crc32(data)))
+        data_size += 264
+        file_info_data.append(struct.pack('<LBLLL', name_offset(fn), 1 if compressed else 0,
+            data_size, len(stored), len(data)))
+        data_region.append(stored)
+        data_size += len(stored)
+    filename_data = ''.join(n + '\x00' for n in name_list)
+
+    section_data = struct.pack('<LHLHLHLH', toc_offset, len(toc_entries),
+        folder_offset, len(folders), file_info_offset, len(files),
+        filename_offset, len(name_list)) + toc_data + folder_data + ''.join(file_info_data) + \
+        filename_data
+    header = struct.pack('<8sL16s128s16sLL', '_ARCHIVE', 2, '\x00' * 16,
+        u'TestArchive'.encode('UTF-16-LE'), '\x00' * 16, len(section_data),
+        180 + len(section_data))
+    with open(filename, 'wb') as handle:
+        handle.write(header + section_data + ''.join(data_region))
+
+class TestFormatsBigHomeworld2Archive(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive_filename = os.path.join(self.tmp_dir, 'test.big')
+        build_hw2_archive(self.archive_filename, TEST_MEMBERS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load(self):
+        with Homeworld2BigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertEqual(sorted(TEST_MEMBERS), bigfile.get_filenames())
+            for member in bigfile.get_members():
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+                self.assertEqual(crc32(TEST_MEMBERS[member.name]), member.crc32)
+                self.assertEqual(TEST_TIMESTAMP, datetime_to_timestamp(member.mtime))
+
+    def test_filename_table(self):
+        with Homeworld2BigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertIsNotNone(bigfile._filename_table)
+            filename_map = bigfile._filename_map
+            # per-entry reads are the fallback for a missing table
+            bigfile._filename_table = None
+            self.assertEqual(filename_map, bigfile._build_filename_map())
+
+    def test_lazy_metadata(self):
+        with Homeworld2BigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            member = bigfile.get_member(os.path.join('data', 'random.bin'))
+            self.assertIsNotNone(member._metadata_offset)
+            self.assertEqual(crc32(TEST_MEMBERS[member.name]), member.crc32)
+            self.assertIsNone(member._metadata_offset)
+
+    def test_load_metadata_batched(self):
+        for read_gap, expected_reads in ((64 * 1024, 1), (0, len(TEST_MEMBERS))):
+            with Homeworld2BigFile(self.archive_filename) as bigfile:
+                bigfile.load()
+                bigfile.METADATA_READ_GAP = read_gap
+                reads = []
+                read = bigfile.read
+                bigfile.read = lambda size=-1: reads.append(size) or read(size)
+                bigfile.load_metadata()
+                self.assertEqual(expected_reads, len(reads))
+                for member in bigfile.get_members():
+                    self.assertIsNone(member._metadata_offset)
+                    self.assertEqual(TEST_TIMESTAMP, datetime_to_timestamp(member.mtime))
+                self.assertEqual(expected_reads, len(reads))
+
+    def test_get_member_from_header(self):
+        with Homeworld2BigFile(self.archive_filename) as bigfile:
+            bigfile.load_header()
+            self.assertIsNone(bigfile['folders'])
+            for name, data in TEST_MEMBERS.items():
+                member = bigfile.get_member(name)
+                self.assertEqual(name, member.name)
+                self.assertEqual(data, bigfile.read_member(member))
+            self.assertEqual([], bigfile.get_members())
+            for name in ('missing.txt', os.path.join('data', 'missing', 'random.bin')):
+                self.assertRaises(KeyError, bigfile.get_member, name)
+
+class TestFormatsBigHomeworld2Writer(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.archive_filename = os.path.join(self.tmp_dir, 'test.big')
+        build_source_tree(self.src_dir)
+        for name in TEST_MEMBERS:
+            os.utime(os.path.join(self.src_dir, name), (TEST_TIMESTAMP, TEST_TIMESTAMP))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _save(self, filename, src_dir=None, workers=None, mode='w+b'):
+        with Homeworld2BigFile(filename, mode) as bigfile:
+            bigfile.add_all(src_dir or self.src_dir)
+            bigfile.save(workers=workers)
+            return bigfile.save_stats
+
+    def _check_archive(self, filename, members=TEST_MEMBERS):
+        with Homeworld2BigFile(filename) as bigfile:
+            bigfile.load()
+            self.assertTrue(bigfile.check_key_hashes())
+            self.assertEqual(sorted(members), bigfile.get_filenames())
+            for member in bigfile.get_members():
+                self.assertEqual(members[member.name], bigfile.read_member(member))
+                self.assertEqual(crc32(members[member.name]), member.crc32)
+                self.assertEqual(TEST_TIMESTAMP, datetime_to_timestamp(member.mtime))
+            self.assertTrue(bigfile.get_member(os.path.join('data', 'compressible.txt')).is_compressed)
+
+    def test_save(self):
+        stats = self._save(self.archive_filename)
+        self.assertEqual(len(TEST_MEMBERS), stats['members'])
+        self._check_archive(self.archive_filename)
+
+    def test_save_write_only(self):
+        # write-only archives can't be read back, their data is spooled instead
+        spooled_filename = os.path.join(self.tmp_dir, 'spooled.big')
+        self._save(self.archive_filename)
+        self._save(spooled_filename, mode='wb')
+        with open(self.archive_filename, 'rb') as handle:
+            with open(spooled_filename, 'rb') as spooled_handle:
+                self.assertEqual(handle.read(), spooled_handle.read())
+
+        with Homeworld2BigFile(spooled_filename, 'wb') as bigfile:
+            bigfile.MAX_SPILL_SIZE = 1024
+            bigfile.add_all(self.src_dir)
+            self.assertRaises(BigFormatException, bigfile.save)
+            self.assertEqual(0, bigfile.tell())
+
+    def test_too_many_files(self):
+        # file counts and indices are uint16, too many files is refused before
+        # any member data is read
+        src_filename = os.path.join(self.src_dir, 'data', 'compressible.txt')
+        src_stat = os.stat(src_filename)
+        with Homeworld2BigFile(self.archive_filename, 'w+b') as bigfile:
+            for i in range(0x10000):
+                bigfile.add(bigfile.get_biginfo(src_filename,
+                    os.path.join('data', 'f%05d.txt' % i), src_stat), False)
+            self.assertRaises(BigFormatException, bigfile.save)
+        self.assertEqual(0, os.path.getsize(self.archive_filename))
+
+    def test_check_key_hashes(self):
+        self._save(self.archive_filename)
+        with open(self.archive_filename, 'r+b') as handle:
+            handle.seek(-1, os.SEEK_END)
+            last_byte = handle.read(1)
+            handle.seek(-1, os.SEEK_END)
+            handle.write(chr(ord(last_byte) ^ 0xFF))
+        with Homeworld2BigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertFalse(bigfile.check_key_hashes())
+
+    def test_parallel_save_identical(self):
+        parallel_filename = os.path.join(self.tmp_dir, 'parallel.big')
+        self._save(self.archive_filename, workers=1)
+        self._save(parallel_filename, workers=3)
+        with open(self.archive_filename, 'rb') as serial_handle:
+            with open(parallel_filename, 'rb') as parallel_handle:
+                self.assertEqual(serial_handle.read(), parallel_handle.read())
+
+    def test_duplicate_content(self):
+        dup_members = dict(TEST_MEMBERS)
+        for name in TEST_MEMBERS:
+            dup_members[os.path.join('copy', name)] = TEST_MEMBERS[name]
+        dup_src_dir = os.path.join(self.tmp_dir, 'dup_src')
+        build_source_tree(dup_src_dir, dup_members)
+        for name in dup_members:
+            os.utime(os.path.join(dup_src_dir, name), (TEST_TIMESTAMP, TEST_TIMESTAMP))
+
+        stats = self._save(self.archive_filename, dup_src_dir)
+        self.assertEqual(len(TEST_MEMBERS), stats['duplicate_members'])
+        self.assertGreater(stats['dedup_saved_bytes'], 0)
+        self._check_archive(self.archive_filename, dup_members)
+
+        # a duplicate with its own timestamp gets its own copy of the data,
+        # copied from where the first one was written
+        changed_name = os.path.join('copy', 'data', 'compressible.txt')
+        os.utime(os.path.join(dup_src_dir, changed_name), (TEST_TIMESTAMP + 60, TEST_TIMESTAMP + 60))
+        stats = self._save(self.archive_filename, dup_src_dir, workers=1)
+        self.assertEqual(len(TEST_MEMBERS), stats['duplicate_members'])
+        with Homeworld2BigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            for member in bigfile.get_members():
+                self.assertEqual(dup_members[member.name], bigfile.read_member(member))
+                self.assertEqual(crc32(dup_members[member.name]), member.crc32)
+            self.assertNotEqual(bigfile.get_member(os.path.join('data', 'compressible.txt'))._offset,
+                bigfile.get_member(changed_name)._offset)
+
+    def test_duplicate_content_other_basename(self):
+        # the metadata record holding the basename comes right before the data,
+        # so a duplicate under another basename needs its own copy of both
+        renamed_name = os.path.join('data', 'renamed.txt')
+        dup_members = dict(TEST_MEMBERS)
+        dup_members[renamed_name] = TEST_MEMBERS[os.path.join('data', 'compressible.txt')]
+        build_source_tree(self.src_dir, {renamed_name: dup_members[renamed_name]})
+        os.utime(os.path.join(self.src_dir, renamed_name), (TEST_TIMESTAMP, TEST_TIMESTAMP))
+
+        stats = self._save(self.archive_filename)
+        self.assertEqual(1, stats['duplicate_members'])
+        self.assertEqual(0, stats['dedup_saved_bytes'])
+        self._check_archive(self.archive_filename, dup_members)
+        with Homeworld2BigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            renamed = bigfile.get_member(renamed_name)
+            bigfile.load_metadata([renamed])
+            self.assertEqual('renamed.txt', os.path.basename(renamed.name))
+            self.assertNotEqual(bigfile.get_member(os.path.join('data', 'compressible.txt'))._offset,
+                renamed._offset)
+
+    def test_stream_large_members(self):
+        noise_name = os.path.join('data', 'noise.bin')
+        members = dict(TEST_MEMBERS)
+        members[noise_name] = ''.join(chr(b) for b in bytearray(os.urandom(4096)))
+        build_source_tree(self.src_dir, {noise_name: members[noise_name]})
+        os.utime(os.path.join(self.src_dir, noise_name), (TEST_TIMESTAMP, TEST_TIMESTAMP))
+        self._save(self.archive_filename)
+
+        streamed_filename = os.path.join(self.tmp_dir, 'streamed.big')
+        with Homeworld2BigFile(streamed_filename, 'wb') as bigfile:
+            bigfile.STREAM_COMPRESSION_SIZE = 0
+            bigfile.add_all(self.src_dir)
+            bigfile.save(workers=2)
+
+        with open(self.archive_filename, 'rb') as handle:
+            with open(streamed_filename, 'rb') as streamed_handle:
+                self.assertEqual(handle.read(), streamed_handle.read())
+        self._check_archive(streamed_filename, members)
+
+    def test_extract_all(self):
+        self._save(self.archive_filename)
+        for workers in (1, 2):
+            dest_dir = os.path.join(self.tmp_dir, 'extract-%d' % workers)
+            with Homeworld2BigFile(self.archive_filename) as bigfile:
+                bigfile.load()
+                bigfile.MAX_IN_FLIGHT_BYTES = 1024
+                bigfile.MAX_BATCH_EXTRACT_SIZE = 2000
+                bigfile.extract_all(path=dest_dir, workers=workers)
+            for name, data in TEST_MEMBERS.items():
+                filename = os.path.join(dest_dir, name)
+                with open(filename, 'rb') as handle:
+                    self.assertEqual(data, handle.read())
+                self.assertEqual(TEST_TIMESTAMP, int(os.path.getmtime(filename)))
+
+    def test_compression_profiles(self):
+        script_name = os.path.join('data', 'scripts', 'a.lua')
+        with Homeworld2BigFile(self.archive_filename, 'wb') as bigfile:
+            bigfile.COMPRESSION_PROFILES = CompressionProfiles([
+                ProfileRule(STORE_PROFILE, extensions=['.lua']),
+            ], default=SMALL_PROFILE)
+            bigfile.add_all(self.src_dir)
+            bigfile.save()
+            stats = bigfile.save_stats
+        self.assertEqual({'members': 1, 'real_size': len(TEST_MEMBERS[script_name]),
+            'stored_size': len(TEST_MEMBERS[script_name])}, stats['profiles']['store'])
+        self.assertEqual(len(TEST_MEMBERS) - 1, stats['profiles']['small']['members'])
+
+        self._check_archive(self.archive_filename)
+        with Homeworld2BigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertFalse(bigfile.get_member(script_name).is_compressed)
+
+    def test_convert(self):
+        hw1_filename = os.path.join(self.tmp_dir, 'test_hw1.big')
+        with HomeworldBigFile(hw1_filename, 'wb') as bigfile:
+            bigfile.add_all(self.src_dir)
+            bigfile.save()
+        big_convert(hw1_filename, self.archive_filename, Homeworld2BigFile)
+        self._check_archive(self.archive_filename)
+
+        # hw2 to hw2 copies the compressed data as-is
+        copy_filename = os.path.join(self.tmp_dir, 'copy.big')
+        big_convert(self.archive_filename, copy_filename, Homeworld2BigFile)
+        self._check_archive(copy_filename)
+
+        # encrypted archives can't be written, that is known before starting
+        hwrm_filename = os.path.join(self.tmp_dir, 'test_hwrm.big')
+        self.assertRaises(GearboxEncryptionException, big_convert,
+            self.archive_filename, hwrm_filename, HomeworldRemasteredBigFile)
+        self.assertFalse(os.path.exists(hwrm_filename))
+
+def encrypt_archive(filename, local_key):
+    """Turn a plain HW2 archive into a Remastered one, encrypting its data and
+    appending the local key after it.
+    """
+
+    with open(filename, 'rb') as handle:
+        data = handle.read()
+    crypto = GearboxCrypt(len(data), local_key, HomeworldRemasteredBigFile.MASTER_KEY)
+    key_data = struct.pack('<LH', HomeworldRemasteredBigFile.ENCRYPTION_KEY_MARKER,
+        len(local_key)) + str(local_key)
+    with open(filename, 'wb') as handle:
+        handle.write(crypto.encrypt(data))
+        handle.write(key_data)
+        handle.write(struct.pack('<L', len(key_data) + 4))
+
+class TestFormatsBigHomeworldRemastered(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive_filename = os.path.join(self.tmp_dir, 'test.big')
+        build_hw2_archive(self.archive_filename, TEST_MEMBERS)
+        encrypt_archive(self.archive_filename, bytearray(range(256)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _count_decrypts(self, bigfile):
+        decrypts = []
+        decrypt = bigfile._crypto.decrypt
+        bigfile._crypto.decrypt = lambda data, offset=0: \
+            decrypts.append(offset) or decrypt(data, offset)
+        return decrypts
+
+    def test_load(self):
+        with HomeworldRemasteredBigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertEqual(sorted(TEST_MEMBERS), bigfile.get_filenames())
+            for member in bigfile.get_members():
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+                self.assertEqual(TEST_TIMESTAMP, datetime_to_timestamp(member.mtime))
+
+    def test_block_cache(self):
+        with HomeworldRemasteredBigFile(self.archive_filename) as bigfile:
+            bigfile.DECRYPTED_BLOCK_SIZE = 256
+            bigfile.DECRYPTED_CACHE_SIZE = 512
+            bigfile.load()
+            self.assertGreater(bigfile.block_cache.stats()['pinned_entries'], 0)
+
+            # the tables are pinned, so reading them again decrypts nothing
+            decrypts = self._count_decrypts(bigfile)
+            bigfile.seek(0)
+            bigfile.read(bigfile['archive_header']['file_data_offset'])
+            self.assertEqual([], decrypts)
+
+            # member data goes through the LRU, small reads of one block decrypt it once
+            member = bigfile.get_member(os.path.join('data', 'random.bin'))
+            with bigfile.open_decompressed(member) as handle:
+                data = ''.join(iter(lambda: handle.read(16), ''))
+            self.assertEqual(TEST_MEMBERS[member.name], data)
+            self.assertEqual(len(set(decrypts)), len(decrypts))
+            self.assertLessEqual(bigfile.block_cache.size, 512)
+
+    def test_read_rest(self):
+        with open(self.archive_filename, 'rb') as handle:
+            plain_size = len(handle.read()) - 4 - 6 - 256
+        with HomeworldRemasteredBigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertIsNotNone(bigfile.block_cache)
+            bigfile.seek(0)
+            data = bigfile.read()
+            self.assertEqual(plain_size, len(data))
+            bigfile.seek(0)
+            self.assertEqual(data, bigfile.read(-1))
+            bigfile.seek(0)
+            bigfile._block_cache = None
+            self.assertEqual(data, bigfile.read())
+
+    def test_uncached(self):
+        with HomeworldRemasteredBigFile(self.archive_filename) as bigfile:
+            bigfile.DECRYPTED_CACHE_SIZE = 0
+            bigfile.load()
+            self.assertIsNone(bigfile.block_cache)
+            for member in bigfile.get_members():
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+
+if __name__ == '__main__':
+    unittest.main()
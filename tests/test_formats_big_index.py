@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import shutil
+import os
+import os.path
+
+from naabal.formats.big.hw1 import HomeworldBigFile, HomeworldBigInfo
+from naabal.formats.big.index import BigIndex
+from naabal.errors import BigIndexException
+from naabal.util.helpers import big_load
+
+from tests.test_formats_big_hw1 import TEST_MEMBERS, build_source_tree
+
+class TestFormatsBigIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.archive_filename = os.path.join(self.tmp_dir, 'test.big')
+        self.index_filename = BigIndex.get_index_filename(self.archive_filename)
+        build_source_tree(self.src_dir)
+        with HomeworldBigFile(self.archive_filename, 'wb') as bigfile:
+            bigfile.add_all(self.src_dir + os.sep)
+            bigfile.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _member_entries(self, bigfile):
+        return [m.get_index_entry() for m in bigfile.get_members()]
+
+    def test_index_roundtrip(self):
+        with big_load(self.archive_filename, use_index=True) as bigfile:
+            self.assertIsInstance(bigfile.get_members()[0], HomeworldBigInfo)
+            expected = self._member_entries(bigfile)
+        self.assertTrue(os.path.exists(self.index_filename))
+
+        with big_load(self.archive_filename, use_index=True) as bigfile:
+            self.assertIsInstance(bigfile, HomeworldBigFile)
+            self.assertIs(HomeworldBigInfo, type(bigfile.get_members()[0]))
+            self.assertEqual(expected, self._member_entries(bigfile))
+            for member in bigfile.get_members():
+                self.assertEqual(TEST_MEMBERS[member.name], bigfile.read_member(member))
+
+    def test_update_from_index(self):
+        big_load(self.archive_filename, use_index=True).close()
+        new_name = os.path.join('data', 'new.txt')
+        members = dict(TEST_MEMBERS)
+        members[new_name] = 'added after indexing ' * 16
+        patch_dir = os.path.join(self.tmp_dir, 'patch')
+        build_source_tree(patch_dir, {new_name: members[new_name]})
+
+        with big_load(self.archive_filename, use_index=True, mode='r+b') as bigfile:
+            bigfile.add_all(patch_dir + os.sep)
+            bigfile.update()
+            bigfile.compact()
+
+        with HomeworldBigFile(self.archive_filename) as bigfile:
+            bigfile.load()
+            self.assertEqual(sorted(members), bigfile.get_filenames())
+            for member in bigfile.get_members():
+                self.assertEqual(members[member.name], bigfile.read_member(member))
+
+    def test_corrupt_index(self):
+        big_load(self.archive_filename, use_index=True).close()
+        with open(self.index_filename, 'r+b') as handle:
+            handle.seek(-1, os.SEEK_END)
+            handle.write('\xFF')
+        self.assertRaises(BigIndexException, BigIndex.load, self.index_filename)
+
+        with big_load(self.archive_filename, use_index=True) as bigfile:
+            self.assertIsInstance(bigfile.get_members()[0], HomeworldBigInfo)
+        # the index should have been rebuilt
+        BigIndex.load(self.index_filename)
+
+    def test_stale_index(self):
+        big_load(self.archive_filename, use_index=True).close()
+        stat = os.stat(self.archive_filename)
+        os.utime(self.archive_filename, (stat.st_atime, stat.st_mtime + 10))
+        self.assertFalse(BigIndex.load(self.index_filename).matches(self.archive_filename))
+
+        with big_load(self.archive_filename, use_index=True) as bigfile:
+            self.assertIsInstance(bigfile.get_members()[0], HomeworldBigInfo)
+        self.assertTrue(BigIndex.load(self.index_filename).matches(self.archive_filename))
+
+if __name__ == '__main__':
+    unittest.main()
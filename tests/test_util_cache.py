@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import threading
+
+from naabal.util.cache import LRUByteCache, MemberCache, BlockCache
+
+class TestUtilCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUByteCache(max_bytes=10)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', 'xxxx')
+        self.assertEqual('xxxx', self.cache.get('a'))
+        self.assertEqual(4, self.cache.size)
+
+    def test_lru_eviction(self):
+        self.cache.put('a', 'xxxx')
+        self.cache.put('b', 'xxxx')
+        # touch a so that b is the least recently used
+        self.cache.get('a')
+        self.cache.put('c', 'xxxx')
+
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+        self.assertEqual(8, self.cache.size)
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_oversized_value(self):
+        self.assertFalse(self.cache.put('a', 'x' * 11))
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(0, self.cache.size)
+
+    def test_replace_value(self):
+        self.cache.put('a', 'xxxx')
+        self.cache.put('a', 'xx')
+        self.assertEqual(2, self.cache.size)
+        self.assertEqual(1, len(self.cache))
+
+    def test_stats(self):
+        self.cache.put('a', 'x')
+        self.cache.get('a')
+        self.cache.get('a')
+        self.cache.get('b')
+        stats = self.cache.stats()
+
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertAlmostEqual(2.0 / 3.0, stats['hit_ratio'])
+
+    def test_threaded_access(self):
+        cache = MemberCache(max_bytes=1024)
+        def worker(n):
+            for i in range(200):
+                cache.put_member(n, i, 'x' * 16)
+                cache.get_member(n, i)
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertTrue(cache.size <= 1024)
+        self.assertEqual(cache.size, 16 * len(cache))
+        stats = cache.stats()
+        self.assertEqual(800, stats['hits'] + stats['misses'])
+
+class TestUtilBlockCache(unittest.TestCase):
+    def test_pinned_blocks(self):
+        cache = BlockCache(4, max_bytes=8)
+        cache.put_block(0, 'aaaa', pin=True)
+        for block_idx in range(1, 5):
+            cache.put_block(block_idx, 'bbbb')
+        # pinned blocks are outside the budget and never evicted
+        self.assertEqual('aaaa', cache.get_block(0))
+        self.assertEqual(8, cache.size)
+        self.assertIsNone(cache.get_block(1))
+        self.assertEqual(4, cache.stats()['pinned_size'])
+
+        cache.unpin_all()
+        self.assertEqual(0, cache.stats()['pinned_entries'])
+        self.assertEqual('aaaa', cache.get_block(0))
+        self.assertEqual(8, cache.size)
+
+if __name__ == '__main__':
+    unittest.main()
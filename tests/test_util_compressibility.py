@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import random
+
+from naabal.util.compressibility import ExtensionPredictor, EntropyPredictor, \
+    TrialPredictor, CombinedPredictor, shannon_entropy
+from naabal.util.lzss import LZSS
+
+TEST_TEXT = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 256
+TEST_RNG = random.Random(1)
+TEST_RANDOM = ''.join(chr(TEST_RNG.getrandbits(8)) for i in range(16 * 1024))
+
+class TestUtilCompressibility(unittest.TestCase):
+    def setUp(self):
+        self.algorithm = LZSS()
+
+    def test_shannon_entropy(self):
+        self.assertEqual(0.0, shannon_entropy(''))
+        self.assertEqual(0.0, shannon_entropy('a' * 100))
+        self.assertAlmostEqual(8.0, shannon_entropy(''.join(chr(i) for i in range(256))))
+
+    def test_extension_predictor(self):
+        predictor = ExtensionPredictor()
+        self.assertTrue(predictor.should_compress('data/script.lua', TEST_TEXT, self.algorithm))
+        self.assertFalse(predictor.should_compress('data/sound.OGG', TEST_TEXT, self.algorithm))
+
+    def test_entropy_predictor(self):
+        predictor = EntropyPredictor()
+        self.assertTrue(predictor.should_compress('text', TEST_TEXT, self.algorithm))
+        self.assertFalse(predictor.should_compress('random', TEST_RANDOM, self.algorithm))
+
+    def test_entropy_predictor_sample_count(self):
+        self.assertRaises(ValueError, EntropyPredictor, sample_count=0)
+        predictor = EntropyPredictor(sample_count=1)
+        self.assertTrue(predictor.should_compress('text', TEST_TEXT, self.algorithm))
+        self.assertFalse(predictor.should_compress('random', TEST_RANDOM, self.algorithm))
+        self.assertEqual(shannon_entropy(TEST_RANDOM[:4 * 1024]), predictor.sample_entropy(TEST_RANDOM))
+
+    def test_trial_predictor(self):
+        predictor = TrialPredictor(sample_size=1024)
+        self.assertTrue(predictor.should_compress('text', TEST_TEXT, self.algorithm))
+        self.assertFalse(predictor.should_compress('random', TEST_RANDOM, self.algorithm))
+
+    def test_combined_predictor(self):
+        predictor = CombinedPredictor([ExtensionPredictor(), EntropyPredictor()])
+        self.assertTrue(predictor.should_compress('text.txt', TEST_TEXT, self.algorithm))
+        self.assertFalse(predictor.should_compress('text.png', TEST_TEXT, self.algorithm))
+        self.assertFalse(predictor.should_compress('random.bin', TEST_RANDOM, self.algorithm))
+
+if __name__ == '__main__':
+    unittest.main()
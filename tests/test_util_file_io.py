@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import shutil
+import os
+import os.path
+
+from naabal.errors import CompressionException
+from naabal.util import StringIO
+from naabal.util.file_io import copy_range, FileInFile, DecompressingReader, replace_file
+
+TEST_DATA = ''.join(chr(i) for i in range(256)) * 4
+
+class TestUtilFileIO(unittest.TestCase):
+    def setUp(self):
+        self.handle = tempfile.TemporaryFile()
+        self.handle.write(TEST_DATA)
+
+    def tearDown(self):
+        self.handle.close()
+
+    def _contents(self):
+        self.handle.seek(0)
+        return self.handle.read()
+
+    def _expected(self, src, dest, size):
+        data = bytearray(TEST_DATA)
+        data[dest:dest+size] = TEST_DATA[src:src+size]
+        return str(data)
+
+    def test_copy_range(self):
+        copy_range(self.handle, 0, 512, 256, chunk_size=64)
+        self.assertEqual(self._expected(0, 512, 256), self._contents())
+
+    def test_copy_range_overlap_down(self):
+        copy_range(self.handle, 100, 40, 500, chunk_size=64)
+        self.assertEqual(self._expected(100, 40, 500), self._contents())
+
+    def test_copy_range_overlap_up(self):
+        copy_range(self.handle, 40, 100, 500, chunk_size=64)
+        self.assertEqual(self._expected(40, 100, 500), self._contents())
+
+    def test_file_in_file_readinto(self):
+        buffer = bytearray(300)
+        with FileInFile(self.handle, 100, 500) as handle:
+            self.assertEqual(300, handle.readinto(buffer))
+            self.assertEqual(TEST_DATA[100:400], buffer)
+            self.assertEqual(200, handle.readinto(buffer))
+            self.assertEqual(TEST_DATA[400:600], buffer[:200])
+            self.assertEqual(0, handle.readinto(buffer))
+
+    def test_decompressing_reader(self):
+        class PassthroughReader(DecompressingReader):
+            def _decompress(self, max_size):
+                return self._input_buffer.read(min(max_size, self._chunk_size))
+
+        self.assertRaises(TypeError, DecompressingReader, StringIO(TEST_DATA))
+        with PassthroughReader(StringIO(TEST_DATA), len(TEST_DATA), chunk_size=100) as reader:
+            self.assertEqual(TEST_DATA[:10], reader.read(10))
+            self.assertEqual(TEST_DATA[10:], reader.read())
+            self.assertEqual(len(TEST_DATA), reader.produced)
+        reader = PassthroughReader(StringIO(TEST_DATA), len(TEST_DATA) + 1)
+        self.assertRaises(CompressionException, reader.read)
+
+class TestUtilReplaceFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_filename = os.path.join(self.tmp_dir, 'src')
+        self.dest_filename = os.path.join(self.tmp_dir, 'dest')
+        for filename in (self.src_filename, self.dest_filename):
+            with open(filename, 'wb') as handle:
+                handle.write(os.path.basename(filename))
+        self.os_name = os.name
+
+    def tearDown(self):
+        os.name = self.os_name
+        shutil.rmtree(self.tmp_dir)
+
+    def _read(self, filename):
+        with open(filename, 'rb') as handle:
+            return handle.read()
+
+    def test_replace_file(self):
+        replace_file(self.src_filename, self.dest_filename)
+        self.assertEqual(['dest'], os.listdir(self.tmp_dir))
+        self.assertEqual('src', self._read(self.dest_filename))
+
+    def test_replace_file_windows(self):
+        os.name = 'nt'
+        replace_file(self.src_filename, self.dest_filename)
+        self.assertEqual(['dest'], os.listdir(self.tmp_dir))
+        self.assertEqual('src', self._read(self.dest_filename))
+
+    def test_replace_file_windows_failure(self):
+        os.name = 'nt'
+        missing_filename = os.path.join(self.tmp_dir, 'missing')
+        self.assertRaises(OSError, replace_file, missing_filename, self.dest_filename)
+        self.assertEqual(['dest', 'src'], sorted(os.listdir(self.tmp_dir)))
+        self.assertEqual('dest', self._read(self.dest_filename))
+
+if __name__ == '__main__':
+    unittest.main()
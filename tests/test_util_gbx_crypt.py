@@ -24,8 +24,10 @@
 # SOFTWARE.
 
 import unittest
+import tempfile
 
-from naabal.util.gbx_crypt import GearboxCrypt
+from naabal.util import gbx_crypt
+from naabal.util.gbx_crypt import GearboxCrypt, numpy
 from naabal.util import unpack_key, StringIO
 
 TEST_GLOBAL_KEY1 = unpack_key("""
@@ -113,6 +115,50 @@ miH++bOI9D1kQDXi/zNw41db/kKww+dq9N7Cw5CFXp/Cw3kZbDafYwo9wMi3Oc/CdxbKiLSQ7ylz
 X/WHV/cCweryuKZjR15roga0ZW7494Y=
 """.strip().decode('base64')
 
+class FakeNumpyArray(object):
+    """Just enough of a uint8 numpy array over a bytearray for GearboxCrypt,
+    slices share the bytearray and adding wraps around like uint8 does.
+    """
+
+    def __init__(self, data, start=0, stop=None):
+        self._data = data
+        self._start = start
+        self._stop = len(data) if stop is None else stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, key):
+        start, stop, step = key.indices(len(self))
+        return FakeNumpyArray(self._data, self._start + start, self._start + stop)
+
+    def __setitem__(self, key, value):
+        # the slice was already added to in place
+        pass
+
+    def __iadd__(self, other):
+        for i in xrange(len(self)):
+            pos = self._start + i
+            self._data[pos] = (self._data[pos] + other._data[other._start + i]) & 0xFF
+        return self
+
+class FakeNumpy(object):
+    uint8 = 'uint8'
+
+    @staticmethod
+    def frombuffer(data, dtype):
+        if isinstance(data, str):
+            # read-only, which is fine for the key
+            return FakeNumpyArray(bytearray(data))
+        if not isinstance(data, bytearray):
+            # like numpy on py2, anything else can't be written through
+            raise TypeError('buffer is not writable: %r' % type(data))
+        return FakeNumpyArray(data)
+
+    @staticmethod
+    def tile(array, repeats):
+        return FakeNumpyArray(array._data[array._start:array._stop] * repeats)
+
 class TestUtilGbxCrypt(unittest.TestCase):
     def setUp(self):
         self.crypto = GearboxCrypt(len(TEST_DATA), TEST_LOCAL_KEY1, TEST_GLOBAL_KEY1)
@@ -163,5 +209,100 @@ class TestUtilGbxCrypt(unittest.TestCase):
             self.crypto.encrypt(TEST_DATA[partial_start:partial_end],
                 partial_start))
 
+    def test_decrypt_into(self):
+        buffer = bytearray(TEST_DATA_ENCRYPTED)
+        self.crypto.decrypt_into(buffer)
+        self.assertEqual(TEST_DATA, buffer)
+        self.crypto.encrypt_into(buffer)
+        self.assertEqual(TEST_DATA_ENCRYPTED, buffer)
+
+        # only the viewed part is touched, both short and long views
+        for start, end in ((100, 110), (3, len(TEST_DATA) - 3)):
+            buffer = bytearray(TEST_DATA_ENCRYPTED)
+            self.crypto.decrypt_into(memoryview(buffer)[start:end], start)
+            self.assertEqual(TEST_DATA_ENCRYPTED[:start] + TEST_DATA[start:end] + \
+                TEST_DATA_ENCRYPTED[end:], buffer)
+
+    def test_stream_buffer_reuse(self):
+        buffer = bytearray(100)
+        with tempfile.TemporaryFile() as input_file:
+            input_file.write(TEST_DATA_ENCRYPTED)
+            # the real file is read with readinto(), StringIO with read()
+            for input_stream in (input_file, StringIO(TEST_DATA_ENCRYPTED)):
+                input_stream.seek(10)
+                output_stream = StringIO()
+                self.assertEqual(len(TEST_DATA) - 10,
+                    self.crypto.decrypt_stream(input_stream, output_stream, buffer=buffer))
+                self.assertEqual(TEST_DATA[10:], output_stream.getvalue())
+
+    def _check_implementation(self, use_numpy):
+        crypto = GearboxCrypt(len(TEST_DATA), TEST_LOCAL_KEY1, TEST_GLOBAL_KEY1,
+            use_numpy=use_numpy)
+        # spans longer than the key period and starting mid-key
+        for start, end in ((0, len(TEST_DATA)), (1, 2), (3, 700), (511, len(TEST_DATA))):
+            self.assertEqual(TEST_DATA[start:end],
+                crypto.decrypt(TEST_DATA_ENCRYPTED[start:end], start))
+            self.assertEqual(TEST_DATA_ENCRYPTED[start:end],
+                crypto.encrypt(TEST_DATA[start:end], start))
+
+    def test_translate_implementation(self):
+        self._check_implementation(False)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_implementation(self):
+        self._check_implementation(True)
+
+    @unittest.skipUnless(numpy is not None, 'numpy is not installed')
+    def test_numpy_matches_translate(self):
+        # the real numpy path against the pure-Python one, byte for byte, for
+        # strings, memoryviews and reused stream buffers
+        numpy_crypto = GearboxCrypt(len(TEST_DATA), TEST_LOCAL_KEY1, TEST_GLOBAL_KEY1,
+            use_numpy=True)
+        translate_crypto = GearboxCrypt(len(TEST_DATA), TEST_LOCAL_KEY1, TEST_GLOBAL_KEY1,
+            use_numpy=False)
+        for start in range(0, len(TEST_DATA), 37):
+            for end in (start + 1, start + 255, start + 256, start + 257, len(TEST_DATA)):
+                for data in (TEST_DATA[start:end], TEST_DATA_ENCRYPTED[start:end]):
+                    self.assertEqual(translate_crypto.decrypt(data, start),
+                        numpy_crypto.decrypt(data, start))
+                    self.assertEqual(translate_crypto.encrypt(data, start),
+                        numpy_crypto.encrypt(data, start))
+
+                numpy_buffer = bytearray(TEST_DATA_ENCRYPTED)
+                translate_buffer = bytearray(TEST_DATA_ENCRYPTED)
+                numpy_crypto.decrypt_into(memoryview(numpy_buffer)[start:end], start)
+                translate_crypto.decrypt_into(memoryview(translate_buffer)[start:end], start)
+                self.assertEqual(translate_buffer, numpy_buffer)
+
+        for buffer_size in (1, 100, len(TEST_DATA) // 3 + 1, len(TEST_DATA) * 2):
+            numpy_output = StringIO()
+            translate_output = StringIO()
+            numpy_crypto.decrypt_stream(StringIO(TEST_DATA_ENCRYPTED), numpy_output,
+                buffer=bytearray(buffer_size))
+            translate_crypto.decrypt_stream(StringIO(TEST_DATA_ENCRYPTED), translate_output,
+                buffer=bytearray(buffer_size))
+            self.assertEqual(translate_output.getvalue(), numpy_output.getvalue())
+            self.assertEqual(TEST_DATA, numpy_output.getvalue())
+
+    def test_numpy_implementation_buffers(self):
+        # runs without numpy installed, checks the numpy path writes back into
+        # memoryviews like the ones decrypt_stream() gives it
+        real_numpy = gbx_crypt.numpy
+        gbx_crypt.numpy = FakeNumpy
+        try:
+            self._check_implementation(True)
+            crypto = GearboxCrypt(len(TEST_DATA), TEST_LOCAL_KEY1, TEST_GLOBAL_KEY1,
+                use_numpy=True)
+            output_stream = StringIO()
+            crypto.decrypt_stream(StringIO(TEST_DATA_ENCRYPTED), output_stream,
+                buffer=bytearray(len(TEST_DATA) // 3 + 1))
+            self.assertEqual(TEST_DATA, output_stream.getvalue())
+            buffer = bytearray(TEST_DATA_ENCRYPTED)
+            crypto.decrypt_into(memoryview(buffer)[3:700], 3)
+            self.assertEqual(TEST_DATA_ENCRYPTED[:3] + TEST_DATA[3:700] + \
+                TEST_DATA_ENCRYPTED[700:], buffer)
+        finally:
+            gbx_crypt.numpy = real_numpy
+
 if __name__ == '__main__':
     unittest.main()
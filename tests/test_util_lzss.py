@@ -25,7 +25,9 @@
 
 import unittest
 
-from naabal.util.lzss import decompress, compress
+from naabal.errors import CompressionException, CompressionBudgetExceeded
+from naabal.util import StringIO
+from naabal.util.lzss import decompress, compress, LZSS
 
 
 TEST_DATA1_DECOMPRESSED = """
@@ -86,5 +88,30 @@ class TestUtilLzss(unittest.TestCase):
     def test_compression(self):
         self.assertEqual(TEST_DATA1_COMPRESSED, compress(TEST_DATA1_DECOMPRESSED))
 
+    def test_compression_budget(self):
+        self.assertEqual(TEST_DATA1_COMPRESSED,
+            compress(TEST_DATA1_DECOMPRESSED, len(TEST_DATA1_COMPRESSED)))
+
+        budget = len(TEST_DATA1_COMPRESSED) / 2
+        with self.assertRaises(CompressionBudgetExceeded) as ctx:
+            compress(TEST_DATA1_DECOMPRESSED, budget)
+        self.assertEqual(budget, ctx.exception.max_output)
+        self.assertGreater(ctx.exception.written, budget)
+        self.assertLess(ctx.exception.consumed, len(TEST_DATA1_DECOMPRESSED))
+
+    def test_decompressor(self):
+        reader = LZSS().decompressor(StringIO(TEST_DATA1_COMPRESSED),
+            len(TEST_DATA1_DECOMPRESSED))
+        chunks = []
+        for chunk in iter(lambda: reader.read(100), ''):
+            self.assertLessEqual(len(chunk), 100)
+            self.assertLessEqual(len(reader._buffer), LZSS.LOOK_AHEAD_SIZE)
+            chunks.append(chunk)
+        self.assertEqual(TEST_DATA1_DECOMPRESSED, ''.join(chunks))
+
+        for expected_size in (len(TEST_DATA1_DECOMPRESSED) - 1, len(TEST_DATA1_DECOMPRESSED) + 1):
+            reader = LZSS().decompressor(StringIO(TEST_DATA1_COMPRESSED), expected_size)
+            self.assertRaises(CompressionException, reader.read)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import zlib
+
+from naabal.util.profiles import CompressionProfile, ProfileRule, CompressionProfiles, \
+    DEFAULT_PROFILE, STORE_PROFILE, FAST_PROFILE, SMALL_PROFILE, auto_profiles
+from naabal.util.lzss import LZSS
+from naabal.util.zlib_wrapper import ZLIB
+
+TEST_TEXT = ''.join('%d lorem ipsum dolor %d sit amet\n' % (i, i * i) for i in range(2048))
+
+class TestUtilProfiles(unittest.TestCase):
+    def test_rule_matching(self):
+        rule = ProfileRule(STORE_PROFILE, extensions=['.PNG'], paths=['data/*'],
+            min_size=10, max_size=100)
+        self.assertTrue(rule.matches('data/a.png', 10))
+        self.assertFalse(rule.matches('data/a.png', 100))
+        self.assertFalse(rule.matches('data/a.png', 9))
+        self.assertFalse(rule.matches('data/a.jpg', 50))
+        self.assertFalse(rule.matches('other/a.png', 50))
+        self.assertTrue(ProfileRule(STORE_PROFILE).matches('anything', 0))
+
+    def test_select(self):
+        profiles = CompressionProfiles([
+            ProfileRule(STORE_PROFILE, extensions=['.png']),
+            ProfileRule(FAST_PROFILE, min_size=1000),
+        ])
+        self.assertIs(STORE_PROFILE, profiles.select('a.png', 5000))
+        self.assertIs(FAST_PROFILE, profiles.select('a.lua', 5000))
+        self.assertIs(DEFAULT_PROFILE, profiles.select('a.lua', 10))
+
+        profiles = auto_profiles()
+        self.assertIs(STORE_PROFILE, profiles.select('a.ogg', 10))
+        self.assertIs(SMALL_PROFILE, profiles.select('a.lua', 10))
+
+    def test_algorithm_configuration(self):
+        algorithm = ZLIB()
+        for profile in (FAST_PROFILE, SMALL_PROFILE):
+            compressed_data = profile.get_algorithm(algorithm).compress(TEST_TEXT)
+            self.assertEqual(zlib.compress(TEST_TEXT, profile.level), compressed_data)
+        huffman = CompressionProfile('huffman', strategy=zlib.Z_HUFFMAN_ONLY)
+        compressed_data = huffman.get_algorithm(algorithm).compress(TEST_TEXT)
+        self.assertEqual(TEST_TEXT, zlib.decompress(compressed_data))
+        self.assertNotEqual(zlib.compress(TEST_TEXT), compressed_data)
+        # the original algorithm is left alone
+        self.assertEqual(zlib.compress(TEST_TEXT), algorithm.compress(TEST_TEXT))
+
+        lzss = LZSS()
+        self.assertIs(lzss, SMALL_PROFILE.get_algorithm(lzss))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+import tempfile
+import shutil
+import os
+import os.path
+
+from naabal.formats.big.hw1 import HomeworldBigFile
+from naabal.util import StringIO
+from naabal.util.scan import compile_globs, scan_tree, read_manifest, scan_dir
+from tests.test_formats_big_hw1 import TEST_MEMBERS, build_source_tree
+
+
+class TestUtilScan(unittest.TestCase):
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        build_source_tree(self.src_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+
+    def test_compile_globs(self):
+        self.assertIsNone(compile_globs(None))
+        match = compile_globs(['*.lua', os.path.join('data', '*.txt')])
+        self.assertTrue(match(os.path.join('data', 'scripts', 'a.lua')))
+        self.assertTrue(match(os.path.join('data', 'compressible.txt')))
+        self.assertFalse(match(os.path.join('data', 'random.bin')))
+
+    def test_scan_tree(self):
+        for workers in (1, 3):
+            found = scan_tree(self.src_dir, workers=workers)
+            self.assertEqual(sorted(TEST_MEMBERS), sorted(f.name for f in found))
+            for source_file in found:
+                self.assertEqual(len(TEST_MEMBERS[source_file.name]), source_file.stat.st_size)
+                self.assertEqual(os.path.join(self.src_dir, source_file.name), source_file.path)
+
+    def test_scan_tree_symlinks(self):
+        os.symlink(self.src_dir, os.path.join(self.src_dir, 'data', 'loop'))
+        os.symlink(os.path.join(self.src_dir, 'data', 'random.bin'),
+            os.path.join(self.src_dir, 'data', 'linked.bin'))
+        os.symlink(os.path.join(self.src_dir, 'missing'),
+            os.path.join(self.src_dir, 'data', 'dangling'))
+        found = scan_tree(self.src_dir)
+        expected = sorted(TEST_MEMBERS) + [os.path.join('data', 'linked.bin')]
+        self.assertEqual(sorted(expected), sorted(f.name for f in found))
+
+    def test_scan_dir_unreadable(self):
+        self.assertEqual(([], []), scan_dir(os.path.join(self.src_dir, 'missing')))
+
+    def test_scan_tree_globs(self):
+        found = scan_tree(self.src_dir, include=['*.txt', '*.lua'], exclude='*/scripts/*')
+        self.assertEqual([os.path.join('data', 'compressible.txt')], [f.name for f in found])
+
+    def test_read_manifest(self):
+        manifest = StringIO('# comment\n\n%s\t10\t1234.5\n%s\n' % (
+            os.path.join('data', 'random.bin'), os.path.join('data', 'scripts', 'a.lua')))
+        found = read_manifest(manifest, self.src_dir, exclude='*.lua')
+        self.assertEqual(1, len(found))
+        self.assertEqual(os.path.join('data', 'random.bin'), found[0].name)
+        self.assertEqual(10, found[0].stat.st_size)
+        self.assertEqual(1234.5, found[0].stat.st_mtime)
+
+    def test_add_all_manifest(self):
+        manifest_filename = os.path.join(self.src_dir, 'manifest.txt')
+        with open(manifest_filename, 'wb') as handle:
+            handle.write('\n'.join(TEST_MEMBERS) + '\n')
+
+        bigfile = HomeworldBigFile(os.devnull)
+        bigfile.add_all(self.src_dir, manifest=manifest_filename)
+        self.assertEqual(sorted(TEST_MEMBERS), bigfile.get_filenames())
+        for member in bigfile.get_members():
+            self.assertEqual(len(TEST_MEMBERS[member.name]), member.real_size)
+
+        scanned = HomeworldBigFile(os.devnull)
+        scanned.add_all(self.src_dir, exclude=lambda fn: fn == manifest_filename)
+        self.assertEqual(bigfile.get_filenames(), scanned.get_filenames())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Alex Headley <aheadley@waysaboutstuff.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import random
+import unittest
+import zlib
+
+from naabal.errors import CompressionException, CompressionBudgetExceeded
+from naabal.util import StringIO
+from naabal.util.zlib_wrapper import ZLIB
+
+
+TEST_DATA = ''.join(chr((i * 7919) % 251) for i in range(64 * 1024))
+
+class TestUtilZlibWrapper(unittest.TestCase):
+    def test_compression(self):
+        self.assertEqual(zlib.compress(TEST_DATA), ZLIB().compress(TEST_DATA))
+
+    def test_compression_budget(self):
+        compressed_data = zlib.compress(TEST_DATA)
+        self.assertEqual(compressed_data, ZLIB().compress(TEST_DATA, len(compressed_data)))
+
+        with self.assertRaises(CompressionBudgetExceeded) as ctx:
+            ZLIB().compress(TEST_DATA, len(compressed_data) - 1)
+        self.assertEqual(len(compressed_data) - 1, ctx.exception.max_output)
+        self.assertGreater(ctx.exception.written, ctx.exception.max_output)
+
+    def test_compression_budget_early_abort(self):
+        rng = random.Random(1)
+        incompressible_data = ''.join(chr(rng.randrange(256)) for i in range(256 * 1024))
+        with self.assertRaises(CompressionBudgetExceeded) as ctx:
+            ZLIB().compress(incompressible_data, 1024)
+        self.assertLess(ctx.exception.consumed, len(incompressible_data))
+
+    def test_decompress_batch(self):
+        originals = [TEST_DATA[:size] for size in (0, 1, 100, 4096, len(TEST_DATA))] * 4
+        jobs = [(zlib.compress(data), len(data)) for data in originals]
+        for workers in (1, 2):
+            self.assertEqual(originals, ZLIB().decompress_batch(jobs, workers=workers))
+
+        with self.assertRaises(CompressionException):
+            ZLIB().decompress_batch([(zlib.compress(TEST_DATA), len(TEST_DATA) - 1)], workers=2)
+
+    def test_decompressor(self):
+        # highly compressible, so a small amount of input expands a long way
+        data = TEST_DATA * 16
+        reader = ZLIB().decompressor(StringIO(zlib.compress(data)), len(data))
+        chunks = []
+        for chunk in iter(lambda: reader.read(1000), ''):
+            self.assertLessEqual(len(chunk), 1000)
+            self.assertEqual('', reader._buffer)
+            chunks.append(chunk)
+        self.assertEqual(data, ''.join(chunks))
+
+        for expected_size in (len(data) - 1, len(data) + 1):
+            reader = ZLIB().decompressor(StringIO(zlib.compress(data)), expected_size)
+            self.assertRaises(CompressionException, reader.read)
+
+if __name__ == '__main__':
+    unittest.main()